@@ -0,0 +1,406 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Takes the base backups of the cluster with WAL-E, on the leader only and only when one is due
+
+A single connection to Postgres is kept open to find out whether we are the leader. Patroni tells us when the role
+changes, through the on_role_change callback sending us SIGUSR1, so on a replica we sleep until we are promoted.
+The time of the last backup is kept in a state file, S3 is only asked about it when a backup seems to be due.
+
+A backup is due as soon as the WAL written since the last one exceeds the threshold of WAL-E, in megabytes or as a
+percentage of the size of the last backup, so a restore never has to replay more than that. Besides that a backup
+is taken on the schedule of BACKUP_HOUR and BACKUP_INTERVAL, unless hardly any WAL has been written since the last."""
+
+import argparse
+import calendar
+import datetime
+import json
+import logging
+import os
+import re
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+PGHOME = os.environ.get('PGHOME', '/home/postgres')
+STATE_FILE = os.path.join(PGHOME, 'backup_state.json')
+PID_FILE = os.path.join(PGHOME, 'backup_scheduler.pid')
+
+BACKUP_INTERVAL = 3600
+# # After a failed backup we try again after RETRY_DELAY seconds, instead of waiting for the next interval
+RETRY_DELAY = 60
+# # When we cannot tell whether a backup is due, we look again after RETRY_DELAY seconds, backing off up to this
+ERROR_MAX_DELAY = 600
+# # Role changes are signalled by Patroni, we look at the role ourselves once in a while in case we missed one
+ROLE_CHECK_INTERVAL = 600
+CONNECT_DELAY = 1
+CONNECT_MAX_DELAY = 30
+
+# # On the leader we look at how much WAL has been written every WAL_CHECK_INTERVAL seconds
+WAL_CHECK_INTERVAL = 60
+WAL_SEGMENT_SIZE = 16 * 1024 * 1024
+# # A scheduled backup is skipped if the WAL since the last one is less than this fraction of the threshold
+IDLE_FRACTION = 0.1
+
+base_backup_re = re.compile(r'^base_(?P<segment>[0-9A-F]{24})_(?P<offset>\d{8})$')
+
+
+def psycopg2_connect():
+    import psycopg2
+
+    connection = psycopg2.connect(dbname='postgres', connect_timeout=5)
+    connection.autocommit = True
+    return connection
+
+
+def run_command(cmd):
+    """Returns the exit code and the output of the command, the errors end up in our log"""
+
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stdin=subprocess.DEVNULL)
+    output = process.communicate()[0]
+    return process.returncode, output.decode('utf-8', 'replace')
+
+
+def parse_time(s):
+    """
+    >>> parse_time('2015-10-27T10:00:00.000Z')
+    1445940000
+    """
+    return calendar.timegm(datetime.datetime.strptime(s, '%Y-%m-%dT%H:%M:%S.%fZ').timetuple())
+
+
+def parse_backup_list(output):
+    """Returns the backups listed by wal-e backup-list as dicts, the columns are named by the header
+
+    >>> parse_backup_list('name\\tlast_modified\\nbase_1\\t2015-10-27T10:00:00.000Z\\n')
+    [{'name': 'base_1', 'last_modified': '2015-10-27T10:00:00.000Z'}]
+    """
+    lines = [line.split('\t') for line in output.splitlines() if line.strip()]
+    if not lines:
+        return []
+    return [dict(zip(lines[0], line)) for line in lines[1:]]
+
+
+def segment_lsn(segment, offset):
+    """Returns the location in the WAL of a decimal offset in a segment, as shown by pg_current_xlog_location
+
+    >>> segment_lsn('000000010000000A000000FF', '00008192')
+    'A/FF002000'
+    """
+    xlogid = int(segment[8:16], 16)
+    position = int(segment[16:24], 16) * WAL_SEGMENT_SIZE + int(offset)
+    return '{0:X}/{1:X}'.format(xlogid, position)
+
+
+def backup_start_lsn(backup):
+    """The location in the WAL a backup listed by wal-e starts at, it is part of the name of the backup
+
+    >>> backup_start_lsn({'name': 'base_000000010000000000000002_00000040'})
+    '0/2000028'
+    """
+    if backup.get('wal_segment_backup_start'):
+        return segment_lsn(backup['wal_segment_backup_start'], backup['wal_segment_offset_backup_start'])
+    match = base_backup_re.match(backup['name'])
+    return segment_lsn(match.group('segment'), match.group('offset')) if match else None
+
+
+def wal_threshold(size, threshold_megabytes=None, threshold_percentage=None):
+    """The number of bytes of WAL after which a new backup is due, None without any threshold
+
+    >>> wal_threshold(10 * 2 ** 30, 1024, 30)
+    1073741824
+    >>> wal_threshold(10 * 2 ** 20, 1024, 30)
+    3145728
+    >>> wal_threshold(None, None, 30) is None
+    True
+    """
+    thresholds = list()
+    if threshold_megabytes:
+        thresholds.append(int(threshold_megabytes) * 1024 * 1024)
+    if threshold_percentage and size:
+        thresholds.append(int(size * float(threshold_percentage) / 100))
+    return min(thresholds) if thresholds else None
+
+
+def parse_backup_hour(value):
+    """The hour of the day to take backups at, * (or nothing) for any hour
+
+    >>> parse_backup_hour(''), parse_backup_hour('*'), parse_backup_hour('03')
+    ('*', '*', 3)
+    """
+    if value.strip() in ('', '*'):
+        return '*'
+    hour = int(value)
+    if not 0 <= hour < 24:
+        raise ValueError('{} is not an hour of the day'.format(value))
+    return hour
+
+
+def next_backup_time(last_backup, interval, backup_hour='*'):
+    """Returns when the next backup is due: interval seconds after the last one, during the backup hour if set
+
+    >>> next_backup_time(1445940000, 3600)
+    1445943600
+    >>> next_backup_time(1445940000, 3600, time.localtime(1445943600).tm_hour)
+    1445943600
+    >>> next_backup_time(1445940000, 3600, time.localtime(1445940000).tm_hour) - 1445940000
+    86400
+    """
+    due = last_backup + interval
+    if backup_hour == '*':
+        return due
+
+    hour = int(backup_hour)
+    local = time.localtime(due)
+    if local.tm_hour == hour:
+        return due
+
+    # # The start of the backup hour on the day the backup is due, or on the next day if that hour has passed
+    start = datetime.datetime(*local[:3]) + datetime.timedelta(hours=hour)
+    if local.tm_hour > hour:
+        start += datetime.timedelta(days=1)
+    return int(time.mktime(start.timetuple()))
+
+
+class BackupScheduler(object):
+
+    def __init__(self, env_dir, data_dir, backup_hour='*', interval=BACKUP_INTERVAL, retain=2,
+                 state_file=STATE_FILE, connect=psycopg2_connect, run=run_command, threshold_megabytes=None,
+                 threshold_percentage=None):
+        self.env_dir = env_dir
+        self.data_dir = data_dir
+        self.backup_hour = backup_hour
+        self.interval = interval
+        self.retain = retain
+        self.threshold_megabytes = threshold_megabytes
+        self.threshold_percentage = threshold_percentage
+        self.state_file = state_file
+        self.connect = connect
+        self.run = run
+        self.connection = None
+        self.connect_delay = CONNECT_DELAY
+        self.error_delay = RETRY_DELAY
+        self.leader = False
+        self.state = self.load_state()
+        self.wakeup = threading.Event()
+        self.stopped = False
+
+    def load_state(self):
+        try:
+            with open(self.state_file) as f:
+                state = json.load(f)
+        except (IOError, OSError, ValueError):
+            state = dict()
+        # # What we remember may have been done by an earlier leader, it is checked against S3 once it matters
+        state['verified'] = False
+        state.pop('failed', None)
+        return state
+
+    def save_state(self):
+        tmp = self.state_file + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({k: v for k, v in self.state.items() if k not in ('verified', 'failed')}, f)
+        os.rename(tmp, self.state_file)
+
+    def wal_e(self, *args):
+        return ['envdir', self.env_dir, 'wal-e', '--aws-instance-profile'] + list(args)
+
+    def query(self, query, *params):
+        """Runs the query over the connection we keep open, returns the first row"""
+
+        if self.connection is None:
+            self.connection = self.connect()
+        try:
+            with self.connection.cursor() as cursor:
+                cursor.execute(query, params)
+                return cursor.fetchone()
+        except Exception:
+            self.close()
+            raise
+
+    def is_leader(self):
+        return not self.query('SELECT pg_is_in_recovery()')[0]
+
+    def close(self):
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except Exception:
+                pass
+            self.connection = None
+
+    def latest_backup(self):
+        """Asks S3 for the latest backup, returns None if there is none"""
+
+        code, output = self.run(self.wal_e('backup-list', '--detail', 'LATEST'))
+        if code != 0:
+            raise Exception('wal-e backup-list exited with code {}'.format(code))
+        backups = parse_backup_list(output)
+        return backups[-1] if backups else None
+
+    def refresh_state(self):
+        backup = self.latest_backup()
+        self.state['last_backup'] = parse_time(backup['last_modified']) if backup else None
+        self.state['start_lsn'] = backup_start_lsn(backup) if backup else None
+        self.state['size'] = int(backup['expanded_size_bytes']) if backup and backup.get('expanded_size_bytes') \
+            else None
+        self.state['verified'] = True
+        self.state.pop('failed', None)
+        self.save_state()
+
+    def wal_since_backup(self):
+        """The number of bytes of WAL written since the last backup started, None if we do not know"""
+
+        if self.state.get('start_lsn') is None:
+            return None
+        return int(self.query('SELECT pg_xlog_location_diff(pg_current_xlog_location(), %s)',
+                              self.state['start_lsn'])[0])
+
+    def backup_reason(self, wal, now):
+        """Returns why a backup is due now, None if it is not"""
+
+        if self.state.get('failed') is not None:
+            return 'retrying the failed backup' if self.state['failed'] + RETRY_DELAY <= now else None
+        if self.state.get('last_backup') is None:
+            return 'there is no backup'
+
+        threshold = wal_threshold(self.state.get('size'), self.threshold_megabytes, self.threshold_percentage)
+        if wal is not None and threshold is not None:
+            if wal >= threshold:
+                return '{} MB of WAL was written since the last backup'.format(wal // 2 ** 20)
+            if wal < threshold * IDLE_FRACTION:
+                # # Another backup would hardly shorten a restore
+                return None
+
+        if next_backup_time(self.state['last_backup'], self.interval, self.backup_hour) <= now:
+            return 'the backup is scheduled'
+        return None
+
+    def backup(self):
+        # # The backup starts at a checkpoint after this location, so we may count a little WAL too much
+        start_lsn, size = self.query('SELECT pg_current_xlog_location(), '
+                                     '(SELECT sum(pg_database_size(oid)) FROM pg_database)')
+        code, _ = self.run(self.wal_e('backup-push', self.data_dir))
+        if code != 0:
+            logging.error('wal-e backup-push exited with code {}, retrying in {} seconds'.format(code, RETRY_DELAY))
+            self.state['failed'] = time.time()
+            return False
+
+        self.state.pop('failed', None)
+        self.state.update(last_backup=time.time(), start_lsn=start_lsn, size=int(size), verified=True)
+        self.save_state()
+
+        # # Only now that the new backup is there, the old ones can go
+        self.run(self.wal_e('delete', '--confirm', 'retain', str(self.retain)))
+        return True
+
+    def step(self):
+        """Does whatever needs to be done now, returns the number of seconds to sleep until we look again"""
+
+        try:
+            leader = self.is_leader()
+        except Exception as e:
+            delay = self.connect_delay
+            self.connect_delay = min(self.connect_delay * 2, CONNECT_MAX_DELAY)
+            logging.debug('Postgres is not available, retrying in {} seconds: {}'.format(delay, e))
+            return delay
+        self.connect_delay = CONNECT_DELAY
+
+        if leader != self.leader:
+            logging.info('We are {} the leader'.format('now' if leader else 'no longer'))
+            self.leader = leader
+            self.state['verified'] = False
+        if not leader:
+            return ROLE_CHECK_INTERVAL
+
+        try:
+            wal = self.wal_since_backup()
+            reason = self.backup_reason(wal, time.time())
+            if reason is not None and not self.state['verified']:
+                # # Another leader may have taken a backup we do not know about
+                self.refresh_state()
+                wal = self.wal_since_backup()
+                reason = self.backup_reason(wal, time.time())
+        except Exception as e:
+            # # Only a failed backup-push makes us push again, not knowing whether a backup is due makes us look again
+            delay = self.error_delay
+            self.error_delay = min(self.error_delay * 2, ERROR_MAX_DELAY)
+            logging.error('Could not find out whether a backup is due, retrying in {} seconds: {}'.format(delay, e))
+            return delay
+        self.error_delay = RETRY_DELAY
+
+        if reason is not None:
+            logging.info('Producing a new backup, as {}'.format(reason))
+            if not self.backup():
+                return RETRY_DELAY
+        return WAL_CHECK_INTERVAL
+
+    def run_forever(self):
+        while not self.stopped:
+            delay = self.step()
+            logging.debug('Sleeping for {:.0f} seconds'.format(delay))
+            self.wakeup.wait(delay)
+            self.wakeup.clear()
+        self.close()
+
+    def wake(self, *args):
+        self.wakeup.set()
+
+    def stop(self, *args):
+        self.stopped = True
+        self.wakeup.set()
+
+
+def notify(pid_file=PID_FILE):
+    """Tells the scheduler that the role has changed, it is fine if it is not running"""
+
+    try:
+        with open(pid_file) as f:
+            os.kill(int(f.read().strip()), signal.SIGUSR1)
+    except (IOError, OSError, ValueError) as e:
+        logging.debug('Could not notify the backup scheduler: {}'.format(e))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--env-dir', default=os.environ.get('WALE_ENV_DIR'), help='The envdir of WAL-E')
+    parser.add_argument('--data-dir', default=os.environ.get('PGDATA'), help='The data directory of Postgres')
+    parser.add_argument('--backup-hour', type=parse_backup_hour, default=os.environ.get('BACKUP_HOUR', '*'),
+                        help='The hour of the day to take backups at, * for any hour')
+    parser.add_argument('--interval', type=int, default=BACKUP_INTERVAL,
+                        help='The minimum number of seconds between two backups')
+    parser.add_argument('--retain', type=int, default=int(os.environ.get('BACKUP_NUM_TO_RETAIN') or 2),
+                        help='The number of base backups to keep')
+    parser.add_argument('--threshold-megabytes', type=int,
+                        default=os.environ.get('WALE_BACKUP_THRESHOLD_MEGABYTES') or None,
+                        help='Take a backup once this much WAL has been written since the last one')
+    parser.add_argument('--threshold-percentage', type=float,
+                        default=os.environ.get('WALE_BACKUP_THRESHOLD_PERCENTAGE') or None,
+                        help='Take a backup once the WAL since the last one is this percentage of its size')
+    parser.add_argument('--state-file', default=STATE_FILE)
+    parser.add_argument('--pid-file', default=PID_FILE)
+    parser.add_argument('--notify', action='store_true', help='Tell the running scheduler the role has changed')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s backup %(levelname)s: %(message)s', level=logging.INFO)
+
+    if args.notify:
+        return notify(args.pid_file)
+
+    scheduler = BackupScheduler(args.env_dir, args.data_dir, args.backup_hour, args.interval, args.retain,
+                                args.state_file, threshold_megabytes=args.threshold_megabytes,
+                                threshold_percentage=args.threshold_percentage)
+    signal.signal(signal.SIGUSR1, scheduler.wake)
+    signal.signal(signal.SIGTERM, scheduler.stop)
+
+    with open(args.pid_file, 'w') as f:
+        f.write(str(os.getpid()))
+    try:
+        scheduler.run_forever()
+    finally:
+        os.unlink(args.pid_file)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Creates the data directory of a new replica, the restore script of Patroni
+
+The latest base backup of WAL-E is restored, its partitions are downloaded and decompressed in parallel, after which
+Postgres catches up by fetching the WAL written since then from S3. If there is no backup, restoring it fails or the
+WAL to replay exceeds the thresholds of WAL-E, the data directory is streamed from the master with pg_basebackup.
+How long every phase took is logged at the end, so we can see where the minutes go.
+
+Patroni calls the script with the data directory and the connection string of the master as the last arguments."""
+
+import contextlib
+import logging
+import multiprocessing
+import os
+import shutil
+import sys
+import time
+
+from backup_scheduler import backup_start_lsn, parse_backup_list, run_command, wal_threshold
+
+# # WAL-E downloads this many partitions of the backup at the same time, each is decompressed by its own lzop
+MIN_POOL_SIZE = 4
+
+
+def psycopg2_connect(connstring):
+    import psycopg2
+
+    connection = psycopg2.connect(connstring, connect_timeout=5)
+    connection.autocommit = True
+    return connection
+
+
+class Report(object):
+    """Remembers how long every phase took and whether it succeeded"""
+
+    def __init__(self):
+        self.start = time.time()
+        self.phases = list()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.time()
+        ok = False
+        try:
+            yield
+            ok = True
+        finally:
+            self.phases.append((name, time.time() - start, ok))
+
+    def format(self):
+        lines = ['{:<16} {:>8.1f}s {}'.format(name, seconds, 'ok' if ok else 'failed')
+                 for name, seconds, ok in self.phases]
+        lines.append('{:<16} {:>8.1f}s'.format('total', time.time() - self.start))
+        return '\n'.join(lines)
+
+
+class ReplicaBootstrap(object):
+
+    def __init__(self, data_dir, connstring, env_dir, threshold_megabytes=None, threshold_percentage=None,
+                 pool_size=None, connect=psycopg2_connect, run=run_command):
+        self.data_dir = data_dir
+        self.connstring = connstring
+        self.env_dir = env_dir
+        self.threshold_megabytes = threshold_megabytes
+        self.threshold_percentage = threshold_percentage
+        self.pool_size = pool_size or max(MIN_POOL_SIZE, multiprocessing.cpu_count())
+        self.connect = connect
+        self.run = run
+        self.report = Report()
+
+    def wal_e(self, *args):
+        return ['envdir', self.env_dir, 'wal-e', '--aws-instance-profile'] + list(args)
+
+    def wal_since(self, lsn):
+        """The number of bytes of WAL the master has written since the location"""
+
+        connection = self.connect(self.connstring)
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT pg_xlog_location_diff(pg_current_xlog_location(), %s)', (lsn,))
+                return int(cursor.fetchone()[0])
+        finally:
+            connection.close()
+
+    def choose_backup(self):
+        """Returns the backup to restore, None if streaming from the master will be faster"""
+
+        code, output = self.run(self.wal_e('backup-list', '--detail', 'LATEST'))
+        if code != 0:
+            logging.warning('wal-e backup-list exited with code {}'.format(code))
+            return None
+        backups = parse_backup_list(output)
+        if not backups:
+            logging.info('There is no backup to restore')
+            return None
+
+        backup = backups[-1]
+        size = int(backup['expanded_size_bytes']) if backup.get('expanded_size_bytes') else None
+        threshold = wal_threshold(size, self.threshold_megabytes, self.threshold_percentage)
+        try:
+            wal = self.wal_since(backup_start_lsn(backup))
+        except Exception as e:
+            # # Without the master we cannot stream either, the backup is our best bet
+            logging.warning('Could not find out how much WAL was written since the backup: {}'.format(e))
+            return backup
+
+        logging.info('{} MB of WAL was written since {}'.format(wal // 2 ** 20, backup['name']))
+        if threshold is not None and wal > threshold:
+            logging.info('Replaying more than {} MB of WAL is slower than streaming from the master'.format(
+                threshold // 2 ** 20))
+            return None
+        return backup
+
+    def fetch_backup(self, backup):
+        code, _ = self.run(self.wal_e('backup-fetch', '--pool-size', str(self.pool_size), self.data_dir,
+                                      backup['name']))
+        if code != 0:
+            raise Exception('wal-e backup-fetch exited with code {}'.format(code))
+
+    def basebackup(self):
+        code, _ = self.run(['pg_basebackup', '--pgdata', self.data_dir, '--xlog-method', 'stream',
+                            '--dbname', self.connstring])
+        if code != 0:
+            raise Exception('pg_basebackup exited with code {}'.format(code))
+
+    def clean_data_dir(self):
+        """Removes whatever a failed attempt left behind, pg_basebackup wants an empty directory"""
+
+        if os.path.isdir(self.data_dir):
+            for name in os.listdir(self.data_dir):
+                path = os.path.join(self.data_dir, name)
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path)
+                else:
+                    os.unlink(path)
+
+    def bootstrap(self):
+        """Returns True if the data directory was created"""
+
+        backup = None
+        if self.env_dir and os.path.isdir(self.env_dir):
+            with self.report.phase('choose backup'):
+                backup = self.choose_backup()
+
+        if backup is not None:
+            logging.info('Restoring {} with {} workers'.format(backup['name'], self.pool_size))
+            try:
+                with self.report.phase('backup-fetch'):
+                    self.fetch_backup(backup)
+                return True
+            except Exception as e:
+                logging.error('Restoring the backup failed, streaming from the master instead: {}'.format(e))
+                self.clean_data_dir()
+
+        try:
+            with self.report.phase('pg_basebackup'):
+                self.basebackup()
+            return True
+        except Exception as e:
+            logging.error(e)
+            return False
+
+
+def main():
+    logging.basicConfig(format='%(asctime)s bootstrap %(levelname)s: %(message)s', level=logging.INFO)
+    if len(sys.argv) < 3:
+        logging.error('Usage: {} [scope role] data_dir connstring'.format(sys.argv[0]))
+        return 2
+
+    bootstrap = ReplicaBootstrap(sys.argv[-2], sys.argv[-1], os.environ.get('WALE_ENV_DIR'),
+                                 os.environ.get('WALE_BACKUP_THRESHOLD_MEGABYTES'),
+                                 os.environ.get('WALE_BACKUP_THRESHOLD_PERCENTAGE'),
+                                 int(os.environ.get('WALE_FETCH_CONCURRENCY') or 0))
+    ok = bootstrap.bootstrap()
+    # # The replay of the WAL since the backup happens when Postgres starts, with the prefetching restore_command
+    logging.info('Time spent per phase:\n' + bootstrap.report.format())
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
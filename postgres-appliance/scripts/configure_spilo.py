@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Writes the configuration of Patroni, with Postgres tuned to the instance it runs on
+
+The number of CPUs, the memory and whether the disk of the data directory is an SSD are detected, the memory,
+checkpoint and WAL settings of Postgres are derived from those. What is detected can be overridden with CPU_COUNT,
+MEMORY_MB and DISK_TYPE (ssd or hdd), any parameter of Postgres with PGPARAM_<NAME>, e.g. PGPARAM_SHARED_BUFFERS=2GB.
+The configuration is checked before it is written, so Patroni does not start with one Postgres would refuse."""
+
+import argparse
+import logging
+import os
+import re
+import sys
+import urllib.request
+
+import yaml
+
+PGHOME = os.environ.get('PGHOME', '/home/postgres')
+
+PG_PORT = 5432
+API_PORT = 8008
+METADATA_URL = 'http://169.254.169.254/latest/meta-data/'
+METADATA_TIMEOUT = 5
+
+MEMINFO = '/proc/meminfo'
+CGROUP_MEMORY_LIMIT = '/sys/fs/cgroup/memory/memory.limit_in_bytes'
+SYS_DEV_BLOCK = '/sys/dev/block'
+
+# # A prefix of its own, the PG_ variables of whatever else runs in the container do not end up in postgresql.conf
+PARAMETER_PREFIX = 'PGPARAM_'
+DISK_TYPES = ['ssd', 'hdd']
+
+# # Postgres defaults to 100 connections, we assume every one of them may use a few times work_mem
+MAX_CONNECTIONS = 100
+SORTS_PER_CONNECTION = 3
+MAX_SHARED_BUFFERS = 8192
+MAX_MAINTENANCE_WORK_MEM = 2048
+WAL_SEGMENT_MB = 16
+
+size_re = re.compile(r'^(\d+)\s*(kB|MB|GB|TB)?$')
+SIZE_UNITS = {'kB': 1.0 / 1024, 'MB': 1, 'GB': 1024, 'TB': 1024 * 1024}
+MEMORY_PARAMETERS = ['shared_buffers', 'effective_cache_size', 'work_mem', 'maintenance_work_mem', 'wal_buffers']
+
+
+def format_size(mb):
+    """
+    >>> format_size(2048), format_size(1536)
+    ('2GB', '1536MB')
+    """
+    return '{}GB'.format(mb // 1024) if mb % 1024 == 0 else '{}MB'.format(mb)
+
+
+def parse_size(value):
+    """Returns the number of megabytes of a memory setting, without a unit Postgres would read it as pages
+
+    >>> parse_size('2GB'), parse_size('512kB')
+    (2048, 0.5)
+    """
+    match = size_re.match(str(value).strip())
+    if not match or not match.group(2):
+        raise Exception('{!r} is not a size, use a unit like MB or GB'.format(value))
+    return int(match.group(1)) * SIZE_UNITS[match.group(2)]
+
+
+def parse_version(version):
+    """
+    >>> parse_version('9.4') < (9, 5) <= parse_version('10')
+    True
+    """
+    return tuple(int(v) for v in str(version).split('.'))
+
+
+def detect_memory(meminfo=MEMINFO, cgroup_limit=CGROUP_MEMORY_LIMIT):
+    """The memory of the instance in megabytes, or the limit of our container if that is lower"""
+
+    memory = None
+    with open(meminfo) as f:
+        for line in f:
+            if line.startswith('MemTotal:'):
+                memory = int(line.split()[1]) // 1024
+    try:
+        with open(cgroup_limit) as f:
+            # # Without a limit this is a huge number
+            memory = min(memory, int(f.read()) // 1024 // 1024)
+    except (IOError, OSError, ValueError):
+        pass
+    return memory
+
+
+def detect_rotational(path, sys_dev_block=SYS_DEV_BLOCK):
+    """Whether the path is on a spinning disk, None if we cannot tell"""
+
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    dev = os.stat(path).st_dev
+    device = os.path.join(sys_dev_block, '{}:{}'.format(os.major(dev), os.minor(dev)))
+
+    # # A partition has no queue of its own, it is that of the disk it is on
+    for queue in (os.path.join(device, 'queue'), os.path.join(device, '..', 'queue')):
+        try:
+            with open(os.path.join(queue, 'rotational')) as f:
+                return f.read().strip() == '1'
+        except (IOError, OSError):
+            pass
+    return None
+
+
+def detect_resources(environ, data_dir):
+    cpus = int(environ.get('CPU_COUNT') or os.cpu_count() or 1)
+    memory_mb = int(environ.get('MEMORY_MB') or detect_memory())
+    disk = environ.get('DISK_TYPE')
+    if not disk:
+        disk = 'hdd' if detect_rotational(data_dir) else 'ssd'
+    if disk not in DISK_TYPES:
+        raise Exception('DISK_TYPE must be one of {}, not {!r}'.format(', '.join(DISK_TYPES), disk))
+    return {'cpus': cpus, 'memory_mb': memory_mb, 'disk': disk}
+
+
+def tune(cpus, memory_mb, disk, pg_version, max_connections=MAX_CONNECTIONS):
+    """The parameters of Postgres which depend on the resources of the instance
+
+    >>> p = tune(2, 8192, 'ssd', '9.4')
+    >>> p['shared_buffers'], p['effective_cache_size'], p['work_mem'], p['checkpoint_segments']
+    ('2GB', '6GB', '20MB', 32)
+    """
+    shared_buffers = min(memory_mb // 4, MAX_SHARED_BUFFERS)
+    parameters = {
+        'shared_buffers': format_size(shared_buffers),
+        'effective_cache_size': format_size(memory_mb * 3 // 4),
+        'work_mem': format_size(max((memory_mb - shared_buffers) // (max_connections * SORTS_PER_CONNECTION), 1)),
+        'maintenance_work_mem': format_size(min(max(memory_mb // 16, 16), MAX_MAINTENANCE_WORK_MEM)),
+        'max_worker_processes': max(8, cpus),
+        'checkpoint_completion_target': 0.9,
+        'random_page_cost': 1.1 if disk == 'ssd' else 4,
+        'effective_io_concurrency': 200 if disk == 'ssd' else 2,
+    }
+    if shared_buffers >= 512:
+        parameters['wal_buffers'] = '16MB'
+
+    # # More memory means more gets written between checkpoints, and we keep the WAL of a checkpoint for replicas
+    checkpoint_segments = min(max(memory_mb // 1024 * 4, 8), 64)
+    if parse_version(pg_version) < (9, 5):
+        parameters['checkpoint_segments'] = checkpoint_segments
+    else:
+        max_wal_size = checkpoint_segments * 3 * WAL_SEGMENT_MB
+        parameters.update(max_wal_size=format_size(max_wal_size), min_wal_size=format_size(max_wal_size // 4))
+    parameters['wal_keep_segments'] = checkpoint_segments
+    return parameters
+
+
+def parameter_overrides(environ):
+    """
+    >>> parameter_overrides({'PGPARAM_SHARED_BUFFERS': '2GB', 'PG_MAJOR': '9.4', 'PGDATA': '/data'})
+    {'shared_buffers': '2GB'}
+    """
+    return {name[len(PARAMETER_PREFIX):].lower(): value for name, value in environ.items()
+            if name.startswith(PARAMETER_PREFIX) and len(name) > len(PARAMETER_PREFIX)}
+
+
+def dcs_config(environ):
+    """The configuration of the distributed configuration store, from the environment"""
+
+    scope = environ['SCOPE']
+    if environ.get('ZOOKEEPER_HOSTS') or environ.get('EXHIBITOR_HOSTS') and environ.get('EXHIBITOR_PORT'):
+        zookeeper = {'scope': scope, 'session_timeout': 30, 'reconnect_timeout': 10}
+        if environ.get('ZOOKEEPER_HOSTS'):
+            zookeeper['hosts'] = yaml.safe_load(environ['ZOOKEEPER_HOSTS'])
+        if environ.get('EXHIBITOR_HOSTS') and environ.get('EXHIBITOR_PORT'):
+            zookeeper['exhibitor'] = {'poll_interval': 300, 'port': int(environ['EXHIBITOR_PORT']),
+                                      'hosts': yaml.safe_load(environ['EXHIBITOR_HOSTS'])}
+        return {'zookeeper': zookeeper}
+    if environ.get('ETCD_HOST'):
+        return {'etcd': {'scope': scope, 'ttl': 30, 'host': environ['ETCD_HOST']}}
+    if environ.get('ETCD_DISCOVERY_DOMAIN'):
+        return {'etcd': {'scope': scope, 'ttl': 30, 'discovery_srv': environ['ETCD_DISCOVERY_DOMAIN']}}
+    raise Exception('Can not find suitable distributed configuration store.')
+
+
+def build_config(environ, resources, private_ip):
+    env_dir = environ['WALE_ENV_DIR']
+    wal_e = 'envdir {} wal-e --aws-instance-profile'.format(env_dir)
+    pghome = environ.get('PGHOME', PGHOME)
+
+    parameters = {
+        'archive_mode': 'on',
+        'wal_level': 'hot_standby',
+        'archive_command': '{} wal-push "%p" -p {}'.format(wal_e, environ.get('WALE_PUSH_CONCURRENCY', 8)),
+        'max_wal_senders': 5,
+        'archive_timeout': '1800s',
+        'max_replication_slots': 5,
+        'hot_standby': 'on',
+        'ssl': 'on',
+        'ssl_cert_file': os.path.join(pghome, 'dummy.crt'),
+        'ssl_key_file': os.path.join(pghome, 'dummy.key'),
+        'wal_log_hints': 'on',
+    }
+    overrides = parameter_overrides(environ)
+    parameters.update(tune(resources['cpus'], resources['memory_mb'], resources['disk'], environ['PGVERSION'],
+                           int(overrides.get('max_connections', MAX_CONNECTIONS))))
+    parameters.update(overrides)
+
+    config = {
+        'ttl': 30,
+        'loop_wait': 10,
+        'scope': environ['SCOPE'],
+        'restapi': {'listen': '0.0.0.0:{}'.format(API_PORT), 'connect_address': '{}:{}'.format(private_ip, API_PORT)},
+        'postgresql': {
+            'name': 'postgresql_{}'.format(environ.get('HOSTNAME', '')),
+            'scope': environ['SCOPE'],
+            'listen': '0.0.0.0:{}'.format(PG_PORT),
+            'connect_address': '{}:{}'.format(private_ip, PG_PORT),
+            'data_dir': environ['PGDATA'],
+            'pg_hba': ['hostssl all all 0.0.0.0/0 md5', 'host    all all 0.0.0.0/0 md5'],
+            'replication': {'username': 'standby', 'password': 'standby', 'network': '0.0.0.0/0'},
+            'superuser': {'password': 'zalando'},
+            'admin': {'username': 'admin', 'password': 'admin'},
+            'wal_e': {'env_dir': env_dir, 'threshold_megabytes': int(environ['WALE_BACKUP_THRESHOLD_MEGABYTES']),
+                      'threshold_backup_size_percentage': int(environ['WALE_BACKUP_THRESHOLD_PERCENTAGE'])},
+            'restore': '/scripts/bootstrap_replica.py',
+            'callbacks': {'on_start': 'patroni/patroni/scripts/aws.py', 'on_stop': 'patroni/patroni/scripts/aws.py',
+                          'on_restart': 'patroni/patroni/scripts/aws.py',
+                          'on_role_change': '/scripts/on_role_change.py'},
+            'pg_rewind': {'username': 'postgres', 'password': 'zalando'},
+            'parameters': parameters,
+            'recovery_conf': {
+                'restore_command': '{} wal-fetch "%f" "%p" -p {}'.format(wal_e, environ.get('WALE_PREFETCH', 8))},
+        },
+    }
+    config.update(dcs_config(environ))
+    return config
+
+
+def validate(config, memory_mb):
+    """Raises an exception if Patroni or Postgres would not start with the configuration"""
+
+    if not any(dcs in config for dcs in ('etcd', 'zookeeper')):
+        raise Exception('No distributed configuration store is configured')
+    for key in ('scope', 'restapi', 'postgresql'):
+        if not config.get(key):
+            raise Exception('{} is missing from the configuration'.format(key))
+    for key in ('data_dir', 'listen', 'connect_address', 'parameters'):
+        if not config['postgresql'].get(key):
+            raise Exception('postgresql.{} is missing from the configuration'.format(key))
+    for key in ('restapi', 'postgresql'):
+        # # Without the private ip of the instance the others can not reach us
+        host, _, port = str(config[key].get('connect_address', '')).rpartition(':')
+        if not host or not port.isdigit():
+            raise Exception('{}.connect_address must be host:port, not {!r}'.format(key,
+                                                                                    config[key].get('connect_address')))
+
+    parameters = config['postgresql']['parameters']
+    sizes = {name: parse_size(parameters[name]) for name in MEMORY_PARAMETERS if name in parameters}
+    if sizes.get('shared_buffers', 0) >= memory_mb:
+        raise Exception('shared_buffers of {} does not fit in {} MB of memory'.format(parameters['shared_buffers'],
+                                                                                   memory_mb))
+    for name in ('max_connections', 'max_worker_processes', 'max_wal_senders', 'max_replication_slots'):
+        if name in parameters and not str(parameters[name]).isdigit():
+            raise Exception('{} must be a number, not {!r}'.format(name, parameters[name]))
+
+
+def instance_metadata(path):
+    try:
+        return urllib.request.urlopen(METADATA_URL + path, timeout=METADATA_TIMEOUT).read().decode('utf-8')
+    except Exception as e:
+        logging.warning('Could not get {} from the instance metadata: {}'.format(path, e))
+        return ''
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('output', nargs='?', default='postgres.yml', help='The file to write the configuration to')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s configure %(levelname)s: %(message)s', level=logging.INFO)
+
+    environ = dict(os.environ)
+    try:
+        resources = detect_resources(environ, environ['PGDATA'])
+        logging.info('Tuning Postgres for {cpus} CPUs, {memory_mb} MB of memory and an {disk}'.format(**resources))
+        config = build_config(environ, resources, instance_metadata('local-ipv4'))
+
+        # # What Patroni reads is what we check
+        text = yaml.safe_dump(config, default_flow_style=False)
+        validate(yaml.safe_load(text), resources['memory_mb'])
+    except Exception as e:
+        logging.error('Not writing {}: {}'.format(args.output, e))
+        return 1
+
+    tmp = args.output + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(text)
+    os.rename(tmp, args.output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
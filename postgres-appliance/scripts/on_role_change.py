@@ -0,0 +1,19 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""The on_role_change callback of Patroni: runs the callback of Patroni for AWS, and wakes up the backup scheduler"""
+
+import subprocess
+import sys
+
+from backup_scheduler import notify
+
+AWS_CALLBACK = 'patroni/patroni/scripts/aws.py'
+
+
+def main():
+    notify()
+    return subprocess.call([AWS_CALLBACK] + sys.argv[1:])
+
+
+if __name__ == '__main__':
+    sys.exit(main())
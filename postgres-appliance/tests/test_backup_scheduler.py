@@ -0,0 +1,225 @@
+import time
+
+import pytest
+
+import backup_scheduler
+from backup_scheduler import BackupScheduler
+
+HEADER = 'name\tlast_modified\texpanded_size_bytes\twal_segment_backup_start\twal_segment_offset_backup_start\n'
+LATEST = HEADER + 'base_000000010000000000000002_00000040\t{}\t104857600\t000000010000000000000002\t00000040\n'
+MB = 1024 * 1024
+
+
+class FakeCursor(object):
+
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, query, params=None):
+        if self.db.down or self.db.fail_wal and 'pg_xlog_location_diff' in query:
+            raise Exception('server closed the connection unexpectedly')
+        self.db.queries.append((query, params))
+        self.query = query
+
+    def fetchone(self):
+        if 'pg_xlog_location_diff' in self.query:
+            return (self.db.wal,)
+        if 'pg_current_xlog_location' in self.query:
+            return (self.db.lsn, self.db.size)
+        return (self.db.in_recovery,)
+
+
+class FakeConnection(object):
+
+    def __init__(self):
+        self.in_recovery = False
+        self.down = False
+        self.fail_wal = False
+        # # The WAL written since the last backup, and the location and size of the database when backing up
+        self.wal = 0
+        self.lsn = '0/3000000'
+        self.size = 100 * MB
+        self.queries = list()
+        self.connections = 0
+
+    def __call__(self):
+        self.connections += 1
+        return self
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def close(self):
+        pass
+
+
+class FakeWalE(object):
+    """Records the wal-e commands, backup-list answers with the backups that were pushed"""
+
+    def __init__(self, last_backup=None):
+        self.commands = list()
+        self.last_backup = last_backup
+        self.fail = False
+        self.fail_list = False
+
+    def __call__(self, cmd):
+        command = cmd[cmd.index('wal-e') + 2]
+        self.commands.append(command)
+        if command == 'backup-list':
+            if self.fail_list:
+                return 1, ''
+            if self.last_backup is None:
+                return 0, HEADER
+            return 0, LATEST.format(time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(self.last_backup)))
+        if command == 'backup-push':
+            if self.fail:
+                return 1, ''
+            self.last_backup = int(time.time())
+        return 0, ''
+
+
+@pytest.fixture
+def scheduler(tmp_path):
+    def create(**kwargs):
+        return BackupScheduler('/env', '/data', state_file=str(tmp_path / 'state.json'), connect=FakeConnection(),
+                               run=FakeWalE(), **kwargs)
+    return create
+
+
+def test_replica_does_nothing(scheduler):
+    s = scheduler()
+    s.connect.in_recovery = True
+
+    assert s.step() == backup_scheduler.ROLE_CHECK_INTERVAL
+    assert s.step() == backup_scheduler.ROLE_CHECK_INTERVAL
+    assert s.run.commands == []
+    # # A single connection is used for all the checks
+    assert s.connect.connections == 1 and len(s.connect.queries) == 2
+
+
+def test_first_backup_and_schedule(scheduler):
+    s = scheduler()
+
+    assert s.step() == backup_scheduler.WAL_CHECK_INTERVAL
+    # # Old backups are only deleted once the new one is there
+    assert s.run.commands == ['backup-list', 'backup-push', 'delete']
+    assert s.state['start_lsn'] == '0/3000000' and s.state['size'] == 100 * MB
+
+    # # Until the next backup is due, S3 is left alone
+    s.step()
+    assert s.run.commands == ['backup-list', 'backup-push', 'delete']
+
+
+def test_cached_last_backup(scheduler):
+    s = scheduler()
+    s.run.last_backup = int(time.time()) - 600
+    s.step()
+    assert s.run.commands == ['backup-list']
+
+    # # A restarted scheduler remembers the last backup, and does not ask S3 about it
+    s = scheduler()
+    s.step()
+    assert s.run.commands == []
+
+
+def test_promotion(scheduler):
+    s = scheduler()
+    s.connect.in_recovery = True
+    s.state['last_backup'] = time.time() - 7200
+    s.step()
+
+    # # After a promotion, S3 is asked once whether the previous leader took a backup meanwhile
+    s.connect.in_recovery = False
+    s.run.last_backup = int(time.time()) - 60
+    s.step()
+    assert s.run.commands == ['backup-list']
+    s.step()
+    assert s.run.commands == ['backup-list']
+
+
+def test_failed_backup_is_retried(scheduler):
+    s = scheduler()
+    s.run.fail = True
+    assert s.step() == pytest.approx(backup_scheduler.RETRY_DELAY, abs=1)
+    assert s.run.commands == ['backup-list', 'backup-push']
+
+    s.run.fail = False
+    s.state['failed'] -= backup_scheduler.RETRY_DELAY
+    s.step()
+    assert s.run.commands == ['backup-list', 'backup-push', 'backup-push', 'delete']
+
+
+def test_backup_list_fails(scheduler):
+    s = scheduler()
+    s.run.last_backup = int(time.time()) - 60
+    s.run.fail_list = True
+    assert [s.step() for _ in range(5)] == [60, 120, 240, 480, 600]
+    assert 'failed' not in s.state
+
+    # # Once S3 answers again, we learn there is no need for a backup yet
+    s.run.fail_list = False
+    assert s.step() == backup_scheduler.WAL_CHECK_INTERVAL
+    assert s.run.commands == ['backup-list'] * 6
+    assert s.error_delay == backup_scheduler.RETRY_DELAY
+
+
+def test_wal_query_fails(scheduler):
+    s = scheduler(threshold_megabytes=1024, threshold_percentage=30)
+    s.run.last_backup = int(time.time()) - 60
+    s.step()
+
+    # # Not knowing how much WAL was written is no reason to push a backup
+    s.connect.fail_wal = True
+    assert s.step() == backup_scheduler.RETRY_DELAY
+    s.connect.fail_wal = False
+    s.step()
+    assert s.run.commands == ['backup-list']
+
+
+def test_postgres_down(scheduler):
+    s = scheduler()
+    s.connect.down = True
+    assert [s.step() for _ in range(3)] == [1, 2, 4]
+
+    s.connect.down = False
+    s.step()
+    assert s.connect.connections == 4
+
+
+def test_wal_threshold(scheduler):
+    s = scheduler(threshold_megabytes=1024, threshold_percentage=30)
+    s.run.last_backup = int(time.time()) - 60
+    s.connect.wal = 20 * MB
+    s.step()
+    assert s.run.commands == ['backup-list']
+    # # The WAL is measured from where the last backup started
+    assert s.connect.queries[-1][1] == ('0/2000028',)
+
+    # # 30% of the 100 MB of the last backup has been written, a backup is due long before the schedule says so
+    s.connect.wal = 31 * MB
+    s.step()
+    assert s.run.commands == ['backup-list', 'backup-push', 'delete']
+
+
+def test_idle_cluster_skips_scheduled_backup(scheduler):
+    s = scheduler(threshold_megabytes=1024, threshold_percentage=30)
+    s.run.last_backup = int(time.time()) - 7200
+    s.connect.wal = MB
+    s.step()
+    assert s.run.commands == ['backup-list']
+
+    s.connect.wal = 5 * MB
+    s.step()
+    assert s.run.commands == ['backup-list', 'backup-push', 'delete']
+
+
+def test_backup_hour(monkeypatch):
+    monkeypatch.setattr('sys.argv', ['backup_scheduler.py', '--backup-hour', '25'])
+    with pytest.raises(SystemExit):
+        backup_scheduler.main()
@@ -0,0 +1,132 @@
+import pytest
+
+import bootstrap_replica
+
+from bootstrap_replica import ReplicaBootstrap
+
+HEADER = 'name\tlast_modified\texpanded_size_bytes\twal_segment_backup_start\twal_segment_offset_backup_start\n'
+LATEST = HEADER + 'base_000000010000000000000002_00000040\t2015-10-27T10:00:00.000Z\t104857600\t' \
+    '000000010000000000000002\t00000040\n'
+MB = 1024 * 1024
+
+
+class FakeMaster(object):
+
+    def __init__(self, wal=0):
+        self.wal = wal
+        self.down = False
+        self.queries = list()
+
+    def __call__(self, connstring):
+        if self.down:
+            raise Exception('could not connect to server')
+        return self
+
+    def cursor(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, query, params):
+        self.queries.append((query, params))
+
+    def fetchone(self):
+        return (self.wal,)
+
+    def close(self):
+        pass
+
+
+class FakeRun(object):
+    """Records the commands, the ones in fail exit with 1"""
+
+    def __init__(self, backups=LATEST):
+        self.backups = backups
+        self.commands = list()
+        self.fail = set()
+
+    def __call__(self, cmd):
+        command = cmd[cmd.index('wal-e') + 2] if 'wal-e' in cmd else cmd[0]
+        self.commands.append(cmd)
+        if command in self.fail:
+            return 1, ''
+        if command == 'backup-list':
+            return 0, self.backups
+        if command == 'backup-fetch':
+            with open(cmd[-2] + '/PG_VERSION', 'w') as f:
+                f.write('9.4\n')
+        return 0, ''
+
+    def names(self):
+        return [cmd[cmd.index('wal-e') + 2] if 'wal-e' in cmd else cmd[0] for cmd in self.commands]
+
+
+@pytest.fixture
+def bootstrap(tmp_path):
+    env_dir = tmp_path / 'env'
+    env_dir.mkdir()
+    data_dir = tmp_path / 'data'
+    data_dir.mkdir()
+
+    def create(wal=0, **kwargs):
+        return ReplicaBootstrap(str(data_dir), 'host=10.0.0.1 port=5432', str(env_dir), 1024, 30, pool_size=8,
+                                connect=FakeMaster(wal), run=FakeRun(**kwargs))
+    return create
+
+
+def test_restores_backup(bootstrap):
+    b = bootstrap(wal=10 * MB)
+    assert b.bootstrap()
+    assert b.run.names() == ['backup-list', 'backup-fetch']
+    assert b.run.commands[-1][-4:] == ['--pool-size', '8', b.data_dir, 'base_000000010000000000000002_00000040']
+    assert b.connect.queries[0][1] == ('0/2000028',)
+    assert [(name, ok) for name, _, ok in b.report.phases] == [('choose backup', True), ('backup-fetch', True)]
+
+
+def test_too_much_wal_streams(bootstrap):
+    # # 30% of the 100 MB backup
+    b = bootstrap(wal=31 * MB)
+    assert b.bootstrap()
+    assert b.run.names() == ['backup-list', 'pg_basebackup']
+
+
+def test_no_backup_streams(bootstrap):
+    b = bootstrap(backups=HEADER)
+    assert b.bootstrap()
+    assert b.run.names() == ['backup-list', 'pg_basebackup']
+
+
+def test_master_down_restores_backup(bootstrap):
+    b = bootstrap()
+    b.connect.down = True
+    assert b.bootstrap()
+    assert b.run.names() == ['backup-list', 'backup-fetch']
+
+
+def test_failed_fetch_falls_back(bootstrap, tmp_path):
+    b = bootstrap()
+    b.run.fail.add('backup-fetch')
+    (tmp_path / 'data' / 'base').mkdir()
+    assert b.bootstrap()
+    assert b.run.names() == ['backup-list', 'backup-fetch', 'pg_basebackup']
+    # # pg_basebackup gets an empty directory
+    assert list((tmp_path / 'data').iterdir()) == []
+    assert [(name, ok) for name, _, ok in b.report.phases][1:] == [('backup-fetch', False), ('pg_basebackup', True)]
+
+    b.run.fail.add('pg_basebackup')
+    assert not b.bootstrap()
+
+
+def test_empty_concurrency(monkeypatch):
+    monkeypatch.setenv('WALE_FETCH_CONCURRENCY', '')
+    monkeypatch.setattr('sys.argv', ['bootstrap_replica.py', '/data', 'host=10.0.0.1'])
+    created = list()
+    monkeypatch.setattr(bootstrap_replica.ReplicaBootstrap, 'bootstrap', lambda self: created.append(self) or True)
+
+    # # An empty variable means the default, like an unset one
+    assert bootstrap_replica.main() == 0
+    assert created[0].pool_size >= bootstrap_replica.MIN_POOL_SIZE
@@ -0,0 +1,141 @@
+import os
+
+import pytest
+import yaml
+
+import configure_spilo
+from configure_spilo import build_config, detect_memory, detect_rotational, parse_size, tune, validate
+
+# # cpus, memory in MB and disk of the instances in docs/admin-guide/sizing.md
+PROFILES = [
+    ('t2.micro', 1, 1024, 'ssd'),
+    ('m4.large', 2, 8192, 'ssd'),
+    ('r3.2xlarge', 8, 62464, 'ssd'),
+    ('d2.8xlarge', 36, 249856, 'hdd'),
+]
+
+ENVIRON = {
+    'SCOPE': 'test',
+    'HOSTNAME': 'spilo-1',
+    'PGHOME': '/home/postgres',
+    'PGDATA': '/home/postgres/pgdata/data',
+    'PGVERSION': '9.4',
+    'WALE_ENV_DIR': '/home/postgres/etc/wal-e.d/env',
+    'WALE_BACKUP_THRESHOLD_MEGABYTES': '1024',
+    'WALE_BACKUP_THRESHOLD_PERCENTAGE': '30',
+    'ETCD_DISCOVERY_DOMAIN': 'postgres.acid.example.com',
+}
+
+
+def memory(parameters, name):
+    return parse_size(parameters[name])
+
+
+@pytest.mark.parametrize('name,cpus,memory_mb,disk', PROFILES)
+def test_profiles(name, cpus, memory_mb, disk):
+    parameters = tune(cpus, memory_mb, disk, '9.4')
+
+    assert memory(parameters, 'shared_buffers') <= min(memory_mb / 4, 8192)
+    assert memory(parameters, 'shared_buffers') < memory(parameters, 'effective_cache_size') < memory_mb
+    # # All connections sorting at once still fit next to the shared buffers
+    assert memory(parameters, 'shared_buffers') + memory(parameters, 'work_mem') * 300 <= memory_mb
+    assert 16 <= memory(parameters, 'maintenance_work_mem') <= 2048
+    assert parameters['max_worker_processes'] >= cpus
+    assert 8 <= parameters['checkpoint_segments'] <= 64
+    assert parameters['random_page_cost'] == (1.1 if disk == 'ssd' else 4)
+
+    config = build_config(ENVIRON, {'cpus': cpus, 'memory_mb': memory_mb, 'disk': disk}, '10.0.0.1')
+    validate(yaml.safe_load(yaml.safe_dump(config)), memory_mb)
+
+
+def test_bigger_instances_get_more():
+    tuned = [tune(cpus, memory_mb, disk, '9.4') for _, cpus, memory_mb, disk in PROFILES]
+    for name in ('shared_buffers', 'effective_cache_size', 'work_mem', 'maintenance_work_mem'):
+        sizes = [memory(parameters, name) for parameters in tuned]
+        assert sizes == sorted(sizes), name
+    assert tuned[0]['shared_buffers'] == '256MB' and tuned[2]['shared_buffers'] == '8GB'
+
+
+def test_wal_size_since_95():
+    parameters = tune(2, 8192, 'ssd', '9.6')
+    assert 'checkpoint_segments' not in parameters
+    assert parameters['max_wal_size'] == '1536MB' and parameters['min_wal_size'] == '384MB'
+
+
+def test_overrides():
+    environ = dict(ENVIRON, PGPARAM_SHARED_BUFFERS='1GB', PGPARAM_MAX_CONNECTIONS='500', PGPARAM_ARCHIVE_TIMEOUT='60s',
+                   PG_MAJOR='9.4')
+    parameters = build_config(environ, {'cpus': 2, 'memory_mb': 8192, 'disk': 'ssd'}, '10.0.0.1')['postgresql'][
+        'parameters']
+    assert parameters['shared_buffers'] == '1GB' and parameters['archive_timeout'] == '60s'
+    # # work_mem is shared between the connections we are told about
+    assert parameters['work_mem'] == '4MB'
+    assert 'major' not in parameters
+
+
+def test_validation():
+    resources = {'cpus': 1, 'memory_mb': 1024, 'disk': 'ssd'}
+    with pytest.raises(Exception, match='does not fit'):
+        validate(build_config(dict(ENVIRON, PGPARAM_SHARED_BUFFERS='2GB'), resources, '10.0.0.1'), 1024)
+    with pytest.raises(Exception, match='not a size'):
+        validate(build_config(dict(ENVIRON, PGPARAM_WORK_MEM='lots'), resources, '10.0.0.1'), 1024)
+    with pytest.raises(Exception, match='distributed configuration store'):
+        build_config(dict(ENVIRON, ETCD_DISCOVERY_DOMAIN=''), resources, '10.0.0.1')
+    with pytest.raises(Exception, match='connect_address'):
+        validate(build_config(ENVIRON, resources, ''), 1024)
+
+
+def test_dcs():
+    environ = dict(ENVIRON, ZOOKEEPER_HOSTS='[zk1:2181, zk2:2181]', EXHIBITOR_HOSTS='[ex1]', EXHIBITOR_PORT='8181')
+    config = build_config(environ, {'cpus': 1, 'memory_mb': 1024, 'disk': 'ssd'}, '10.0.0.1')
+    assert 'etcd' not in config
+    assert config['zookeeper']['hosts'] == ['zk1:2181', 'zk2:2181']
+    assert config['zookeeper']['exhibitor'] == {'poll_interval': 300, 'port': 8181, 'hosts': ['ex1']}
+
+
+def test_detect_memory(tmp_path):
+    meminfo = tmp_path / 'meminfo'
+    meminfo.write_text('MemTotal:        8175440 kB\nMemFree:         1175440 kB\n')
+    limit = tmp_path / 'limit'
+    assert detect_memory(str(meminfo), str(limit)) == 7983
+
+    limit.write_text('{}\n'.format(2 * 1024 ** 3))
+    assert detect_memory(str(meminfo), str(limit)) == 2048
+
+
+def test_detect_rotational(tmp_path):
+    dev = os.stat(str(tmp_path)).st_dev
+    device = tmp_path / 'block' / '{}:{}'.format(os.major(dev), os.minor(dev))
+    assert detect_rotational(str(tmp_path / 'pgdata' / 'data'), str(tmp_path / 'block')) is None
+
+    (device / 'queue').mkdir(parents=True)
+    (device / 'queue' / 'rotational').write_text('1\n')
+    assert detect_rotational(str(tmp_path / 'pgdata' / 'data'), str(tmp_path / 'block'))
+
+
+def test_main(tmp_path, monkeypatch):
+    for name, value in ENVIRON.items():
+        monkeypatch.setenv(name, value)
+    monkeypatch.setenv('CPU_COUNT', '2')
+    monkeypatch.setenv('MEMORY_MB', '8192')
+    monkeypatch.setenv('DISK_TYPE', 'ssd')
+    monkeypatch.setattr(configure_spilo, 'instance_metadata', lambda path: '10.0.0.1')
+    output = tmp_path / 'postgres.yml'
+
+    monkeypatch.setattr('sys.argv', ['configure_spilo.py', str(output)])
+    assert configure_spilo.main() == 0
+    config = yaml.safe_load(output.read_text())
+    assert config['postgresql']['connect_address'] == '10.0.0.1:5432'
+    assert config['postgresql']['parameters']['shared_buffers'] == '2GB'
+
+    # # A configuration Postgres would refuse is not written
+    output.unlink()
+    monkeypatch.setenv('PGPARAM_SHARED_BUFFERS', '16GB')
+    assert configure_spilo.main() == 1
+    assert not output.exists()
+
+    # # Nor one without an address the others can reach
+    monkeypatch.delenv('PGPARAM_SHARED_BUFFERS')
+    monkeypatch.setattr(configure_spilo, 'instance_metadata', lambda path: '')
+    assert configure_spilo.main() == 1
+    assert not output.exists()
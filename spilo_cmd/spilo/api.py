@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""A Python api to find spilos and set up tunnels to them, for programs which would otherwise run the spilo command
+
+Nothing here uses the globals of the command line, a single process can discover spilos and open tunnels to many
+clusters, from several threads at once if it likes.
+
+    >>> from spilo.api import discover, open_tunnel
+    >>> spilos = discover('eu-west-1', ['cluster1'])           # doctest: +SKIP
+    >>> tunnel = open_tunnel('cluster1', region='eu-west-1')   # doctest: +SKIP
+    >>> tunnel.dsn                                             # doctest: +SKIP
+    'host=localhost port=20000'
+    >>> tunnel.close()                                         # doctest: +SKIP
+"""
+import collections
+
+from spilo.aws import DEFAULT_CONCURRENCY
+from spilo.cache import DEFAULT_TTL
+from spilo.spilo import PIUCONFIG, MultipleSpilos, find_tunnel, find_tunnels, get_spilos, get_spilos_in_regions, \
+    kill_tunnel, make_context, open_spilo_tunnel, update_spilo_info
+from spilo.ssh import READY_TIMEOUT
+
+__all__ = ['MultipleSpilos', 'Tunnel', 'discover', 'list_tunnels', 'open_tunnel']
+
+
+class Tunnel(collections.namedtuple('Tunnel', 'cluster, host, service, pid, pg_port, patroni_port, dsn, entry, '
+                                              'process')):
+    """A tunnel to a spilo, the entry is how the tunnel is registered and the process is set if we started ssh"""
+
+    def close(self):
+        kill_tunnel(self.entry)
+        if self.process is not None:
+            self.process.wait()
+
+
+def tunnel_from_entry(entry, process=None):
+    return Tunnel(cluster=entry.get('cluster'), host=entry.get('host'), service=entry.get('service') or None,
+                  pid=int(entry['pid']), pg_port=int(entry['pgport']), patroni_port=int(entry['patroniport']),
+                  dsn=entry['dsn'].strip('"'), entry=entry, process=process)
+
+
+def discover(region=None, clusters=None, regions=None, details=False, concurrency=DEFAULT_CONCURRENCY,
+             ttl=DEFAULT_TTL, refresh=False, match='regex'):
+    """Returns the spilos in the region, or in all the regions at once, with their instances if details is set"""
+
+    if regions:
+        spilos = get_spilos_in_regions(regions, clusters, concurrency=concurrency, ttl=ttl, refresh=refresh,
+                                       match=match)
+    else:
+        spilos = get_spilos(region, clusters, concurrency=concurrency, ttl=ttl, refresh=refresh, match=match)
+
+    if details:
+        spilos = update_spilo_info(spilos, concurrency=concurrency)
+    return spilos
+
+
+def open_tunnel(cluster, region=None, reuse=True, multiplex=False, port=5432, pg_service_file=None,
+                odd_config_file=PIUCONFIG, timeout=READY_TIMEOUT, concurrency=DEFAULT_CONCURRENCY, ttl=DEFAULT_TTL,
+                refresh=False, match='regex'):
+    """Returns a tunnel to the cluster, an existing one if reuse is set
+
+    The tunnel keeps running after we are gone, unless it is closed."""
+
+    if reuse:
+        entry = find_tunnel(cluster, usable=True)
+        if entry is not None:
+            return tunnel_from_entry(entry)
+
+    opts = {'cluster': cluster, 'region': region, 'multiplex': multiplex, 'port': port,
+            'pg_service_file': pg_service_file, 'odd_config_file': odd_config_file, 'tunnel_timeout': timeout,
+            'concurrency': concurrency, 'cache_ttl': ttl, 'refresh': refresh, 'match': match}
+
+    entry, process = open_spilo_tunnel(cluster, make_context(opts))
+    return tunnel_from_entry(entry, process)
+
+
+def list_tunnels(cluster=None, match='regex'):
+    """Returns the running tunnels, to the matching clusters only if a cluster is given"""
+
+    return [tunnel_from_entry(entry) for entry in find_tunnels(cluster, match)]
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import logging
+import random
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_CONCURRENCY = 10
+
+# # Retry settings used when AWS tells us to slow down
+MAX_RETRIES = 6
+BASE_DELAY = 0.5
+MAX_DELAY = 10
+
+THROTTLING_ERROR_CODES = ['Throttling', 'ThrottlingException', 'RequestLimitExceeded', 'RequestThrottled',
+                          'ServiceUnavailable', 'SlowDown']
+
+
+def is_throttling_error(e):
+    """Determines whether the exception was caused by AWS rate limiting us"""
+
+    if getattr(e, 'error_code', None) in THROTTLING_ERROR_CODES:
+        return True
+
+    return getattr(e, 'status', None) == 503
+
+
+def call_with_backoff(func, *args, **kwargs):
+    """Calls func, retrying with exponential backoff (and jitter) as long as AWS is throttling us"""
+
+    attempt = 0
+    while True:
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            if attempt >= MAX_RETRIES or not is_throttling_error(e):
+                raise
+
+            delay = min(MAX_DELAY, BASE_DELAY * 2 ** attempt) * random.uniform(0.5, 1)
+            logging.debug('Throttled by AWS ({}), retrying in {:.2f} seconds'.format(e, delay))
+            time.sleep(delay)
+            attempt += 1
+
+
+def parallel_map(func, items, concurrency=DEFAULT_CONCURRENCY):
+    """Applies func to every item using at most concurrency threads
+
+    The results are returned in the same order as the items, so the outcome is identical to a serial map"""
+
+    items = list(items)
+
+    if concurrency is None or concurrency <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+
+    with ThreadPoolExecutor(max_workers=min(concurrency, len(items))) as executor:
+        return list(executor.map(func, items))
+
+
+def parallel_imap(func, items, concurrency=DEFAULT_CONCURRENCY):
+    """Like parallel_map, but yields every result as soon as it and all the results before it are available"""
+
+    items = list(items)
+
+    if concurrency is None or concurrency <= 1 or len(items) <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    # # When we are closed before the end, map cancels the calls which have not started yet
+    with ThreadPoolExecutor(max_workers=min(concurrency, len(items))) as executor:
+        yield from executor.map(func, items)
+
+
+class ThreadLocalConnection(object):
+    """Lazily creates one connection per thread, as boto connections should not be shared between threads"""
+
+    def __init__(self, factory, *args, **kwargs):
+        self.factory = factory
+        self.args = args
+        self.kwargs = kwargs
+        self.local = threading.local()
+
+    def get(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = self.factory(*self.args, **self.kwargs)
+            self.local.connection = connection
+        return connection
+
+
+class SharedResult(object):
+    """Lazily calls func once, all threads asking for the result while it is being computed wait for it"""
+
+    def __init__(self, func, *args, **kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.lock = threading.Lock()
+        self.done = False
+        self.result = None
+
+    def get(self):
+        with self.lock:
+            if not self.done:
+                self.result = self.func(*self.args, **self.kwargs)
+                self.done = True
+        return self.result
+
+
+def get_cname_records(route53, zone_id):
+    """Returns (name, target) for every CNAME in the hosted zone, boto follows the pages of the listing for us"""
+
+    # # Getting a "DNSServerError: 400 Bad Request" when adding type='CNAME' to the get_all_rrsets call
+    rrsets = call_with_backoff(route53.get_all_rrsets, hosted_zone_id=zone_id)
+
+    return [(rr.name, target) for rr in rrsets if rr.type == 'CNAME' for target in rr.resource_records]
+
+
+def build_cname_index(route53_connections, concurrency=DEFAULT_CONCURRENCY):
+    """Builds a reverse index of the CNAME records of all hosted zones, mapping a dns name to its aliases"""
+
+    zones = call_with_backoff(route53_connections.get().get_zones)
+    zone_records = parallel_map(lambda zone: get_cname_records(route53_connections.get(), zone.id), zones,
+                                concurrency)
+
+    index = dict()
+    for records in zone_records:
+        for name, target in records:
+            aliases = index.setdefault(target, list())
+            alias = name[:-1] if name.endswith('.') else name
+            if alias not in aliases:
+                aliases.append(alias)
+
+    logging.debug('Indexed {} CNAME targets from {} hosted zones'.format(len(index), len(zones)))
+    return index
+
+
+# # EC2 accepts at most 200 values for a single filter
+MAX_FILTER_VALUES = 200
+
+
+def get_instances_by_stack(ec2, stack_ids):
+    """Fetches the instances of many stacks at once, instead of doing one EC2 call per stack"""
+
+    stack_ids = list(stack_ids)
+    instances = dict()
+
+    for i in range(0, len(stack_ids), MAX_FILTER_VALUES):
+        chunk = stack_ids[i:i + MAX_FILTER_VALUES]
+        for instance in call_with_backoff(ec2.get_only_instances,
+                                          filters={'tag:aws:cloudformation:stack-id': chunk}):
+            instances.setdefault(instance.tags.get('aws:cloudformation:stack-id'), list()).append(instance)
+
+    return instances
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import io
+import logging
+import time
+
+from spilo.health import psycopg2_connect
+
+PERCENTILES = [50, 90, 99]
+
+DEFAULT_CONNECTIONS = 10
+DEFAULT_QUERIES = 200
+DEFAULT_COPY_ROWS = 100000
+
+COPY_QUERY = "COPY (SELECT i, repeat('x', 100) FROM generate_series(1, {}) AS i) TO STDOUT"
+
+
+def percentiles(samples, ps=PERCENTILES):
+    """Returns the given percentiles (nearest rank) of the samples, in milliseconds
+
+    >>> percentiles([0.001 * i for i in range(1, 101)])
+    {'p50': 50.0, 'p90': 90.0, 'p99': 99.0}
+    >>> percentiles([])
+    {'p50': None, 'p90': None, 'p99': None}
+    """
+    samples = sorted(samples)
+    result = dict()
+    for p in ps:
+        if samples:
+            rank = max(0, -(-p * len(samples) // 100) - 1)
+            result['p{}'.format(p)] = round(samples[rank] * 1000, 3)
+        else:
+            result['p{}'.format(p)] = None
+    return result
+
+
+class CountingWriter(io.RawIOBase):
+    """A file to COPY into, which only counts the bytes it gets"""
+
+    def __init__(self):
+        self.size = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.size += len(data)
+        return len(data)
+
+
+def timed(func, *args):
+    start = time.time()
+    result = func(*args)
+    return time.time() - start, result
+
+
+def bench_connect(connect, parameters, count):
+    """Measures how long it takes to set up a new connection, including the authentication"""
+
+    samples = list()
+    for _ in range(count):
+        elapsed, connection = timed(lambda: connect(**parameters))
+        samples.append(elapsed)
+        connection.close()
+    return samples
+
+
+def bench_queries(connection, count):
+    """Measures the round trip of a query which costs the server next to nothing"""
+
+    samples = list()
+    with connection.cursor() as cursor:
+        for _ in range(count):
+            start = time.time()
+            cursor.execute('SELECT 1')
+            cursor.fetchone()
+            samples.append(time.time() - start)
+    return samples
+
+
+def bench_copy(connection, rows):
+    """Returns the number of bytes and the seconds it took to COPY them out of the server"""
+
+    writer = CountingWriter()
+    with connection.cursor() as cursor:
+        elapsed, _ = timed(cursor.copy_expert, COPY_QUERY.format(int(rows)), writer)
+    return writer.size, elapsed
+
+
+def run_benchmark(target, parameters, connect=psycopg2_connect, connections=DEFAULT_CONNECTIONS,
+                  queries=DEFAULT_QUERIES, copy_rows=DEFAULT_COPY_ROWS):
+    """Benchmarks a single target, returns the results as a flat dict"""
+
+    connection = connect(**parameters)
+    if connection is None:
+        raise Exception('Benchmarking needs psycopg2, please install it')
+
+    try:
+        logging.info('Benchmarking {}: {} queries and a COPY of {} rows'.format(target, queries, copy_rows))
+        query_samples = bench_queries(connection, queries)
+        copy_bytes, copy_seconds = bench_copy(connection, copy_rows) if copy_rows else (0, 0)
+    finally:
+        connection.close()
+
+    logging.info('Benchmarking {}: {} new connections'.format(target, connections))
+    connect_samples = bench_connect(connect, parameters, connections)
+
+    result = {'target': target}
+    result.update({'connect_' + k: v for k, v in percentiles(connect_samples).items()})
+    result.update({'query_' + k: v for k, v in percentiles(query_samples).items()})
+    result['copy_bytes'] = copy_bytes
+    result['copy_mb_s'] = round(copy_bytes / copy_seconds / 2 ** 20, 2) if copy_seconds else None
+    return result
+
+
+def overhead(tunnel, direct):
+    """Compares the results of the tunnel with those of a direct connection
+
+    >>> overhead({'query_p50': 1.5, 'copy_mb_s': 20.0}, {'query_p50': 0.5, 'copy_mb_s': 80.0})
+    {'target': 'overhead', 'query_p50': 1.0, 'copy_mb_s': -60.0}
+    """
+    result = {'target': 'overhead'}
+    for key, value in tunnel.items():
+        if key != 'target' and value is not None and direct.get(key) is not None:
+            result[key] = round(value - direct[key], 3)
+    return result
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import contextlib
+import copy
+import fcntl
+import json
+import logging
+import os
+import tempfile
+import time
+
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'spilo')
+DISCOVERY_CACHE = os.path.join(CACHE_DIR, 'discovery.json')
+CONFIG_CACHE = os.path.join(CACHE_DIR, 'config.json')
+STACKS_CACHE = os.path.join(CACHE_DIR, 'stacks.json')
+
+# # A file which was modified this recently may be modified again within the resolution of its mtime, we do not
+# # cache it, as we would not notice that change
+RACY_SECONDS = 2
+
+DEFAULT_TTL = 3600
+
+
+def read_json(filename, default=None):
+    try:
+        with open(filename, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return default
+    except (OSError, ValueError) as e:
+        logging.warning('Ignoring unreadable cache file {}: {}'.format(filename, e))
+        return default
+
+
+def write_json(filename, data):
+    """Writes the file atomically, so concurrent spilo processes never see a partially written file"""
+
+    directory = os.path.dirname(filename)
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, separators=(',', ':'))
+        os.replace(tmp, filename)
+    except:
+        os.unlink(tmp)
+        raise
+
+
+@contextlib.contextmanager
+def locked_json(filename, default):
+    """Holds an exclusive lock on the file, yields its contents which are written back if they were modified
+
+    Reading, modifying and writing back the file under the lock, concurrent spilo processes and threads never lose
+    each other's modifications"""
+
+    os.makedirs(os.path.dirname(filename), mode=0o700, exist_ok=True)
+
+    with open(filename + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            data = read_json(filename, default)
+            original = copy.deepcopy(data)
+            yield data
+            if data != original:
+                write_json(filename, data)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def load_spilos(region, ttl=DEFAULT_TTL, filename=None, selection=None):
+    """Returns the cached spilo records for the region, None if there are none or they have expired
+
+    A cache holding only the spilos of some selections is used for those selections, without a selection only a cache
+    holding all the spilos of the region is used"""
+
+    if not ttl:
+        return None
+
+    filename = filename or DISCOVERY_CACHE
+    entry = read_json(filename, dict()).get(region)
+    if entry is None:
+        return None
+
+    age = time.time() - entry.get('timestamp', 0)
+    if age > ttl:
+        logging.debug('Discovery cache for {} expired {:.0f} seconds ago'.format(region, age - ttl))
+        return None
+
+    if not entry.get('complete', True) and selection not in entry.get('selections', list()):
+        logging.debug('Discovery cache for {} does not hold the spilos of {}'.format(region, selection or 'all'))
+        return None
+
+    logging.debug('Using discovery cache for {} ({:.0f} seconds old)'.format(region, age))
+    return entry.get('spilos', list())
+
+
+def store_spilos(region, records, filename=None, complete=True):
+    filename = filename or DISCOVERY_CACHE
+    try:
+        with locked_json(filename, dict()) as cache:
+            cache[region] = {'timestamp': time.time(), 'spilos': records, 'complete': complete}
+    except OSError as e:
+        logging.warning('Could not write discovery cache {}: {}'.format(filename, e))
+
+
+def add_spilos(region, records, ttl=DEFAULT_TTL, filename=None, selection=None):
+    """Adds the spilos of a selection to the cache, next to the spilos which are cached already and have not expired
+
+    The selection is remembered, the cache only holds all the spilos of the selections it was filled for"""
+
+    filename = filename or DISCOVERY_CACHE
+    names = {r['stack_name'] for r in records}
+    try:
+        with locked_json(filename, dict()) as cache:
+            entry = cache.get(region)
+            if entry is None or time.time() - entry.get('timestamp', 0) > ttl:
+                entry = {'timestamp': time.time(), 'spilos': list(), 'complete': False, 'selections': list()}
+            if not entry.get('complete', True) and selection not in entry.setdefault('selections', list()):
+                entry['selections'].append(selection)
+
+            entry['spilos'] = [r for r in entry.get('spilos', list()) if r['stack_name'] not in names] + records
+            cache[region] = entry
+    except OSError as e:
+        logging.warning('Could not write discovery cache {}: {}'.format(filename, e))
+
+
+def invalidate_spilo(region, stack_name, filename=None):
+    """Removes a single spilo from the cache, the other cached spilos of the region stay valid"""
+
+    filename = filename or DISCOVERY_CACHE
+    try:
+        with locked_json(filename, dict()) as cache:
+            entry = cache.get(region)
+            if entry is None:
+                return
+
+            spilos = [s for s in entry.get('spilos', list()) if s.get('stack_name') != stack_name]
+            if len(spilos) < len(entry.get('spilos', list())):
+                logging.info('Removing {} from the discovery cache'.format(stack_name))
+                entry['spilos'] = spilos
+    except OSError as e:
+        logging.warning('Could not write discovery cache {}: {}'.format(filename, e))
+
+
+def load_non_spilos(region, ttl=DEFAULT_TTL, filename=None):
+    """Returns the stacks we found not to be a spilo, mapping their id to the signature they had back then
+
+    The stacks are forgotten after ttl seconds, so a change we cannot see in the signature is noticed eventually"""
+
+    entry = read_json(filename or STACKS_CACHE, dict()).get(region)
+    if not ttl or not isinstance(entry, dict) or 'timestamp' not in entry:
+        return dict()
+
+    age = time.time() - entry['timestamp']
+    if age > ttl:
+        logging.debug('Remembered stacks of {} expired {:.0f} seconds ago'.format(region, age - ttl))
+        return dict()
+    return entry.get('stacks', dict())
+
+
+def store_non_spilos(region, stacks, filename=None, renew=True):
+    """Without renew, the stacks expire when the ones we remembered before would have"""
+
+    filename = filename or STACKS_CACHE
+    try:
+        with locked_json(filename, dict()) as cache:
+            entry = cache.get(region)
+            timestamp = time.time()
+            if not renew and isinstance(entry, dict) and 'timestamp' in entry:
+                timestamp = entry['timestamp']
+            cache[region] = {'timestamp': timestamp, 'stacks': stacks}
+    except OSError as e:
+        logging.warning('Could not write stacks cache {}: {}'.format(filename, e))
+
+
+def file_signature(filename):
+    stat = os.stat(filename)
+    return [stat.st_mtime_ns, stat.st_size, stat.st_ino]
+
+
+def parse_files(kind, filenames, parse, filename=None):
+    """Returns a list of (filename, parse(filename)) for the files which exist
+
+    The parsed contents are cached per file, keyed by its path, mtime and size, so a file is only parsed again after
+    it has been changed. Parsed contents which are not serializable to JSON are returned without being cached."""
+
+    filename = filename or CONFIG_CACHE
+    cache = read_json(filename, dict())
+    entries = cache.setdefault(kind, dict())
+    changed = False
+
+    parsed = list()
+    for f in filenames:
+        try:
+            signature = file_signature(f)
+        except OSError:
+            if entries.pop(f, None) is not None:
+                changed = True
+            continue
+
+        entry = entries.get(f)
+        if entry is not None and entry['signature'] == signature:
+            parsed.append((f, entry['data']))
+            continue
+
+        logging.debug('Parsing {}'.format(f))
+        data = parse(f)
+        parsed.append((f, data))
+
+        if time.time() - signature[0] / 1e9 > RACY_SECONDS:
+            entries[f] = {'signature': signature, 'data': data}
+            changed = True
+
+    if changed:
+        try:
+            write_json(filename, cache)
+        except OSError as e:
+            logging.warning('Could not write config cache {}: {}'.format(filename, e))
+        except (TypeError, ValueError) as e:
+            # # e.g. the dates in a YAML file
+            logging.warning('Not caching the parsed {} files: {}'.format(kind, e))
+
+    return parsed
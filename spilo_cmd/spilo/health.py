@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import json
+import logging
+import time
+
+from spilo.aws import DEFAULT_CONCURRENCY, parallel_map
+
+PROBE_TIMEOUT = 5
+
+COLUMNS = ['cluster', 'role', 'state', 'timeline', 'lag', 'rest_ms', 'sql_ms', 'error']
+
+# # On a replica we report how far replay is behind what has been received, on a master how far behind its
+# # slowest replica is. Since 10 the functions have wal/lsn in their names, instead of xlog/location.
+LAG_QUERY = """SELECT pg_is_in_recovery(),
+                      CASE WHEN pg_is_in_recovery()
+                           THEN pg_{0}_diff(pg_last_{1}_receive_{2}(), pg_last_{1}_replay_{2}())
+                           ELSE (SELECT max(pg_{0}_diff(pg_current_{1}_{2}(), replay_{2})) FROM pg_stat_replication)
+                      END"""
+
+
+def lag_query(server_version):
+    """
+    >>> 'pg_wal_lsn_diff(pg_current_wal_lsn(), replay_lsn)' in lag_query(100000)
+    True
+    >>> 'pg_last_xlog_replay_location()' in lag_query(90500)
+    True
+    """
+    if server_version >= 100000:
+        return LAG_QUERY.format('wal_lsn', 'wal', 'lsn')
+    return LAG_QUERY.format('xlog_location', 'xlog', 'location')
+
+
+def psycopg2_connect(**parameters):
+    """psycopg2 is optional, without it we only probe Patroni"""
+
+    try:
+        import psycopg2
+    except ImportError:
+        return None
+
+    connection = psycopg2.connect(**parameters)
+    connection.autocommit = True
+    return connection
+
+
+class Prober(object):
+    """Probes a single cluster through its tunnel
+
+    The HTTP connection to Patroni and the connection to Postgres are kept open between probes, so when watching
+    we measure the round trip of the requests, not the time it takes to set up a connection through ssh."""
+
+    def __init__(self, cluster, patroni_port, pg_port=None, libpq_parameters=None, connect=psycopg2_connect,
+                 timeout=PROBE_TIMEOUT):
+        self.cluster = cluster
+        self.patroni_port = int(patroni_port)
+        self.pg_port = pg_port
+        self.libpq_parameters = libpq_parameters or dict()
+        self.connect = connect if pg_port is not None else None
+        self.timeout = timeout
+        self.http = None
+        self.db = None
+
+    def probe(self):
+        result = dict.fromkeys(COLUMNS)
+        result['cluster'] = self.cluster
+
+        errors = list()
+        try:
+            result.update(self.probe_patroni())
+        except Exception as e:
+            errors.append('patroni: {}'.format(e))
+
+        if self.connect is not None:
+            try:
+                result.update(self.probe_postgres())
+            except Exception as e:
+                errors.append('postgres: {}'.format(e))
+
+        result['error'] = '; '.join(errors) or None
+        return result
+
+    def probe_patroni(self):
+        start = time.time()
+        status = json.loads(self.get('/').decode('utf-8'))
+        latency = time.time() - start
+
+        xlog = status.get('xlog', dict())
+        lag = None
+        if 'received_location' in xlog and 'replayed_location' in xlog:
+            lag = max(0, xlog['received_location'] - xlog['replayed_location'])
+
+        return {'role': status.get('role'), 'state': status.get('state'), 'timeline': status.get('timeline'),
+                'lag': lag, 'rest_ms': round(latency * 1000, 1)}
+
+    def get(self, path):
+        # # http.client is imported here, as it adds noticeably to the startup time of every spilo command
+        import http.client
+
+        # # A connection which was closed by the other end is only noticed when we use it, we then retry once
+        for attempt in range(2):
+            if self.http is None:
+                self.http = http.client.HTTPConnection('127.0.0.1', self.patroni_port, timeout=self.timeout)
+            try:
+                self.http.request('GET', path)
+                response = self.http.getresponse()
+                body = response.read()
+                if response.will_close:
+                    self.close_http()
+                return body
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                self.close_http()
+                if attempt > 0:
+                    raise
+            except:
+                self.close_http()
+                raise
+
+    def probe_postgres(self):
+        if self.db is None:
+            parameters = dict(self.libpq_parameters, host='localhost', port=self.pg_port,
+                              connect_timeout=max(1, int(self.timeout)))
+            self.db = self.connect(**parameters)
+            if self.db is None:
+                logging.info('psycopg2 is not available, only probing Patroni')
+                self.connect = None
+                return dict()
+
+        try:
+            start = time.time()
+            with self.db.cursor() as cursor:
+                cursor.execute(lag_query(self.db.server_version))
+                in_recovery, lag = cursor.fetchone()
+            latency = time.time() - start
+        except:
+            self.close_db()
+            raise
+
+        result = {'sql_ms': round(latency * 1000, 1)}
+        if lag is not None:
+            result['lag'] = int(lag)
+        return result
+
+    def close_http(self):
+        if self.http is not None:
+            self.http.close()
+            self.http = None
+
+    def close_db(self):
+        if self.db is not None:
+            try:
+                self.db.close()
+            except Exception:
+                pass
+            self.db = None
+
+    def close(self):
+        self.close_http()
+        self.close_db()
+
+
+def probe_all(probers, concurrency=DEFAULT_CONCURRENCY):
+    """Probes all the clusters in parallel, the results are in the same order as the probers"""
+
+    return parallel_map(lambda prober: prober.probe(), probers, concurrency)
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import re
+
+MODES = ['regex', 'prefix', 'exact']
+
+# # The dns name AWS gives a load balancer: [internal-]<name>-<id>.<region>.elb.amazonaws.com
+elb_dns_re = re.compile(r'^(?:internal-)?(.+)-\d+\.[a-z0-9-]+\.elb\.amazonaws\.com$')
+
+# # Load balancer names are truncated to this length
+MAX_ELB_NAME = 32
+
+
+class Matcher(object):
+    """Matches the cluster patterns given by the user, compiled once
+
+    Regular expressions are compiled one by one, a pattern may start with a global flag like (?i) which would be
+    invalid inside an alternation. The prefixes and names of the other modes are compiled into a single one.
+
+    >>> Matcher(['cluster1', 'db$']).search('mydb')
+    True
+    >>> Matcher(['cluster1'], 'prefix').search('acluster1', 'cluster10')
+    True
+    >>> Matcher(['cluster1'], 'exact').search('cluster10')
+    False
+    >>> Matcher(['(?i)^DB', 'cluster1']).search('db1')
+    True
+    """
+
+    def __init__(self, patterns, mode='regex'):
+        if isinstance(patterns, str):
+            patterns = [patterns]
+        if mode not in MODES:
+            raise Exception('Unknown match mode {}, use one of {}'.format(mode, ', '.join(MODES)))
+
+        self.patterns = list(patterns)
+        self.mode = mode
+
+        if mode == 'regex':
+            self.regexes = [re.compile(p) for p in self.patterns]
+        else:
+            pattern = '^(?:{})'.format('|'.join(re.escape(p) for p in self.patterns))
+            if mode == 'exact':
+                pattern += '$'
+            self.regexes = [re.compile(pattern)]
+
+    def search(self, *haystacks):
+        return any(regex.search(h) for h in haystacks if h for regex in self.regexes)
+
+    def __repr__(self):
+        return 'Matcher({!r}, {!r})'.format(self.patterns, self.mode)
+
+
+def elb_name(dns_name):
+    """
+    >>> elb_name('internal-spilo-cluster1-1234567890.eu-west-1.elb.amazonaws.com')
+    'spilo-cluster1'
+    >>> elb_name('cluster1.db.example.com') is None
+    True
+    """
+    match = elb_dns_re.match(dns_name)
+    return match.group(1) if match else None
+
+
+def elb_dns_names(stack_name, region):
+    """The dns names a load balancer named after the stack could have, the id does not matter for matching"""
+
+    name = stack_name[:MAX_ELB_NAME]
+    return ['{}{}-0.{}.elb.amazonaws.com'.format(prefix, name, region) for prefix in ('internal-', '')]
+
+
+def preselect_stacks(stacks, matcher, cname_index, region):
+    """Returns the stacks which may turn out to be a matching spilo, before we make a single call per stack
+
+    A spilo matches on its version, its load balancer and the dns names pointing to it. The dns names come from the
+    CNAME index, they tell us which load balancers we are looking for. Those are named after their stack, if we find
+    one which is not, we cannot rule out any stack and all stacks are returned."""
+
+    if matcher is None:
+        return list(stacks)
+
+    stacks = list(stacks)
+    wanted = set()
+    for target, aliases in cname_index.items():
+        if matcher.search(target, *aliases):
+            name = elb_name(target)
+            if name is None:
+                # # Not a load balancer, so not a spilo either
+                continue
+            if not any(s.stack_name[:MAX_ELB_NAME] == name for s in stacks):
+                return stacks
+            wanted.add(name)
+
+    return [s for s in stacks if s.stack_name[:MAX_ELB_NAME] in wanted or
+            matcher.search(s.stack_name, s.version, *elb_dns_names(s.stack_name, region))]
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import json
+
+import click
+
+
+class StreamingTable(object):
+    """Prints a table row by row, while the rows are still coming in
+
+    As we cannot look at the rows to come, the widths of the columns are fixed up front. Longer values are printed
+    in full, pushing the rest of their row to the right."""
+
+    def __init__(self, cols, widths, styles=None, titles=None):
+        self.cols = cols
+        self.widths = [max(widths.get(col, 10), len(self.title(col, titles or dict()))) for col in cols]
+        self.styles = styles or dict()
+
+        for i, (col, width) in enumerate(zip(cols, self.widths)):
+            click.secho(self.title(col, titles or dict()).ljust(width), nl=False, fg='black', bg='white')
+            if i < len(cols) - 1:
+                click.secho('│', nl=False, fg='black', bg='white')
+        click.echo('')
+
+    @staticmethod
+    def title(col, titles):
+        return titles.get(col, col.title().replace('_', ' '))
+
+    def row(self, row):
+        from clickclick.console import format
+
+        for col, width in zip(self.cols, self.widths):
+            val = row.get(col)
+            try:
+                style = self.styles.get(val, dict())
+            except TypeError:
+                style = dict()
+            text = format(col, val)
+            # # Numbers and timestamps are aligned to the right, like clickclick does
+            text = text.rjust(width) if isinstance(val, (int, float)) else text.ljust(width)
+            click.secho(text, nl=False, **style)
+            click.echo(' ', nl=False)
+        click.echo('')
+
+
+def print_records(records, output):
+    """Prints the records as a single json or yaml document, for scripts rather than people"""
+
+    if output == 'yaml':
+        import yaml
+
+        print(yaml.safe_dump(json.loads(json.dumps(records, default=str)), default_flow_style=False), end='')
+    else:
+        print(json.dumps(records, sort_keys=True, default=str))
+
+
+def print_tsv(cols, rows):
+    """Prints the rows as tab separated values, unlike the table of clickclick the values are not made pretty"""
+
+    print('\t'.join(cols))
+    for row in rows:
+        print('\t'.join('' if row.get(col) is None else str(row[col]) for col in cols))
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import logging
+import os
+import random
+import socket
+import time
+
+from spilo.cache import CACHE_DIR
+from spilo.registry import is_alive, locked_registry, read_tunnels
+
+RESERVATIONS = os.path.join(CACHE_DIR, 'ports.json')
+
+# # The local ports of our tunnels are taken from this range, which stays clear of the ephemeral ports of the OS
+PORT_RANGE = os.environ.get('SPILO_PORT_RANGE', '20000-29999')
+
+# # A reservation is only kept for as long as it takes to start a tunnel, after that the tunnel registry has the ports
+RESERVATION_TTL = 60
+
+
+def port_range(value=None):
+    """
+    >>> port_range('20000-20009')
+    range(20000, 20010)
+    """
+    low, _, high = (value or PORT_RANGE).partition('-')
+    return range(int(low), int(high or low) + 1)
+
+
+def is_bindable(port):
+    with socket.socket() as s:
+        # # ssh binds the forwarded ports using SO_REUSEADDR as well, so ports in TIME_WAIT are fine
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            s.bind(('127.0.0.1', port))
+        except OSError:
+            return False
+    return True
+
+
+def live_reservations(reservations):
+    now = time.time()
+    return [r for r in reservations if now - r['time'] < RESERVATION_TTL and is_alive(r['pid'])]
+
+
+def tunnel_ports(tunnels):
+    ports = set()
+    for t in tunnels:
+        if is_alive(t['pid']):
+            ports.update(int(t[key]) for key in ('pgport', 'patroniport') if t.get(key))
+    return ports
+
+
+def reserve_ports(count, filename=None, registry=None):
+    """Reserves count free local ports for a new tunnel
+
+    The reservations are shared by all spilo processes of the user, so concurrent tunnels never get the same port,
+    they should be released as soon as the tunnel has been registered."""
+
+    with locked_registry(filename or RESERVATIONS) as reservations:
+        # # Tunnels are registered before their reservations are released, so reading the registry while holding
+        # # the reservations lock means we see the ports of every tunnel
+        reservations[:] = live_reservations(reservations)
+        in_use = {r['port'] for r in reservations} | tunnel_ports(read_tunnels(registry))
+
+        candidates = list(port_range())
+        start = random.randrange(len(candidates))
+
+        ports = list()
+        for port in candidates[start:] + candidates[:start]:
+            if port not in in_use and is_bindable(port):
+                ports.append(port)
+                if len(ports) == count:
+                    break
+        else:
+            raise Exception('No free ports left in range {}'.format(PORT_RANGE))
+
+        reservations.extend({'port': p, 'pid': os.getpid(), 'time': time.time()} for p in ports)
+
+    logging.debug('Reserved local ports {}'.format(ports))
+    return ports
+
+
+def release_ports(ports, filename=None):
+    with locked_registry(filename or RESERVATIONS) as reservations:
+        reservations[:] = [r for r in reservations if r['port'] not in ports]
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import getpass
+import json
+import logging
+import os
+import re
+import subprocess
+import sys
+
+PROC = '/proc'
+
+# # The environment variables we set on the ssh processes which are running our tunnels
+SPILO_VARIABLES = [
+    ('pgport', 'SPILOPGPORT'),
+    ('patroniport', 'SPILOPATRONIPORT'),
+    ('host', 'SPILOHOST'),
+    ('vpc_id', 'SPILOVPCID'),
+    ('service', 'SPILOSERVICE'),
+]
+
+
+def get_my_processes():
+    """Returns the tunnel processes of the current user
+
+    On Linux we read the environment of the ssh processes from /proc, elsewhere we fall back to ps"""
+
+    if sys.platform.startswith('linux') and os.path.isdir(os.path.join(PROC, 'self')):
+        processes = scan_proc()
+    else:
+        processes = scan_ps()
+
+    logging.debug('Processes : {}'.format(json.dumps(processes, sort_keys=True, indent=4)))
+    return processes
+
+
+def tunnel_process(pid, command, environment):
+    process = dict()
+    process['pid'] = pid
+    process['process'] = command
+    process['cluster'] = environment['SPILOCLUSTER']
+
+    for key, variable in SPILO_VARIABLES:
+        if variable in environment:
+            process[key] = environment[variable]
+
+    service_dsn = process.get('service')
+    if service_dsn is None:
+        service_dsn = ''
+    else:
+        service_dsn = ' service={}'.format(service_dsn)
+
+    process['dsn'] = '"host=localhost port={}{}"'.format(process['pgport'], service_dsn)
+    return process
+
+
+def scan_proc(proc=PROC, uid=None, command='ssh'):
+    """Finds the tunnels by reading /proc/<pid>/environ of the ssh processes of the user"""
+
+    if uid is None:
+        uid = os.getuid()
+
+    processes = list()
+
+    for pid in sorted((p for p in os.listdir(proc) if p.isdigit()), key=int):
+        path = os.path.join(proc, pid)
+        try:
+            if os.stat(path).st_uid != uid:
+                continue
+
+            with open(os.path.join(path, 'comm'), 'rb') as f:
+                if f.read().strip() != command.encode():
+                    continue
+
+            with open(os.path.join(path, 'environ'), 'rb') as f:
+                environ = f.read()
+
+            if b'SPILOCLUSTER=' not in environ:
+                continue
+
+            with open(os.path.join(path, 'cmdline'), 'rb') as f:
+                argv = f.read().split(b'\0')
+        except OSError:
+            # # The process exited while we were looking at it
+            continue
+
+        environment = dict()
+        for variable in environ.split(b'\0'):
+            if variable.startswith(b'SPILO'):
+                key, _, value = variable.decode('utf-8', 'replace').partition('=')
+                environment[key] = value
+
+        processes.append(tunnel_process(pid, argv[0].decode('utf-8', 'replace'), environment))
+
+    return processes
+
+
+def scan_ps():
+    # # We do not use psutil for processes, as environment variables of processes is not
+    # # available from it. We will just use good old ps for the task
+
+    ps_cmd = [
+        'ps',
+        'e',
+        '-eww',
+        '-U',
+        getpass.getuser(),
+        '-A',
+        '-o',
+        'pid,command',
+    ]
+
+    ps_output = subprocess.check_output(ps_cmd, shell=False, stderr=subprocess.DEVNULL,
+                                        env={'LANG': 'C'}).splitlines()
+    return parse_ps_output(ps_output)
+
+
+def parse_ps_output(ps_output):
+    processes = list()
+
+    process_re = re.compile(r'^\s*(\d+)\s+([^\s]+).*SPILOCLUSTER=([^\s]*)')
+    variable_res = [
+        ('SPILOPGPORT', re.compile(r'SPILOPGPORT=(\d+)')),
+        ('SPILOPATRONIPORT', re.compile(r'SPILOPATRONIPORT=(\d+)')),
+        ('SPILOSERVICE', re.compile(r'SPILOSERVICE=(\w*)')),
+        ('SPILOHOST', re.compile(r'SPILOHOST=([^\s]*)')),
+        ('SPILOVPCID', re.compile(r'SPILOVPCID=([^\s]*)')),
+    ]
+
+    # # We cannot disable the header on every ps (Mac OS X for example), the first line is a header
+    for line in ps_output[1:]:
+        line = line.decode('utf-8')
+
+        match = process_re.search(line)
+        if match:
+            logging.debug('Matched line: {}'.format(line[0:120]))
+
+            environment = {'SPILOCLUSTER': match.group(3)}
+            for variable, variable_re in variable_res:
+                variable_match = variable_re.search(line)
+                if variable_match:
+                    environment[variable] = variable_match.group(1)
+
+            processes.append(tunnel_process(match.group(1), match.group(2), environment))
+
+    return processes
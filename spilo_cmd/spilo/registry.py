@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import contextlib
+import logging
+import os
+import time
+
+from spilo.cache import CACHE_DIR, locked_json, read_json
+from spilo.processes import get_my_processes, tunnel_process
+
+REGISTRY = os.path.join(CACHE_DIR, 'tunnels.json')
+
+
+@contextlib.contextmanager
+def locked_registry(filename=None):
+    """Holds an exclusive lock on the registry, yields its entries which are written back if they were modified"""
+
+    with locked_json(filename or REGISTRY, list()) as entries:
+        yield entries
+
+
+def is_alive(pid):
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # # The process exists, but belongs to someone else: our tunnel has gone and its pid was reused
+        return False
+    return True
+
+
+def read_tunnels(filename=None):
+    """Returns all registered tunnels without locking the registry, which is always replaced atomically"""
+
+    return read_json(filename or REGISTRY, list())
+
+
+def is_running(entry):
+    """A tunnel is running if its ssh is, or if a supervisor is looking after it while ssh is being restarted"""
+
+    return is_alive(entry['pid']) or (entry.get('supervisor') is not None and is_alive(entry['supervisor']))
+
+
+def get_tunnels(filename=None):
+    """Returns the registered tunnels which are still running, forgetting about the ones which are not"""
+
+    with locked_registry(filename) as entries:
+        live = [e for e in entries if is_running(e)]
+        if len(live) < len(entries):
+            logging.debug('Pruning {} stale tunnel(s) from the registry'.format(len(entries) - len(live)))
+            entries[:] = live
+
+    return live
+
+
+def adopt_tunnels(scan=get_my_processes, filename=None):
+    """Registers the running tunnels which are missing from the registry, returns the adopted entries
+
+    Those were started by an older spilo, or are left over after the registry was lost. Finding them means scanning
+    the processes, so this is only done when asked for with tunnel --adopt."""
+
+    try:
+        processes = scan()
+    except Exception as e:
+        logging.warning('Could not look for unregistered tunnels: {}'.format(e))
+        return list()
+
+    adopted = list()
+    with locked_registry(filename) as entries:
+        # # A tunnel restarted by the supervisor has another pid, but still the same port
+        ports = set(e['pgport'] for e in entries)
+        for process in processes:
+            if process.get('pgport') and process['pgport'] not in ports and is_alive(process['pid']):
+                entry = dict(process, process='ssh', started=None)
+                entries.append(entry)
+                adopted.append(entry)
+                ports.add(entry['pgport'])
+
+    if adopted:
+        logging.info('Adopted {} tunnel(s) which were not registered'.format(len(adopted)))
+    return adopted
+
+
+def register_tunnel(pid, environment, extra=None, filename=None):
+    """Registers a tunnel using the same SPILO* variables we set on the ssh process
+
+    Multiplexed tunnels share the pid of their ssh master, they are told apart by their postgres port"""
+
+    entry = tunnel_process(str(pid), 'ssh', environment)
+    entry['started'] = time.time()
+    entry.update(extra or dict())
+
+    with locked_registry(filename) as entries:
+        entries[:] = [e for e in entries if not same_tunnel(e, entry['pid'], entry['pgport'])]
+        entries.append(entry)
+
+    return entry
+
+
+def unregister_tunnel(pid, pgport=None, filename=None):
+    with locked_registry(filename) as entries:
+        entries[:] = [e for e in entries if not same_tunnel(e, str(pid), pgport)]
+
+
+def pop_tunnel(pgport, filename=None):
+    """Unregisters the tunnel on the local postgres port and returns its entry, None if there is none
+
+    The port tells the tunnel apart even after the supervisor restarted it, while its pid has changed"""
+
+    with locked_registry(filename) as entries:
+        popped = [e for e in entries if e['pgport'] == str(pgport)]
+        entries[:] = [e for e in entries if e['pgport'] != str(pgport)]
+
+    return popped[0] if popped else None
+
+
+def same_tunnel(entry, pid, pgport=None):
+    return entry['pid'] == pid and (pgport is None or entry['pgport'] == str(pgport))
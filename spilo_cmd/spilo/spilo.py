@@ -2,40 +2,76 @@
 # -*- coding: utf-8 -*-
 import click
 import atexit
-import getpass
 import collections
 import logging
-import re
 import sys
-import boto
 import os
-import prettytable
 import json
 import signal
-import dateutil
 import time
 import socket
 import datetime
 import subprocess
-import yaml
+import tempfile
+import threading
 import configparser
 
-from clickclick import AliasedGroup, OutputFormat
-from clickclick.console import print_table, format_time
-import senza.cli
-from senza.cli import get_region, check_credentials, get_stacks, resources, handle_exceptions, get_instance_health, \
-    parse_time, watching
-from dateutil import parser as dateutil_parser
-
-STYLES = senza.cli.STYLES
-TITLES = senza.cli.TITLES
-
-STYLES['MASTER'] = {'fg': 'green'}
-STYLES['REPLICA'] = {'fg': 'yellow'}
-
-ec2 = None
+from spilo.aws import DEFAULT_CONCURRENCY, SharedResult, ThreadLocalConnection, build_cname_index, call_with_backoff, \
+    get_instances_by_stack, parallel_imap, parallel_map
+from spilo.bench import DEFAULT_CONNECTIONS, DEFAULT_COPY_ROWS, DEFAULT_QUERIES, overhead, run_benchmark
+from spilo.cache import DEFAULT_TTL, add_spilos, invalidate_spilo, load_non_spilos, load_spilos, parse_files, \
+    store_non_spilos, store_spilos
+from spilo.health import COLUMNS as HEALTH_COLUMNS, Prober, probe_all
+from spilo.matcher import MODES, Matcher, preselect_stacks
+from spilo.output import StreamingTable, print_records, print_tsv
+from spilo.ports import release_ports, reserve_ports
+from spilo.registry import adopt_tunnels, get_tunnels, is_alive, pop_tunnel, register_tunnel
+from spilo.supervisor import CHECK_INTERVAL, Supervisor, ensure_supervisor, is_listening, supervised_tunnels
+from spilo.ssh import READY_TIMEOUT, add_forwards, cancel_forwards, ensure_master, run_over_master, \
+    ssh_destination, tunnel_command, wait_for_tunnel
+
+# # boto and senza take most of our startup time, they are only imported by the commands that talk to AWS.
+# # So we print tables without the styles and titles of senza.cli, these are only the values and columns we print.
+STYLES = {
+    'MASTER': {'fg': 'green'},
+    'REPLICA': {'fg': 'yellow'},
+    'PROMOTED': {'fg': 'green', 'bold': True},
+    'DEMOTED': {'fg': 'red', 'bold': True},
+    'ADDED': {'fg': 'green'},
+    'REMOVED': {'fg': 'red'},
+    'CHANGED': {'fg': 'yellow'},
+    'master': {'fg': 'green'},
+    'replica': {'fg': 'yellow'},
+    'running': {'fg': 'green'},
+}
+TITLES = {
+    'instance_id': 'Instance ID',
+    'private_ip': 'Private IP',
+    'launch_time': 'Launched',
+    'rest_ms': 'REST ms',
+    'sql_ms': 'SQL ms',
+    'connect_p50': 'Connect p50 ms',
+    'connect_p99': 'Connect p99 ms',
+    'query_p50': 'Query p50 ms',
+    'query_p90': 'Query p90 ms',
+    'query_p99': 'Query p99 ms',
+    'copy_mb_s': 'COPY MB/s',
+}
+
+# # While watching, we poll more often during a transition and back off when the clusters are stable
+WATCH_MIN_INTERVAL = 1
+WATCH_BACKOFF = 4
+
+boto = None
+# # The connections to AWS, per region
+aws_connections = dict()
+aws_connections_lock = threading.Lock()
 tunnels = {'patroni':None, 'postgres':None}
 managed_processes = dict()
+managed_tunnels = list()
+
+# # How often we try to start a tunnel when its local ports turn out to be taken
+PORT_ATTEMPTS = 3
 
 processed = False
 PIUCONFIG = '~/.config/piu/piu.yaml'
@@ -52,11 +88,48 @@ option_pg_service_file = click.option('--pg_service-file', help='The PostgreSQL
 option_region = click.option('--region', envvar='AWS_DEFAULT_REGION', metavar='AWS_REGION_ID',
                              help='AWS region ID (e.g. eu-west-1)')
 option_reuse = click.option('--reuse/--no-reuse', default=True, help='Reuse an already exisiting tunnel')
+option_concurrency = click.option('--concurrency', type=click.IntRange(1, 100), envvar='SPILO_CONCURRENCY',
+                                  default=DEFAULT_CONCURRENCY, help='Maximum number of concurrent AWS requests')
+option_cache_ttl = click.option('--cache-ttl', type=click.IntRange(0), envvar='SPILO_CACHE_TTL', default=DEFAULT_TTL,
+                                metavar='SECS', help='Reuse discovered spilos for SECS seconds (0 disables the cache)')
+option_match = click.option('--match', type=click.Choice(MODES), envvar='SPILO_MATCH', default='regex',
+                             help='How clusters are matched against versions and dns names')
+option_refresh = click.option('--refresh', is_flag=True, default=False, help='Ignore the discovery cache')
+option_tunnel_timeout = click.option('--tunnel-timeout', type=click.FLOAT, envvar='SPILO_TUNNEL_TIMEOUT',
+                                     default=READY_TIMEOUT, metavar='SECS',
+                                     help='Maximum time to wait for a tunnel to be established')
+option_supervise = click.option('--supervise/--no-supervise', envvar='SPILO_SUPERVISE', default=False,
+                                help='Let the supervisor restart the tunnel if it dies, start it if needed')
+option_multiplex = click.option('--multiplex/--no-multiplex', envvar='SPILO_MULTIPLEX', default=False,
+                                help='Share a single ssh connection to the odd host between all tunnels')
 
 cluster_argument = click.argument('cluster')
 
 
-class Spilo(collections.namedtuple('Spilo', 'stack_name, version, dns, elb, instances, vpc_id, stack')):
+class AliasedGroup(click.Group):
+    """Allows abbreviated commands, like the group of clickclick which we do not import for startup time"""
+
+    def get_command(self, ctx, cmd_name):
+        rv = click.Group.get_command(self, ctx, cmd_name)
+        if rv is not None:
+            return rv
+        matches = [x for x in self.list_commands(ctx) if x.startswith(cmd_name)]
+        if not matches:
+            return None
+        elif len(matches) == 1:
+            return click.Group.get_command(self, ctx, matches[0])
+        ctx.fail('Too many matches: %s' % ', '.join(sorted(matches)))
+
+
+class Spilo(collections.namedtuple('Spilo', 'stack_name, version, dns, elb, instances, vpc_id, stack, region')):
+    pass
+
+
+Spilo.__new__.__defaults__ = (None,)
+
+
+class CachedStack(collections.namedtuple('CachedStack', 'stack_name, stack_id, name, version')):
+    """Stands in for the CloudFormation stack of a spilo that was read from the discovery cache"""
     pass
 
 
@@ -86,17 +159,34 @@ def process_options(opts):
     options = opts
 
     logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=options.get('loglevel', 'WARNING'))
-    pg_service_name, pg_service = get_pg_service()
+    pg_service_name, pg_service = get_pg_service(options)
 
-    odd_config = load_odd_config()
+    odd_config = load_odd_config(options)
 
     processed = True
 
+
+class Context(collections.namedtuple('Context', 'options, pg_service_name, pg_service, odd_config')):
+    """Everything needed to set up a tunnel, so tunnels can be set up without the globals of the command line"""
+    pass
+
+
+def make_context(opts):
+    pg_service_name, pg_service = get_pg_service(opts)
+    return Context(options=opts, pg_service_name=pg_service_name, pg_service=pg_service,
+                   odd_config=load_odd_config(opts))
+
+
 def cleanup():
     for name, process in managed_processes.items():
         if process.returncode is None:
+            if name == 'tunnel':
+                # # Like kill_tunnel, unregistered first so a supervisor does not restart it
+                pop_tunnel(tunnels['postgres'])
             logging.info('Terminating process {} (pid={})'.format(name, process.pid))
             process.kill()
+    for entry in managed_tunnels:
+        kill_tunnel(entry)
     os.system('stty sane')
 
 
@@ -118,6 +208,13 @@ def libpq_parameters():
 @option_odd_config_file
 @option_region
 @option_reuse
+@option_multiplex
+@option_supervise
+@option_tunnel_timeout
+@option_concurrency
+@option_cache_ttl
+@option_refresh
+@option_match
 @option_log_level
 @click.argument('psql_arguments', nargs=-1, metavar='[-- [psql OPTIONS]]')
 def connect(**options):
@@ -125,7 +222,7 @@ def connect(**options):
 
     process_options(options)
 
-    tunnel_pid = get_tunnel(options['cluster'], options['reuse'])
+    get_tunnel(options['cluster'], options['reuse'])
 
     psql_cmd = ['psql', libpq_parameters()[1]]
     psql_cmd.extend(options['psql_arguments'])
@@ -138,44 +235,195 @@ def connect(**options):
 
 
 @cli.command('healthcheck', short_help='Healthcheck')
-@click.option('--watch', help='Keep watching every WATCH seconds')
+@click.option('--watch', help='Keep probing every WATCH seconds', type=click.FLOAT, metavar='SECS')
+@click.option('--output', type=click.Choice(['text', 'jsonl']), default='text',
+              help='Print a table, or a JSON object per cluster for every probe')
+@click.option('-P', '--libpq-parameter', 'libpq_parameters', multiple=True, metavar='KEY=VALUE',
+              help='Extra libpq connection parameter for the SQL probe, e.g. -P dbname=postgres')
 @option_port
 @option_pg_service_file
-@cluster_argument
-@click.argument('libpq_parameters', nargs=-1)
+@option_odd_config_file
+@option_region
+@option_multiplex
+@option_supervise
+@option_tunnel_timeout
+@option_concurrency
+@option_cache_ttl
+@option_refresh
+@option_match
+@option_log_level
+@click.argument('clusters', nargs=-1, required=True)
 def healthcheck(**options):
-    """Does a healthcheck on the given cluster"""
+    """Does a healthcheck on the given clusters
 
-    pass
+    Patroni, and Postgres if psycopg2 is installed, are probed through the tunnels of all clusters in parallel."""
+
+    # # The pg_service lookup is done for a single cluster only
+    options['cluster'] = options['clusters'][0] if len(options['clusters']) == 1 else None
+    process_options(options)
+
+    parameters = dict(p.split('=', 1) for p in options['libpq_parameters'])
+    if pg_service_name is not None:
+        parameters.setdefault('service', pg_service_name)
+
+    probers = list()
+    for cluster in options['clusters']:
+        get_tunnel(cluster, options.get('reuse', True))
+        probers.append(Prober(cluster, tunnels['patroni'], tunnels['postgres'], parameters))
+
+    try:
+        while True:
+            results = probe_all(probers, options['concurrency'])
+            if options['output'] == 'jsonl':
+                now = time.time()
+                for result in results:
+                    print(json.dumps(dict(result, time=now), sort_keys=True), flush=True)
+            else:
+                print_table(HEALTH_COLUMNS, results, styles=STYLES, titles=TITLES)
+
+            if not options['watch']:
+                break
+            time.sleep(options['watch'])
+    finally:
+        for prober in probers:
+            prober.close()
+
+    if any(result['error'] for result in results):
+        sys.exit(1)
+
+
+@cli.command('bench', short_help='Benchmark a tunnel')
+@click.option('--direct', metavar='DSN', help='Also benchmark this DSN, to compare the tunnel with direct access')
+@click.option('--connections', type=click.IntRange(1), default=DEFAULT_CONNECTIONS,
+              help='Number of connections to set up')
+@click.option('--queries', type=click.IntRange(1), default=DEFAULT_QUERIES, help='Number of queries to run')
+@click.option('--copy-rows', type=click.IntRange(0), default=DEFAULT_COPY_ROWS,
+              help='Number of rows to COPY out of the server, 0 skips the COPY')
+@click.option('--output', type=click.Choice(['text', 'json']), default='text')
+@click.option('-P', '--libpq-parameter', 'libpq_parameters', multiple=True, metavar='KEY=VALUE',
+              help='Extra libpq connection parameter, e.g. -P dbname=postgres')
+@option_port
+@option_pg_service_file
+@option_odd_config_file
+@option_region
+@option_reuse
+@option_multiplex
+@option_supervise
+@option_tunnel_timeout
+@option_concurrency
+@option_cache_ttl
+@option_refresh
+@option_match
+@option_log_level
+@cluster_argument
+def bench(**options):
+    """Measures connection setup, query round trips and COPY throughput through the tunnel to the cluster"""
+
+    process_options(options)
+
+    get_tunnel(options['cluster'], options['reuse'])
+
+    parameters = dict(p.split('=', 1) for p in options['libpq_parameters'])
+    parameters.update(libpq_parameters()[0])
+
+    settings = {'connections': options['connections'], 'queries': options['queries'],
+                'copy_rows': options['copy_rows']}
+
+    results = [run_benchmark('tunnel', parameters, **settings)]
+    if options['direct'] is not None:
+        results.append(run_benchmark('direct', {'dsn': options['direct']}, **settings))
+        results.append(overhead(*results))
+
+    if options['output'] == 'json':
+        print(json.dumps({'cluster': options['cluster'], 'time': time.time(), 'settings': settings,
+                          'results': results}, sort_keys=True, indent=4))
+    else:
+        columns = ['target', 'connect_p50', 'connect_p99', 'query_p50', 'query_p90', 'query_p99', 'copy_mb_s']
+        print_table(columns, results, styles=STYLES, titles=TITLES)
 
 
 @cli.command('list', short_help='List available spilos')
 @option_log_level
 @option_region
+@option_concurrency
+@option_cache_ttl
+@option_refresh
+@option_match
+@click.option('--regions', envvar='SPILO_REGIONS', metavar='AWS_REGION_IDS',
+              help='Comma separated AWS region IDs to list the spilos of, all regions are searched in parallel')
 @click.option('--tunnel', help='List only the established tunnels', is_flag=True, default=False)
 @click.option('--details', help='Show more details', is_flag=True, default=False)
-@click.option('--watch', help='Auto update the screen every X seconds', type=click.IntRange(1, 300), metavar='SECS')
+@click.option('--watch', help='Auto update the screen every X seconds, with --details only changes are shown',
+              type=click.IntRange(1, 300), metavar='SECS')
+@click.option('--output', type=click.Choice(['table', 'stream', 'jsonl', 'json', 'tsv', 'yaml']), default='table',
+              help='Print every spilo as soon as it is found with stream and jsonl, or all at once with the others')
 @click.argument('clusters', nargs=-1)
 def list_spilos(**options):
     process_options(options)
 
+    regions = [r.strip() for r in (options['regions'] or '').split(',') if r.strip()]
+
+    if options['output'] != 'table' and options['watch']:
+        raise Exception('--watch can only be used with --output table')
+
+    if options['output'] in ('stream', 'jsonl') and not options['tunnel']:
+        if regions:
+            spilos = iter_spilos_in_regions(regions, clusters=options['clusters'], concurrency=options['concurrency'],
+                                            ttl=options['cache_ttl'], refresh=options['refresh'],
+                                            match=options['match'])
+        else:
+            spilos = iter_spilos(options['region'], clusters=options['clusters'], concurrency=options['concurrency'],
+                                 ttl=options['cache_ttl'], refresh=options['refresh'], match=options['match'])
+        stream_spilos(spilos, options['output'], details=options['details'], show_region=bool(regions),
+                      concurrency=options['concurrency'])
+        return
+
     if options['tunnel']:
         spilos = list()
+    elif regions:
+        spilos = get_spilos_in_regions(regions, clusters=options['clusters'], concurrency=options['concurrency'],
+                                       ttl=options['cache_ttl'], refresh=options['refresh'], match=options['match'])
     else:
-        spilos = get_spilos(region=options['region'], clusters=options['clusters'], details=options['details'])
+        spilos = get_spilos(region=options['region'], clusters=options['clusters'], details=options['details'],
+                            concurrency=options['concurrency'], ttl=options['cache_ttl'], refresh=options['refresh'],
+                            match=options['match'])
 
-    processes = get_my_processes()
+    if options['details'] and options['watch']:
+        watch_spilos(spilos, options['watch'], concurrency=options['concurrency'], show_region=bool(regions))
+        return
+
+    if options['output'] != 'table':
+        if options['details']:
+            spilos = update_spilo_info(spilos, concurrency=options['concurrency'])
+        print_spilos(spilos, show_region=bool(regions), output=options['output'])
+        return
+
+    from senza.cli import watching
 
     for _ in watching(w=False, watch=options['watch']):
         if options['details']:
-            spilos = update_spilo_info(spilos)
-        print_spilos(spilos)
+            spilos = update_spilo_info(spilos, concurrency=options['concurrency'])
+        print_spilos(spilos, show_region=bool(regions))
 
 
-def print_spilos(spilos):
+def print_spilos(spilos, show_region=False, output='table'):
+    if output in ('json', 'yaml'):
+        print_records([spilo_to_json(s) for s in spilos], output)
+        return
     if len(spilos) == 0:
         return
 
+    # # Scripts reading tab separated values get the cluster information on every row
+    columns, pretty_rows = spilo_rows(spilos, show_region, repeat=output == 'tsv')
+    if output == 'tsv':
+        print_tsv(columns, pretty_rows)
+    else:
+        print_table(columns, pretty_rows, styles=STYLES, titles=TITLES)
+
+
+def spilo_rows(spilos, show_region=False, repeat=False):
+    """Returns the columns and the rows to print the spilos in a table, a row per instance"""
+
     columns = [
         'cluster',
         'dns',
@@ -186,11 +434,13 @@ def print_spilos(spilos):
     ]
     if spilos[0].instances is None:
         columns = ['cluster', 'dns']
+    if show_region:
+        columns.insert(0, 'region')
 
     pretty_rows = list()
 
     for s in spilos:
-        pretty_row = {'cluster': s.version}
+        pretty_row = {'cluster': s.version, 'region': getattr(s, 'region', None)}
         pretty_row['dns'] = ', '.join(s.dns or list())
 
         if s.instances is not None:
@@ -199,37 +449,156 @@ def print_spilos(spilos):
                 pretty_rows.append(pretty_row.copy())
 
                 # # Do not repeat general cluster information
-                pretty_row = {'cluster': '', 'dns': ''}
+                if not repeat:
+                    pretty_row = {'cluster': '', 'dns': '', 'region': ''}
         else:
             pretty_rows.append(pretty_row)
 
-    print_table(columns, pretty_rows, styles=STYLES, titles=TITLES)
+    return columns, pretty_rows
 
 
-def re_search(needles=None, haystacks=None):
-    """Searches a list of values for a list of regexp"""
+# # The widths of the columns when streaming, as we cannot look ahead at the rows to come
+STREAM_WIDTHS = {'region': 14, 'cluster': 24, 'dns': 48, 'instance_id': 19, 'private_ip': 15, 'role': 7,
+                 'launch_time': 9}
 
-    if needles is None or haystacks is None:
-        return None
 
-    if isinstance(needles, str):
-        needles = [needles]
+def spilo_to_json(spilo):
+    result = spilo_to_record(spilo)
+    result['region'] = spilo.region
+    result['instances'] = spilo.instances
+    return result
 
-    if isinstance(haystacks, str):
-        haystacks = [haystacks]
 
-    for n in needles:
-        rp = re.compile(n)
-        for h in haystacks:
-            if rp.search(h):
-                return n, h
+def stream_spilos(spilos, output, details=False, show_region=False, concurrency=DEFAULT_CONCURRENCY):
+    """Prints every spilo as soon as it is yielded, either as rows of a table or as a line of JSON"""
 
-    return None
+    start = time.time()
+    table = None
+    count = 0
+
+    for spilo in spilos:
+        if details:
+            spilo = update_spilo_info([spilo], concurrency=concurrency)[0]
+        if count == 0:
+            logging.debug('Time to first row: {:.3f} seconds'.format(time.time() - start))
+        count += 1
+
+        if output == 'jsonl':
+            print(json.dumps(spilo_to_json(spilo), sort_keys=True, default=str), flush=True)
+            continue
+
+        if table is None:
+            columns, _ = spilo_rows([spilo], show_region)
+            table = StreamingTable(columns, STREAM_WIDTHS, styles=STYLES, titles=TITLES)
+        for row in spilo_rows([spilo], show_region)[1]:
+            table.row(row)
+        sys.stdout.flush()
+
+    logging.debug('Streamed {} spilos in {:.3f} seconds'.format(count, time.time() - start))
+
+
+def watch_spilos(spilos, interval, concurrency=DEFAULT_CONCURRENCY, show_region=False):
+    """Prints the spilos once, and from then on only the instances whose role, ip or health changed"""
+
+    spilos = update_spilo_info(spilos, concurrency=concurrency)
+    print_spilos(spilos, show_region)
+    previous = instance_snapshot(spilos)
+
+    delay = interval
+    while True:
+        time.sleep(delay)
+
+        spilos = update_spilo_info(spilos, concurrency=concurrency)
+        current = instance_snapshot(spilos)
+        changes = diff_snapshots(previous, current)
+        if len(changes) > 0:
+            print_changes(changes)
+
+        delay = next_watch_interval(delay, interval, len(changes) > 0)
+        logging.debug('Next poll in {} seconds'.format(delay))
+        previous = current
+
+
+def next_watch_interval(delay, interval, changed):
+    """
+    >>> next_watch_interval(5, 5, True)
+    1
+    >>> next_watch_interval(1, 5, False)
+    2
+    >>> next_watch_interval(16, 5, False)
+    20
+    """
+    if changed:
+        return WATCH_MIN_INTERVAL
+
+    return min(delay * 2, interval * WATCH_BACKOFF)
+
+
+def instance_snapshot(spilos):
+    """Maps every instance to the attributes which can change while we are watching"""
+
+    snapshot = dict()
+    for s in spilos:
+        for i in s.instances or list():
+            snapshot[(s.version, i['instance_id'])] = {'private_ip': i['private_ip'], 'role': i['role'],
+                                                       'health': i.get('health')}
+    return snapshot
+
+
+def diff_snapshots(previous, current):
+    changes = list()
+
+    for key in sorted(set(previous) | set(current)):
+        old = previous.get(key)
+        new = current.get(key)
+        if old == new:
+            continue
+
+        if old is None:
+            change = 'ADDED'
+        elif new is None:
+            change = 'REMOVED'
+        elif old['role'] == 'REPLICA' and new['role'] == 'MASTER':
+            change = 'PROMOTED'
+        elif old['role'] == 'MASTER' and new['role'] == 'REPLICA':
+            change = 'DEMOTED'
+        else:
+            change = 'CHANGED'
+
+        row = {'cluster': key[0], 'instance_id': key[1], 'change': change}
+        row.update(new or old)
+        changes.append(row)
+
+    return changes
+
+
+def print_changes(changes):
+    columns = ['time', 'cluster', 'instance_id', 'private_ip', 'role', 'health', 'change']
+
+    now = time.strftime('%H:%M:%S')
+    for c in changes:
+        c['time'] = now
+
+    print_table(columns, changes, styles=STYLES, titles=TITLES)
+
+
+def is_stable(stack):
+    return 'COMPLETE' in stack.stack_status and 'DELETE' not in stack.stack_status and \
+        'ROLLBACK' not in stack.stack_status
+
+
+def stack_signature(stack):
+    """Changes whenever the stack is updated, so it may have become a spilo
+
+    boto keeps the elements of a StackSummary it does not know under their own name, like LastUpdatedTime"""
+
+    updated = getattr(stack, 'LastUpdatedTime', None) or getattr(stack, 'creation_time', None)
+    return [stack.stack_status, str(updated)]
 
 
 def get_spilo_resources(stack, cloud_formation_connection):
-    if 'COMPLETE' in stack.stack_status and 'DELETE' not in stack.stack_status and 'ROLLBACK' not in stack.stack_status:
-        resources = cloud_formation_connection.describe_stack_resources(stack.stack_name)
+    if is_stable(stack):
+        resources = call_with_backoff(cloud_formation_connection.describe_stack_resources, stack.stack_name)
 
         # # We know it is a Spilo if it has a PostgresLoadBalancer
         for resource in resources:
@@ -240,110 +609,356 @@ def get_spilo_resources(stack, cloud_formation_connection):
     return None
 
 
-def update_spilo_info(spilos):
-    global ec2
-    global elb_conn
+def load_boto():
+    global boto
+
+    if boto is None:
+        import boto.cloudformation
+        import boto.ec2
+        import boto.ec2.elb
+        import boto.route53
+    return boto
+
+
+class RegionConnections(object):
+    """The connections to the AWS services of a single region, every thread gets its own connections"""
+
+    def __init__(self, region):
+        load_boto()
+        self.region = region
+        self.ec2 = ThreadLocalConnection(boto.ec2.connect_to_region, region)
+        self.elb = ThreadLocalConnection(boto.ec2.elb.connect_to_region, region)
+        self.cloudformation = ThreadLocalConnection(boto.cloudformation.connect_to_region, region)
+        self.route53 = ThreadLocalConnection(boto.route53.connect_to_region, region)
+
+
+def get_connections(region):
+    with aws_connections_lock:
+        if region not in aws_connections:
+            aws_connections[region] = RegionConnections(region)
+        return aws_connections[region]
+
+
+def get_region(region):
+    """Like senza, falls back to the default region in ~/.aws/config, senza is only imported to complain"""
+
+    if not region:
+        config = configparser.ConfigParser()
+        try:
+            config.read(os.path.expanduser('~/.aws/config'))
+            region = config.get('default', 'region', fallback=None)
+        except configparser.Error:
+            pass
+    if region:
+        return region
+
+    from senza.cli import get_region
+    return get_region(region)
+
+
+def check_credentials(region):
+    from senza.cli import check_credentials
+    return check_credentials(region)
+
+
+def get_stacks(*args, **kwargs):
+    from senza.cli import get_stacks
+    return get_stacks(*args, **kwargs)
+
+
+def update_spilo_info(spilos, cname_index=None, batched=True, concurrency=DEFAULT_CONCURRENCY):
+    """Refreshes the instances of the spilos, and their dns names if a CNAME index is given"""
+
+    spilos = list(spilos)
+
+    # # The spilos of every region are handled by their own connections, all regions in parallel
+    regions = collections.OrderedDict()
+    for s in spilos:
+        regions.setdefault(s.region, list()).append(s.stack)
+
+    def get_details(region):
+        connections = get_connections(region)
+        if batched:
+            return get_instance_details(regions[region], connections, concurrency)
+        return [get_stack_instance_details(stack, connections) for stack in regions[region]]
+
+    details = dict(zip(regions, parallel_map(get_details, regions, concurrency)))
+    instances = [details[s.region].pop(0) for s in spilos]
 
     new_spilos = list()
 
-    for old_spilo in spilos:
-        new_spilos.append(Spilo(old_spilo.stack_name, old_spilo.version, old_spilo.dns, old_spilo.elb,
-                          get_stack_instance_details(old_spilo.stack), old_spilo.vpc_id, old_spilo.stack))
+    for old_spilo, spilo_instances in zip(spilos, instances):
+        dns = old_spilo.dns
+        if cname_index is not None and old_spilo.elb is not None:
+            dns = get_dns_names(cname_index, old_spilo.elb['dns_name'])
+        new_spilos.append(old_spilo._replace(dns=dns, instances=spilo_instances))
     return new_spilos
 
 
-def get_spilos(region, clusters=None, details=False):
-    global ec2
-    global elb_conn
+def get_spilos_in_regions(regions, clusters=None, concurrency=DEFAULT_CONCURRENCY, ttl=DEFAULT_TTL, refresh=False,
+                          match='regex'):
+    """Finds the spilos in all the regions at once, so it takes as long as the slowest region
+
+    The CNAME index is the same for every region, as Route 53 is a global service, it is built only once"""
+
+    regions = list(regions)
+    cname_index = SharedResult(lambda: get_cname_index(regions[0], concurrency))
+
+    def get_region_spilos(region):
+        return get_spilos(region, clusters, concurrency=concurrency, ttl=ttl, refresh=refresh, match=match,
+                          cname_index=cname_index)
+
+    return [s for spilos in parallel_map(get_region_spilos, regions, len(regions)) for s in spilos]
 
-    if len(clusters) == 0:
+
+def iter_spilos_in_regions(regions, clusters=None, concurrency=DEFAULT_CONCURRENCY, ttl=DEFAULT_TTL, refresh=False,
+                           match='regex'):
+    """Like get_spilos_in_regions, but yields the spilos of all regions as soon as they are found
+
+    Every region has a thread of its own feeding a queue, so the spilos of different regions are interleaved"""
+
+    import queue
+
+    regions = list(regions)
+    cname_index = SharedResult(lambda: get_cname_index(regions[0], concurrency))
+    results = queue.Queue()
+    done = object()
+
+    def produce(region):
+        try:
+            for spilo in iter_spilos(region, clusters, concurrency=concurrency, ttl=ttl, refresh=refresh, match=match,
+                                     cname_index=cname_index):
+                results.put(spilo)
+        except Exception as e:
+            results.put(e)
+        results.put(done)
+
+    for region in regions:
+        threading.Thread(target=produce, args=(region,), daemon=True).start()
+
+    running = len(regions)
+    while running > 0:
+        result = results.get()
+        if result is done:
+            running -= 1
+        elif isinstance(result, Exception):
+            raise result
+        else:
+            yield result
+
+
+def get_spilos(region, clusters=None, details=False, concurrency=DEFAULT_CONCURRENCY, ttl=DEFAULT_TTL,
+               refresh=False, match='regex', cname_index=None):
+    return list(iter_spilos(region, clusters, concurrency=concurrency, ttl=ttl, refresh=refresh, match=match,
+                            cname_index=cname_index))
+
+
+def iter_spilos(region, clusters=None, concurrency=DEFAULT_CONCURRENCY, ttl=DEFAULT_TTL, refresh=False, match='regex',
+                cname_index=None):
+    """Yields the spilos in the region as soon as they are found, the cache is updated once all have been found"""
+
+    if clusters is not None and len(clusters) == 0:
         clusters = None
-    if isinstance(clusters, str):
-        clusters = [clusters]
+    matcher = None if clusters is None else Matcher(clusters, match)
+    selection = None if matcher is None else [matcher.mode] + sorted(matcher.patterns)
 
+    # # The cache is stored under the resolved region, so that is where we look. A region we have cached spilos for has
+    # # been validated before, so we do not need senza to check it
     region = get_region(region)
+    records = None if refresh else load_spilos(region, ttl, selection=selection)
+    if records is not None:
+        spilos = filter_spilos([spilo_from_record(r, region) for r in records], matcher)
+
+        # # The cluster we are looking for may have been created after we filled the cache
+        if len(spilos) > 0 or matcher is None:
+            yield from spilos
+            return
+
     check_credentials(region)
-    if ec2 is None:
-        ec2 = boto.ec2.connect_to_region(region)
-    cf = boto.cloudformation.connect_to_region(region)
-    elb_conn = boto.ec2.elb.connect_to_region(region)
-    route53 = boto.route53.connect_to_region(region)
 
-    zones = route53.get_zones()
+    if isinstance(cname_index, SharedResult):
+        cname_index = cname_index.get()
 
-    # # Getting a "DNSServerError: 400 Bad Request" when adding type='CNAME' to the below function call
-    route53_records = route53.get_all_rrsets(hosted_zone_id=zones[0].id)
+    # # When looking for specific clusters, only the stacks which may match are discovered
+    spilos = list()
+    for spilo in iter_discover_spilos(region, concurrency, cname_index, matcher=matcher, remember=bool(ttl),
+                                      refresh=refresh, ttl=ttl):
+        spilos.append(spilo)
+        yield from filter_spilos([spilo], matcher)
+
+    if ttl:
+        if matcher is None:
+            store_spilos(region, [spilo_to_record(s) for s in spilos])
+        else:
+            add_spilos(region, [spilo_to_record(s) for s in spilos], ttl, selection=selection)
 
-    cname_records = list()
 
-    for rr in route53_records:
-        if rr.type == 'CNAME':
-            cname_records.append({'name': rr.name, 'resource_records': rr.resource_records})
+def filter_spilos(spilos, matcher=None):
+    if matcher is None:
+        return spilos
+    if not isinstance(matcher, Matcher):
+        matcher = Matcher(matcher)
 
-    spilos = list()
+    return [s for s in spilos if matcher.search(s.elb['dns_name'], s.version, *s.dns)]
+
+
+def spilo_to_record(spilo):
+    return {'stack_name': spilo.stack_name, 'version': spilo.version, 'dns': spilo.dns, 'elb': spilo.elb,
+            'vpc_id': spilo.vpc_id, 'stack_id': spilo.stack.stack_id, 'name': spilo.stack.name}
+
+
+def spilo_from_record(record, region=None):
+    stack = CachedStack(stack_name=record['stack_name'], stack_id=record['stack_id'], name=record['name'],
+                        version=record['version'])
+    return Spilo(stack_name=record['stack_name'], version=record['version'], dns=record['dns'], elb=record['elb'],
+                 instances=None, vpc_id=record['vpc_id'], stack=stack, region=region)
+
+
+def get_cname_index(region, concurrency=DEFAULT_CONCURRENCY):
+    return build_cname_index(get_connections(region).route53, concurrency)
+
+
+def discover_spilos(region, concurrency=DEFAULT_CONCURRENCY, cname_index=None, matcher=None, remember=True,
+                    refresh=False, ttl=DEFAULT_TTL):
+    return list(iter_discover_spilos(region, concurrency, cname_index, matcher, remember, refresh, ttl))
+
+
+def iter_discover_spilos(region, concurrency=DEFAULT_CONCURRENCY, cname_index=None, matcher=None, remember=True,
+                         refresh=False, ttl=DEFAULT_TTL):
+    """Finds all the spilos in the region, or only those which may be matched by the matcher
+
+    The spilos are yielded as soon as their stack has been resolved, in the order of the stacks. Stacks which are not
+    a spilo are remembered, they are only looked at again after they have changed or after ttl seconds. With refresh
+    all stacks are looked at, without remember we neither use nor update what we remember."""
+
+    # # The per stack lookups are done by a pool of workers, every worker gets its own connections
+    connections = get_connections(region)
+    cf_connections = connections.cloudformation
+    elb_connections = connections.elb
+
+    if cname_index is None:
+        cname_index = get_cname_index(region, concurrency)
 
     # # How to recognize a Spilo: There are a few things we can use to determine which stack is a spilo
     # # The name itself is very volatile, therefore not a good candidate.
     # # Stacks containing a PostgresLoadBalancer are deemed to be a spilo, q:x
 
     # # We try to do as little work as possible. Therefore we try to filter out non-matching stacks asap
-    stacks = list()
-    for stack in get_stacks(stack_refs=None, region=region, all=True):
-        res = get_spilo_resources(stack, cf)
-        if res is not None:
-            stacks.append((stack, res))
-
-    for stack, resources in stacks:
-        stack_name = stack.name
-        version = stack.version
-        elb = None
-        instances = None
-        vpc_id = None
-        dns = list()
+    stacks = list(get_stacks(stack_refs=None, region=region, all=True))
+    candidates = preselect_stacks(stacks, matcher, cname_index, region)
+    if len(candidates) < len(stacks):
+        logging.debug('Only looking at {} of {} stacks matching {}'.format(len(candidates), len(stacks), matcher))
 
+    known = load_non_spilos(region, ttl) if remember and not refresh else dict()
+    if known:
+        candidates = [s for s in candidates if known.get(s.stack_id) != stack_signature(s)]
+        logging.debug('{} stacks are known not to be a spilo'.format(len(known)))
+
+    def resolve_stack(stack):
+        """Returns the spilos of the stack, or None if it is not a spilo"""
+
+        resources = get_spilo_resources(stack, cf_connections.get())
+        if resources is None:
+            return None
+
+        spilos = list()
         for resource in resources:
-            if resource.logical_resource_id == 'PostgresLoadBalancer':
-                info = elb_conn.get_all_load_balancers(load_balancer_names=[resource.physical_resource_id])[0]
-                elb = {'name': info.name, 'dns_name': info.dns_name}
-                vpc_id = info.vpc_id
+            if resource.logical_resource_id != 'PostgresLoadBalancer':
+                continue
+            info = call_with_backoff(elb_connections.get().get_all_load_balancers,
+                                     load_balancer_names=[resource.physical_resource_id])[0]
+            elb = {'name': info.name, 'dns_name': info.dns_name}
+            spilos.append(Spilo(stack_name=resource.stack_name, version=stack.version, elb=elb, instances=None,
+                                dns=get_dns_names(cname_index, info.dns_name), vpc_id=info.vpc_id, stack=stack,
+                                region=region))
+        return spilos
+
+    # # The resources and load balancer of a stack are looked up by the same worker, so a spilo is complete as soon
+    # # as its stack is. Results are yielded in order, a slow stack holds back the ones after it.
+    non_spilos = list()
+    for stack, spilos in zip(candidates, parallel_imap(resolve_stack, candidates, concurrency)):
+        if spilos is None:
+            non_spilos.append(stack)
+            continue
+        yield from spilos
+
+    if remember:
+        # # We only remember stacks which are still there and have not changed, and of the new ones we only
+        # # remember those we actually looked at
+        signatures = {s.stack_id: stack_signature(s) for s in stacks}
+        remembered = {i: signature for i, signature in known.items() if signatures.get(i) == signature}
+        for stack in non_spilos:
+            if is_stable(stack):
+                remembered[stack.stack_id] = signatures[stack.stack_id]
+        if remembered != known:
+            store_non_spilos(region, remembered, renew=not known)
+
+
+def get_dns_names(cname_index, dns_name):
+    """Returns the aliases of the load balancer, or its own dns name if it has none"""
+
+    return list(cname_index.get(dns_name, list())) or [dns_name]
+
+
+def is_cached(spilo):
+    return isinstance(spilo.stack, CachedStack)
+
+
+def forward_reachable(port, timeout=3):
+    """Checks whether Patroni answers through the tunnel, ssh closes the forward if it cannot reach the host"""
 
-                dns = [info.dns_name]
+    try:
+        with socket.create_connection(('127.0.0.1', port), timeout=timeout) as sock:
+            sock.sendall(b'GET / HTTP/1.0\r\n\r\n')
+            return len(sock.recv(1)) > 0
+    except socket.timeout:
+        # # A slow answer does not mean the host has gone
+        return True
+    except OSError:
+        return False
 
-                for record in cname_records:
-                    for rr in record['resource_records']:
-                        if rr == info.dns_name:
-                            dns.append(record['name'][:-1])
 
-                if clusters is None or re_search(clusters, dns) or re_search(clusters, stack.version):
-                    if len(dns) > 1:
-                        dns.pop(0)
-                    spilos.append(Spilo(stack_name=resource.stack_name, version=stack.version, elb=elb,
-                                  instances=instances, dns=dns, vpc_id=vpc_id, stack=stack))
+def get_stack_instance_details(stack, connections):
+    instances_info = \
+        connections.ec2.get().get_only_instances(filters={'tag:aws:cloudformation:stack-id': stack.stack_id})
+    instances_health = connections.elb.get().describe_instance_health(stack.stack_name)
 
-    return spilos
+    return join_instance_details(instances_info, instances_health)
 
 
-def get_stack_instance_details(stack):
-    global ec2
-    global elb_conn
+def get_instance_details(stacks, connections, concurrency=DEFAULT_CONCURRENCY):
+    """Batched version of get_stack_instance_details, returns the instance details of every stack
+
+    The instances of all stacks are fetched using a single (filtered) EC2 call, the health of the instances is
+    fetched per load balancer in parallel."""
+
+    stacks = list(stacks)
+    instances_info = get_instances_by_stack(connections.ec2.get(), [stack.stack_id for stack in stacks])
+
+    def get_health(stack):
+        return call_with_backoff(connections.elb.get().describe_instance_health, stack.stack_name)
+
+    instances_health = parallel_map(get_health, stacks, concurrency)
+
+    return [join_instance_details(instances_info.get(stack.stack_id, list()), health)
+            for stack, health in zip(stacks, instances_health)]
 
-    instances_info = \
-        ec2.get_only_instances(filters={'tag:aws:cloudformation:stack-id': stack.stack_id})
-    instances_health = elb_conn.describe_instance_health(stack.stack_name)
+
+def join_instance_details(instances_info, instances_health):
+    states = {ih.instance_id: ih.state for ih in instances_health}
 
     instances = list()
     for ii in instances_info:
-        for ih in instances_health:
-            if ih.instance_id == ii.id:
-                instance = {'instance_id': ii.id, 'private_ip': ii.private_ip_address,
-                            'launch_time': parse_time(ii.launch_time)}
+        if ii.id in states:
+            instance = {'instance_id': ii.id, 'private_ip': ii.private_ip_address,
+                        'launch_time': parse_time(ii.launch_time), 'health': states[ii.id]}
 
-                if ih.state == 'InService':
-                    instance['role'] = 'MASTER'
-                else:
-                    instance['role'] = 'REPLICA'
+            if states[ii.id] == 'InService':
+                instance['role'] = 'MASTER'
+            else:
+                instance['role'] = 'REPLICA'
 
-                instances.append(instance)
+            instances.append(instance)
 
     instances.sort(key=lambda k: (k['role'], k['instance_id']))
 
@@ -365,142 +980,99 @@ def parse_time(s: str) -> float:
         return None
 
 
-def list_tunnels(cluster):
-    processes = get_my_processes()
+def find_tunnels(cluster=None, match='regex'):
+    """Returns the registry entries of the running tunnels, of the matching clusters only if a cluster is given
+
+    If a supervisor is running, it tells us how the tunnels are doing, otherwise we check which ssh are running"""
+
+    processes = supervised_tunnels()
+    if processes is None:
+        processes = get_tunnels()
     processes.sort(key=lambda k: k['cluster'])
 
+    if cluster is not None:
+        matcher = Matcher(cluster, match)
+        return [p for p in processes if matcher.search(p['host'], p.get('service', ''))]
+    return processes
+
+
+def list_tunnels(cluster, match='regex', output='table'):
+    rows = find_tunnels(cluster, match)
+
     columns = [
         'pid',
         'host',
         'service',
         'dsn',
     ]
+    if any('state' in r for r in rows):
+        columns += ['state', 'restarts']
 
-    rows = list()
-    if cluster is not None:
-        for p in processes:
-            if re.search(cluster, p['host']) or re.search(cluster, p.get('service', '')):
-                rows.append(p)
+    if output in ('json', 'yaml'):
+        print_records(rows, output)
+    elif output == 'tsv':
+        print_tsv(columns, rows)
     else:
-        rows = processes
-
-    print_table(columns, rows, styles=STYLES, titles=TITLES)
-
-
-def get_my_processes():
-    # # We do not use psutil for processes, as environment variables of processes is not
-    # # available from it. We will just use good old ps for the task
-
-    ps_cmd = [
-        'ps',
-        'e',
-        '-eww',
-        '-U',
-        getpass.getuser(),
-        '-A',
-        '-o',
-        'pid,command',
-    ]
-
-    ps_output = subprocess.check_output(ps_cmd, shell=False, stderr=subprocess.DEVNULL,
-                                        env={'LANG': 'C'}).splitlines()
-    ps_output.reverse()
-
-    processes = list()
-
-    process_re = re.compile('^\s*(\d+)\s+([^\s]+).*SPILOCLUSTER=([^\s]*)')
-    pgport_re = re.compile('SPILOPGPORT=(\d+)')
-    patroniport_re = re.compile('SPILOPATRONIPORT=(\d+)')
-    service_re = re.compile('SPILOSERVICE=(\w*)')
-    host_re = re.compile('SPILOHOST=([^\s]*)')
-    vpc_re = re.compile('SPILOVPCID=([^\s]*)')
-
-    # # We cannot disable the header on every ps (Mac OS X for example), the first line is a header
-    line = ps_output.pop()
-    while len(ps_output) > 0:
-        line = ps_output.pop().decode('utf-8')
-
-        match = process_re.search(line)
-        if match:
-            logging.debug('Matched line: {}'.format(line[0:120]))
-            process = dict()
-            process['pid'] = match.group(1)
-            process['process'] = match.group(2)
-            process['cluster'] = match.group(3)
-
-            match = process_re.match(line)
-
-            process['pid'] = match.group(1)
-            process['process'] = match.group(2)
-
-            match = pgport_re.search(line)
-            if match:
-                process['pgport'] = match.group(1)
-
-            match = patroniport_re.search(line)
-            if match:
-                process['patroniport'] = match.group(1)
-
-            match = host_re.search(line)
-            if match:
-                process['host'] = match.group(1)
+        print_table(columns, rows, styles=STYLES, titles=TITLES)
 
-            match = vpc_re.search(line)
-            if match:
-                process['vpc_id'] = match.group(1)
 
-            match = service_re.search(line)
-            if match:
-                process['service'] = match.group(1)
-
-            logging.debug('Process: {}'.format(process))
-
-            service_dsn = process.get('service')
-            if service_dsn is None:
-                service_dsn = ''
-            else:
-                service_dsn = ' service={}'.format(service_dsn)
-
-            process['dsn'] = '"host=localhost port={}{}"'.format(process['pgport'], service_dsn)
-            processes.append(process)
-        else:
-
-            # logging.debug("Disregarding line: {}".format(line))
-            pass
+@cli.command('supervisor', short_help='Supervise all tunnels')
+@click.option('--interval', type=click.FLOAT, envvar='SPILO_SUPERVISOR_INTERVAL', default=CHECK_INTERVAL,
+              metavar='SECS', help='Check the tunnels every SECS seconds')
+@option_log_level
+def supervisor(**options):
+    """Restarts the tunnels which have died on the same local ports, and serves their status to tunnel --list"""
 
-    logging.debug('Processes : {}'.format(pretty(processes)))
-    return processes
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=options['log_level'])
+    try:
+        Supervisor(options['interval']).run()
+    except KeyboardInterrupt:
+        pass
 
 
 @cli.command('tunnel', short_help='Create a tunnel')
 @click.option('--background/--no-background', default=True, help='Push the tunnel in the background')
 @click.option('--kill', help='Kill the tunnel for the specified cluster', is_flag=True)
 @click.option('--list', help='List all the tunnels that are available', is_flag=True)
+@click.option('--adopt', is_flag=True,
+              help='Register the running tunnels spilo does not know about, e.g. those started by an older spilo')
+@click.option('--output', type=click.Choice(['table', 'json', 'tsv', 'yaml']), default='table',
+              help='The format of the list of tunnels')
 @option_reuse
+@option_multiplex
+@option_supervise
+@option_tunnel_timeout
 @option_port
 @option_pg_service_file
 @option_odd_config_file
 @option_region
+@option_concurrency
+@option_cache_ttl
+@option_refresh
+@option_match
 @option_log_level
 @cluster_argument
 def tunnel(**options):
     """Sets up a tunnel to use for connecting to Spilo"""
 
-    global tunnels
-
     process_options(options)
 
+    if options['adopt']:
+        # # Only on request, as it means scanning all our processes
+        for entry in adopt_tunnels():
+            print('Adopted tunnel with pid={} on port {}'.format(entry['pid'], entry['pgport']))
+
     if options['list']:
-        list_tunnels(options['cluster'])
+        list_tunnels(options['cluster'], options['match'], options['output'])
         sys.exit(0)
 
     if options['kill']:
-        pid = get_tunnel(options['cluster'], reuse=True, create=False)
-        if pid is None:
+        entry = find_tunnel(options['cluster'])
+        if entry is None:
             logging.warning("There was no tunnel to kill")
         else:
-            print("Terminating process with pid={}".format(pid))
-            os.kill(int(pid), signal.SIGKILL)
+            print("Terminating tunnel with pid={}".format(entry['pid']))
+            kill_tunnel(entry)
         sys.exit(0)
 
     tunnel_pid = get_tunnel(options['cluster'], options['reuse'])
@@ -538,46 +1110,56 @@ export PGPORT={port}
     sys.exit(0)
 
 
+def print_table(cols, rows, styles=None, titles=None):
+    from clickclick.console import print_table
+    print_table(cols, rows, styles=styles, titles=titles)
+
+
 def pretty(something):
     return json.dumps(something, sort_keys=True, indent=4)
 
 
-def get_pg_service():
+def get_pg_service(opts=None):
     """Reads all the services from all the pg service files it can find"""
 
+    opts = options if opts is None else opts
+
     # # http://www.postgresql.org/docs/current/static/libpq-pgservice.html
     # #
     # # There are some precedence rules which we want to honour.
 
-    if options.get('cluster') is None:
+    if opts.get('cluster') is None:
         return None, dict()
 
     filenames = list()
 
-    if options.get('pg_service_file') is not None:
-        filenames.append(options['pg_service_file'])
+    if opts.get('pg_service_file') is not None:
+        filenames.append(opts['pg_service_file'])
     else:
         filenames.append('~/.pg_service.conf')
         filenames.append('~/pg_service.conf')
-        if filenames.append(os.environ.get('PGSYSCONFDIR')) is not None:
-            filenames.append(os.environ.get('PGSYSCONFDIR') + '/pg_service.conf')
+        if os.environ.get('PGSYSCONFDIR') is not None:
+            filenames.append(os.path.join(os.environ['PGSYSCONFDIR'], 'pg_service.conf'))
         filenames.append('/etc/pg_service.conf')
 
     filenames = [os.path.expanduser(f) for f in filenames if f is not None]
 
-    logging.debug(pretty(options))
+    logging.debug(pretty(opts))
 
     defaults = dict()
-    defaults['port'] = options.get('port', 5432)
-    defaults['host'] = options['cluster']
+    defaults['port'] = opts.get('port', 5432)
+    defaults['host'] = opts['cluster']
 
     parser = configparser.ConfigParser(defaults=defaults)
 
-    services = [options['cluster'], 'spilo']
-    parsed = parser.read(filenames)
-    logging.debug('Read pg_service definitions from the following files: {}'.format(parsed))
+    # # Reading the files one after the other into the same parser, later files add to and override the sections
+    # # of earlier files, just like reading them all at once
+    parsed = parse_files('pg_service', filenames, parse_pg_service_file)
+    for _, sections in parsed:
+        parser.read_dict(sections)
+    logging.debug('Read pg_service definitions from the following files: {}'.format([f for f, _ in parsed]))
 
-    pg_service = dict()
+    services = [opts['cluster'], 'spilo']
 
     for service in services:
         if parser.has_section(service):
@@ -587,130 +1169,246 @@ def get_pg_service():
     return None, dict(parser.items('DEFAULT', raw=True))
 
 
-def load_odd_config():
+def parse_pg_service_file(filename):
+    """Returns the sections of a single service file, including its DEFAULT section"""
+
+    # # No section header can be empty, so with this default section [DEFAULT] is returned like any other section
+    parser = configparser.ConfigParser(default_section='', interpolation=None)
+    with open(filename, 'r') as f:
+        parser.read_file(f)
+    return {section: dict(parser.items(section)) for section in parser.sections()}
+
+
+def load_odd_config(opts=None):
+    opts = options if opts is None else opts
     odd_config = {'user_name':None, 'odd_host':None}
 
-    if options.get('odd_config_file') is not None and os.path.isfile(options['odd_config_file']):
-        with open(options['odd_config_file'], 'r') as f:
-            odd_config = yaml.load(f)
-        logging.debug('Loaded odd configuration from {}:\n{}'.format(options['odd_config_file'], pretty(odd_config)))
+    if opts.get('odd_config_file') is not None and os.path.isfile(opts['odd_config_file']):
+        for _, odd_config in parse_files('odd_config', [opts['odd_config_file']], parse_yaml_file):
+            logging.debug('Loaded odd configuration from {}:\n{}'.format(opts['odd_config_file'], pretty(odd_config)))
 
     return odd_config
 
 
+def parse_yaml_file(filename):
+    import yaml
+
+    with open(filename, 'r') as f:
+        return yaml.safe_load(f)
+
+
+def is_usable(entry):
+    """A registered tunnel we can connect through, its supervisor may be alive while it gave up restarting ssh"""
+
+    return is_alive(entry['pid']) or is_listening(entry['pgport'])
+
+
+def find_tunnel(service_name, usable=False):
+    """Returns a running tunnel to the service, with usable only one we can connect through
+
+    Tunnels which are not usable are stopped and unregistered, so a new one can be started in their place"""
+
+    processes = [p for p in get_tunnels() if service_name in p['host'] or service_name == p.get('service')]
+    if usable:
+        for entry in [p for p in processes if not is_usable(p)]:
+            logging.warning('Tunnel on port {} is down, not reusing it'.format(entry['pgport']))
+            kill_tunnel(entry)
+        processes = [p for p in processes if is_usable(p)]
+
+    if len(processes) > 0:
+        logging.info('Found a tunnel which is available: {}'.format(pretty(processes)))
+        return processes[0]
+
+    return None
+
+
+def kill_tunnel(entry):
+    """Stops a tunnel, a multiplexed tunnel only has its forwards removed as the master may be shared
+
+    The tunnel is unregistered first, so a supervisor does not restart it"""
+
+    entry = pop_tunnel(entry['pgport']) or entry
+    if entry.get('destination') is not None:
+        try:
+            cancel_forwards(entry['destination'], entry['forwards'])
+        except Exception as e:
+            logging.warning('Could not cancel the forwards of the tunnel: {}'.format(e))
+    else:
+        try:
+            os.kill(int(entry['pid']), signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+
+def start_tunnel(spilo, destination, env, ports, multiplex=False, pg_port=5432, timeout=READY_TIMEOUT):
+    """Starts the ssh forwards to the spilo on the given local ports, and registers the tunnel once it works"""
+
+    postgres_port, patroni_port = ports
+    logging.debug('Postgres tunnel port: {}, Patroni tunnel port: {}'.format(*ports))
+
+    env['SPILOPGPORT'] = str(postgres_port)
+    forwards = ['{}:{}:{}'.format(postgres_port, spilo.dns[0], str(pg_port))]
+
+    env['SPILOPATRONIPORT'] = str(patroni_port)
+    port = 8008
+    forwards.append('{}:{}:{}'.format(patroni_port, spilo.dns[0], str(port)))
+
+    spilo_env = {k: v for k, v in env.items() if k.startswith('SPILO')}
+
+    if multiplex:
+        logging.info('Adding forwards {} to the master connection to {}'.format(forwards, destination))
+        add_forwards(destination, forwards)
+        pid = ensure_master(destination)
+        tunnel = None
+        stderr = None
+        extra = {'destination': destination, 'forwards': forwards}
+    else:
+        ssh_cmd = tunnel_command(destination, forwards)
+
+        logging.info('Setting up tunnel command: {}, env={}'.format(ssh_cmd, pretty(env)))
+
+        # # The errors of ssh end up in an unnamed file, a pipe could fill up or break once we are gone
+        stderr = tempfile.TemporaryFile()
+        tunnel = subprocess.Popen(ssh_cmd, shell=False, stderr=stderr, stdin=subprocess.DEVNULL, env=env)
+        pid = tunnel.pid
+        # # With the command the supervisor can restart the tunnel on the same ports
+        extra = {'ssh': ssh_cmd}
+
+    try:
+        latency = wait_for_tunnel(postgres_port, tunnel, stderr, timeout)
+    except:
+        if tunnel is None:
+            cancel_forwards(destination, forwards)
+        elif tunnel.returncode is None:
+            tunnel.kill()
+        raise
+    finally:
+        if stderr is not None:
+            stderr.close()
+
+    logging.debug('Established connectivity on tunnel after {} seconds'.format(latency))
+    extra['latency'] = round(latency, 3)
+
+    return register_tunnel(pid, spilo_env, extra), tunnel
+
+
+class MultipleSpilos(Exception):
+    """More than one spilo matches the cluster we were asked to set up a tunnel to"""
+
+    def __init__(self, cluster, spilos):
+        Exception.__init__(self, 'Multiple candidates starting with {}: {}'.format(
+                           cluster, ', '.join(s.version for s in spilos)))
+        self.spilos = spilos
+
+
 def get_tunnel(service_name=None, reuse=True, create=True):
     if service_name is None:
         return
 
-    processes = get_my_processes()
+    if options.get('supervise', False):
+        ensure_supervisor()
 
-    processes = [p for p in processes if service_name in p['host']]
-
-    if reuse and len(processes) > 0:
-        logging.info('Found a tunnel which is available: {}'.format(pretty(processes)))
-        tunnels['postgres'] = processes[0]['pgport']
-        tunnels['patroni'] = processes[0]['patroniport']
-        return processes[0]['pid']
+    if reuse:
+        entry = find_tunnel(service_name, usable=True)
+        if entry is not None:
+            tunnels['postgres'] = entry['pgport']
+            tunnels['patroni'] = entry['patroniport']
+            return entry['pid']
 
     if not create:
         return None
 
-    if service_name == pg_service_name:
-        host = pg_service.get('hostaddr') or pg_service.get('host') or pg_service_name
+    context = Context(options=options, pg_service_name=pg_service_name, pg_service=pg_service, odd_config=odd_config)
+    try:
+        entry, tunnel = open_spilo_tunnel(service_name, context)
+    except MultipleSpilos as e:
+        logging.error('Multiple candidates starting with {}:\n'.format(options['cluster']))
+        print_spilos(e.spilos)
+        sys.exit(1)
+
+    tunnels['postgres'] = int(entry['pgport'])
+    tunnels['patroni'] = int(entry['patroniport'])
+
+    if not options.get('background', False):
+        if tunnel is None:
+            managed_tunnels.append(entry)
+        else:
+            managed_processes['tunnel'] = tunnel
+
+    return int(entry['pid']) if tunnel is None else tunnel.pid
+
+
+def open_spilo_tunnel(service_name, context):
+    """Sets up a new tunnel to the service, returns its registry entry and the ssh process if we started one
+
+    Only the context is used, not the globals of the command line, so a single process can set up many tunnels"""
+
+    opts = context.options
+
+    if service_name == context.pg_service_name:
+        pg_service = context.pg_service
+        host = pg_service.get('hostaddr') or pg_service.get('host') or context.pg_service_name
         spilo = Spilo(stack_name=None, version=None, dns=[host], elb=None, instances=None, vpc_id=None, stack=None)
     else:
-        spilos = get_spilos(options['region'], [service_name])
+        spilos = get_spilos(opts.get('region'), [service_name],
+                            concurrency=opts.get('concurrency', DEFAULT_CONCURRENCY),
+                            ttl=opts.get('cache_ttl', DEFAULT_TTL), refresh=opts.get('refresh', False),
+                            match=opts.get('match', 'regex'))
         if len(spilos) == 0:
-            raise Exception('Could not find a spilo cluster beginning with {}'.format(options['cluster']))
-
+            raise Exception('Could not find a spilo cluster beginning with {}'.format(service_name))
         if len(spilos) > 1:
-            logging.error('Multiple candidates starting with {}:\n'.format(options['cluster']))
-            print_spilos(spilos)
-            sys.exit(1)
+            raise MultipleSpilos(service_name, spilos)
         spilo = spilos[0]
 
-    # # We open 2 sockets and let the OS pick a free port for us
-    # # later on we will use these ports for portforwarding
-    pg_socket = socket.socket()
-    pg_socket.bind(('', 0))
-    tunnels['postgres'] = int(pg_socket.getsockname()[1])
-    logging.debug('Postgres tunnel port: {}'.format(tunnels['postgres']))
-
-    patroni_socket = socket.socket()
-    patroni_socket.bind(('', 0))
-    tunnels['patroni'] = int(patroni_socket.getsockname()[1])
-    logging.debug('tunnel port: {}'.format(tunnels['postgres']))
-
-    ssh_cmd = ['ssh']
-    if odd_config.get('user_name') is not None:
-        ssh_cmd += ['{}@{}'.format(odd_config['user_name'], odd_config['odd_host'])]
-    else:
-        ssh_cmd += [odd_config.get('odd_host') or '']
+    destination = ssh_destination(context.odd_config)
+    multiplex = opts.get('multiplex', False)
 
     env = os.environ.copy()
     env['SPILOCLUSTER'] = spilo.version or ''
     env['SPILOHOST'] = spilo.dns[0]
-    env['SPILOSERVICE'] = pg_service_name or ''
+    env['SPILOSERVICE'] = context.pg_service_name or ''
     env['SPILOVPCID'] = spilo.vpc_id or ''
 
-    logging.debug('Testing ssh access using cmd:{}'.format(ssh_cmd))
-    test = subprocess.check_output(ssh_cmd + ['printf t3st'], shell=False, stderr=subprocess.DEVNULL)
+    if multiplex:
+        # # The reachability test reuses the master connection, so it does not cost another ssh handshake
+        ensure_master(destination)
+        logging.debug('Testing ssh access using the master connection to {}'.format(destination))
+        test = run_over_master(destination, 'printf t3st')
+    else:
+        logging.debug('Testing ssh access using cmd:{}'.format(['ssh', destination]))
+        test = subprocess.check_output(['ssh', destination, 'printf t3st'], shell=False, stderr=subprocess.DEVNULL)
     if test != b't3st':
         logging.error('Could not setup a working tunnel. You may need to request access using piu')
         raise Exception(str(test))
 
+    logging.debug(context.pg_service)
+    pg_port = context.pg_service.get('port') or opts.get('port', 5432)
 
-    # We will close the opened socket as late as possible, to prevent other processes from occupying this port
-    patroni_socket.close()
-    pg_socket.close()
-
-    ssh_cmd.append('-L')
-    logging.debug(pg_service)
-
-    env['SPILOPGPORT'] = str(tunnels['postgres'])
-    port = str(pg_service['port'] or options['port'])
-    ssh_cmd.append('{}:{}:{}'.format(tunnels['postgres'], spilo.dns[0], str(port)))
-
-    ssh_cmd.append('-L')
-    env['SPILOPATRONIPORT'] = str(tunnels['patroni'])
-    port = 8008
-    ssh_cmd.append('{}:{}:{}'.format(tunnels['patroni'], spilo.dns[0], str(port)))
-
-    ssh_cmd.append('-N')
-
-    logging.info('Setting up tunnel command: {}, env={}'.format(ssh_cmd, pretty(env)))
-
-    tunnel = subprocess.Popen(ssh_cmd, shell=False, stderr=subprocess.DEVNULL, stdin=subprocess.DEVNULL, env=env)
-    tunnel.poll()
-    if tunnel.returncode is not None:
-        raise Exception('Tunnel not running anymore, exitcode tunnel: {}'.format(tunnel.returncode))
-
-    # # Wait for the tunnel to be available
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    conn_test = '127.0.0.1', tunnels['postgres']
-    result = sock.connect_ex(conn_test)
-
-    timeout = 5
-    epoch_time = time.time()
-    threshold_time = time.time() + timeout
-
-    # # Loop until connection is established
-    while result != 0:
-        time.sleep(0.1)
-        result = sock.connect_ex(conn_test)
-        if time.time() > threshold_time:
-            raise Exception('Tunnel was not established within timeout of {} seconds'.format(timeout))
+    # # Another program may still grab one of our reserved ports before ssh binds it, in which case we try again
+    for attempt in range(1, PORT_ATTEMPTS + 1):
+        ports = reserve_ports(2)
+        try:
+            entry, tunnel = start_tunnel(spilo, destination, env, ports, multiplex, pg_port,
+                                         opts.get('tunnel_timeout', READY_TIMEOUT))
             break
+        except Exception as e:
+            if attempt == PORT_ATTEMPTS or 'in use' not in str(e):
+                raise
+            logging.info('Local port was taken, retrying: {}'.format(e))
+        finally:
+            release_ports(ports)
 
-    sock.close()
-
-    logging.debug('Established connectivity on tunnel after {} seconds'.format(time.time() - epoch_time))
-
-    if not options.get('background', False):
-        managed_processes['tunnel'] = tunnel
+    if is_cached(spilo) and not forward_reachable(int(entry['patroniport'])):
+        logging.warning('Could not reach {} using the discovery cache, rediscovering'.format(spilo.dns[0]))
+        kill_tunnel(entry)
+        if tunnel is not None:
+            tunnel.wait()
+        invalidate_spilo(get_region(opts.get('region')), spilo.stack_name)
+        return open_spilo_tunnel(service_name, context._replace(options=dict(opts, refresh=True)))
 
-    return tunnel.pid
+    return entry, tunnel
 
 
 if __name__ == '__main__':
+    from senza.cli import handle_exceptions
     handle_exceptions(cli)()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import hashlib
+import logging
+import os
+import re
+import socket
+import subprocess
+import time
+
+from spilo.cache import CACHE_DIR
+
+# # Unix socket paths are limited to ~100 characters, we therefore use a short hash of the destination
+CONTROL_DIR = os.path.join(CACHE_DIR, 'ssh')
+CONTROL_PERSIST = '4h'
+
+# # While waiting for a tunnel we check the local port after READY_DELAY seconds, backing off to READY_MAX_DELAY
+READY_TIMEOUT = 5
+READY_DELAY = 0.01
+READY_MAX_DELAY = 0.25
+READY_BACKOFF = 1.5
+
+# # Without keepalives a tunnel through a bastion which went away hangs, instead of exiting so it can be restarted
+KEEPALIVE_OPTIONS = ['-o', 'ServerAliveInterval=15', '-o', 'ServerAliveCountMax=3']
+
+master_re = re.compile(r'Master running \(pid=(\d+)\)')
+
+
+def ssh_destination(odd_config):
+    if odd_config.get('user_name') is not None:
+        return '{}@{}'.format(odd_config['user_name'], odd_config['odd_host'])
+    return odd_config.get('odd_host') or ''
+
+
+def control_path(destination):
+    return os.path.join(CONTROL_DIR, hashlib.sha1(destination.encode('utf-8')).hexdigest()[:16])
+
+
+def control_command(destination, *args):
+    return ['ssh', '-S', control_path(destination)] + list(args) + [destination]
+
+
+def master_pid(destination):
+    """Returns the pid of the master connection to the destination, None if there is none"""
+
+    check = subprocess.run(control_command(destination, '-O', 'check'), stdin=subprocess.DEVNULL,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    match = master_re.search(check.stderr.decode('utf-8', 'replace'))
+    if check.returncode == 0 and match:
+        return int(match.group(1))
+    return None
+
+
+def ensure_master(destination, env=None):
+    """Makes sure there is a multiplexed master connection to the destination, and returns its pid
+
+    The master is running in the background and is shared by all the tunnels to the same odd host"""
+
+    pid = master_pid(destination)
+    if pid is not None:
+        logging.debug('Reusing ssh master connection to {} (pid={})'.format(destination, pid))
+        return pid
+
+    os.makedirs(CONTROL_DIR, mode=0o700, exist_ok=True)
+    # # The socket of a master which has died is left behind, ssh would then run without a control socket
+    if os.path.exists(control_path(destination)):
+        os.unlink(control_path(destination))
+
+    ssh_cmd = control_command(destination, '-M', '-f', '-N', '-o', 'ControlPersist={}'.format(CONTROL_PERSIST),
+                              *KEEPALIVE_OPTIONS)
+    logging.info('Starting ssh master connection: {}'.format(ssh_cmd))
+
+    master = subprocess.run(ssh_cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                            env=env)
+    if master.returncode != 0:
+        raise Exception('Could not start ssh master connection to {}: {}'.format(
+                        destination, master.stderr.decode('utf-8', 'replace').strip()))
+
+    pid = master_pid(destination)
+    if pid is None:
+        raise Exception('ssh master connection to {} is not running'.format(destination))
+    return pid
+
+
+def tunnel_command(destination, forwards):
+    """The ssh command running a tunnel of its own, with the forwards as given to ssh -L"""
+
+    # # ssh should exit, rather than keep running without the forward, if it cannot bind the port
+    ssh_cmd = ['ssh', destination, '-o', 'ExitOnForwardFailure=yes'] + KEEPALIVE_OPTIONS
+    for forward in forwards:
+        ssh_cmd += ['-L', forward]
+    ssh_cmd.append('-N')
+    return ssh_cmd
+
+
+def run_over_master(destination, command):
+    return subprocess.check_output(control_command(destination) + [command], stdin=subprocess.DEVNULL,
+                                   stderr=subprocess.DEVNULL)
+
+
+def add_forwards(destination, forwards):
+    """Adds local forwards (as given to ssh -L) to the master connection of the destination"""
+
+    _forward_command(destination, 'forward', forwards)
+
+
+def cancel_forwards(destination, forwards):
+    _forward_command(destination, 'cancel', forwards)
+
+
+def _forward_command(destination, command, forwards):
+    args = ['-O', command]
+    for forward in forwards:
+        args += ['-L', forward]
+
+    result = subprocess.run(control_command(destination, *args), stdin=subprocess.DEVNULL,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise Exception('Could not {} {} on ssh master connection to {}: {}'.format(
+                        command, ', '.join(forwards), destination, result.stderr.decode('utf-8', 'replace').strip()))
+
+
+def wait_for_tunnel(port, process=None, stderr=None, timeout=READY_TIMEOUT):
+    """Waits until the local end of the tunnel accepts connections, returns the number of seconds this took
+
+    While waiting we also watch the ssh process, if it exits we fail immediately with the error ssh reported."""
+
+    start = time.time()
+    deadline = start + timeout
+    delay = READY_DELAY
+
+    while True:
+        if process is not None and process.poll() is not None:
+            raise Exception('ssh exited with code {} before the tunnel was established: {}'.format(
+                            process.returncode, read_stderr(stderr)))
+
+        try:
+            socket.create_connection(('127.0.0.1', int(port)), timeout=max(0.1, deadline - time.time())).close()
+            return time.time() - start
+        except OSError:
+            pass
+
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise Exception('Tunnel was not established within timeout of {} seconds'.format(timeout))
+
+        if process is None:
+            time.sleep(min(delay, remaining))
+        else:
+            try:
+                # # Returns as soon as ssh exits
+                process.wait(min(delay, remaining))
+            except subprocess.TimeoutExpired:
+                pass
+        delay = min(delay * READY_BACKOFF, READY_MAX_DELAY)
+
+
+def read_stderr(stderr):
+    if stderr is None:
+        return ''
+    stderr.seek(0)
+    return stderr.read().decode('utf-8', 'replace').strip()
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Looks after all the registered tunnels, restarting ssh on the same local ports when a tunnel has died
+
+The status of the tunnels is served as json on a unix socket, so spilo tunnel --list does not need to scan the
+processes. Run it with spilo supervisor, or let spilo start it in the background with --supervise."""
+
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from spilo.cache import CACHE_DIR
+from spilo.processes import SPILO_VARIABLES
+from spilo.registry import is_alive, locked_registry, read_tunnels
+from spilo.ssh import READY_TIMEOUT, add_forwards, cancel_forwards, ensure_master, wait_for_tunnel
+
+SOCKET = os.path.join(CACHE_DIR, 'supervisor.sock')
+CHECK_INTERVAL = 10
+QUERY_TIMEOUT = 1
+
+
+def tunnel_environment(entry):
+    """The SPILO* variables of the tunnel, which we set again on the ssh we restart it with"""
+
+    env = {variable: entry[key] for key, variable in SPILO_VARIABLES if entry.get(key) is not None}
+    env['SPILOCLUSTER'] = entry.get('cluster') or ''
+    return env
+
+
+def is_listening(port, timeout=QUERY_TIMEOUT):
+    try:
+        socket.create_connection(('127.0.0.1', int(port)), timeout=timeout).close()
+        return True
+    except OSError:
+        return False
+
+
+class Supervisor(object):
+
+    def __init__(self, interval=CHECK_INTERVAL, registry=None, timeout=READY_TIMEOUT):
+        self.interval = interval
+        self.registry = registry
+        self.timeout = timeout
+        self.pid = os.getpid()
+        # # The status of every tunnel we look after, by local postgres port
+        self.status = dict()
+        # # The ssh processes we started, so we can reap them when they exit
+        self.processes = dict()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def adopt(self):
+        """Takes charge of all the registered tunnels, returns their entries"""
+
+        with locked_registry(self.registry) as entries:
+            for i, entry in enumerate(entries):
+                if entry.get('supervisor') != self.pid and is_alive(entry['pid']):
+                    entries[i] = dict(entry, supervisor=self.pid)
+            return [e for e in entries if e.get('supervisor') == self.pid]
+
+    def check(self):
+        """Checks every tunnel once, and restarts the ones which are down"""
+
+        for pgport, process in list(self.processes.items()):
+            if process.poll() is not None:
+                del self.processes[pgport]
+
+        entries = self.adopt()
+        ports = set(e['pgport'] for e in entries)
+
+        with self.lock:
+            for pgport in list(self.status):
+                if pgport not in ports:
+                    del self.status[pgport]
+
+        for entry in entries:
+            status = {'restarts': self.status.get(entry['pgport'], dict()).get('restarts', 0), 'error': None}
+            if is_alive(entry['pid']) and is_listening(entry['pgport']):
+                status.update(state='up', error=None)
+            else:
+                logging.warning('Tunnel to {} on port {} is down, restarting it'.format(entry.get('host'),
+                                                                                         entry['pgport']))
+                try:
+                    entry = self.restart(entry)
+                    status.update(state='up', error=None)
+                    status['restarts'] += 1
+                except Exception as e:
+                    logging.error('Could not restart tunnel on port {}: {}'.format(entry['pgport'], e))
+                    status.update(state='down', error=str(e))
+                if entry is None:
+                    continue
+            status['checked'] = time.time()
+            with self.lock:
+                self.status[entry['pgport']] = dict(entry, **status)
+
+    def restart(self, entry):
+        """Starts the tunnel again on the same local ports, returns its new entry or None if it was killed meanwhile"""
+
+        process = None
+        if entry.get('destination') is not None:
+            pid = ensure_master(entry['destination'])
+            try:
+                cancel_forwards(entry['destination'], entry['forwards'])
+            except Exception:
+                pass
+            add_forwards(entry['destination'], entry['forwards'])
+            wait_for_tunnel(entry['pgport'], timeout=self.timeout)
+        else:
+            if entry.get('ssh') is None:
+                raise Exception('The tunnel was started without recording its ssh command, it cannot be restarted')
+            if is_alive(entry['pid']):
+                # # ssh is running but the forward does not work, probably the connection hangs
+                os.kill(int(entry['pid']), signal.SIGKILL)
+            stderr = tempfile.TemporaryFile()
+            try:
+                process = subprocess.Popen(entry['ssh'], stderr=stderr, stdin=subprocess.DEVNULL,
+                                           env=dict(os.environ, **tunnel_environment(entry)))
+                wait_for_tunnel(entry['pgport'], process, stderr, self.timeout)
+            except:
+                if process is not None and process.poll() is None:
+                    process.kill()
+                    process.wait()
+                raise
+            finally:
+                stderr.close()
+            pid = process.pid
+
+        registered = False
+        with locked_registry(self.registry) as entries:
+            for i, e in enumerate(entries):
+                if e['pgport'] == entry['pgport']:
+                    entries[i] = dict(e, pid=str(pid), restarted=time.time())
+                    registered = True
+
+        if not registered:
+            logging.info('Tunnel on port {} was killed while we restarted it'.format(entry['pgport']))
+            if process is not None:
+                process.kill()
+                process.wait()
+            return None
+
+        if process is not None:
+            self.processes[entry['pgport']] = process
+        return dict(entry, pid=str(pid))
+
+    def get_status(self):
+        with self.lock:
+            return sorted(self.status.values(), key=lambda s: (s.get('cluster') or '', s['pgport']))
+
+    def run(self, path=None):
+        path = path or SOCKET
+        if query_status(path) is not None:
+            raise Exception('A supervisor is already running on {}'.format(path))
+        if os.path.exists(path):
+            os.unlink(path)
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+
+        supervisor = self
+
+        class Handler(socketserver.StreamRequestHandler):
+
+            def handle(self):
+                if self.rfile.readline().strip() == b'status':
+                    self.wfile.write(json.dumps(supervisor.get_status()).encode('utf-8'))
+
+        server = socketserver.ThreadingUnixStreamServer(path, Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, args=(0.1,), daemon=True).start()
+        logging.info('Supervising tunnels, status on {}'.format(path))
+
+        try:
+            while not self.stopped.is_set():
+                try:
+                    self.check()
+                except Exception as e:
+                    logging.exception('Checking the tunnels failed: {}'.format(e))
+                self.stopped.wait(self.interval)
+        finally:
+            server.shutdown()
+            server.server_close()
+            os.unlink(path)
+
+    def stop(self):
+        self.stopped.set()
+
+
+def query_status(path=None, timeout=QUERY_TIMEOUT):
+    """Returns the status of the supervised tunnels, or None if no supervisor is running"""
+
+    try:
+        with socket.socket(socket.AF_UNIX) as sock:
+            sock.settimeout(timeout)
+            sock.connect(path or SOCKET)
+            sock.sendall(b'status\n')
+            data = b''
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                data += chunk
+        return json.loads(data.decode('utf-8'))
+    except (OSError, ValueError):
+        return None
+
+
+def ensure_supervisor(interval=CHECK_INTERVAL, path=None):
+    """Starts a supervisor in the background, unless one is running already"""
+
+    if query_status(path) is not None:
+        return
+
+    logging.info('Starting tunnel supervisor')
+    env = dict(os.environ, SPILO_SUPERVISOR_INTERVAL=str(interval))
+    if path is not None:
+        env['SPILO_SUPERVISOR_SOCKET'] = path
+    subprocess.Popen([sys.executable, '-m', 'spilo.supervisor'], stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                     stderr=subprocess.DEVNULL, start_new_session=True, env=env)
+
+    deadline = time.time() + READY_TIMEOUT
+    while query_status(path) is None:
+        if time.time() > deadline:
+            raise Exception('The tunnel supervisor did not start within {} seconds'.format(READY_TIMEOUT))
+        time.sleep(0.05)
+
+
+def supervised_tunnels(path=None):
+    """The registered tunnels with their status if a supervisor is running, None if there is no supervisor
+
+    The supervisor only knows about a tunnel after its next check, those tunnels are added from the registry."""
+
+    status = query_status(path)
+    if status is None:
+        return None
+
+    known = set(s['pgport'] for s in status)
+    return status + [e for e in read_tunnels() if e['pgport'] not in known and is_alive(e['pid'])]
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s',
+                        level=os.environ.get('SPILO_SUPERVISOR_LOGLEVEL', 'INFO'))
+    try:
+        Supervisor(float(os.environ.get('SPILO_SUPERVISOR_INTERVAL', CHECK_INTERVAL))).run(
+            os.environ.get('SPILO_SUPERVISOR_SOCKET'))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,253 @@
+import collections
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+import types
+
+import pytest
+
+import spilo.cache
+import spilo.ports
+import spilo.registry
+import spilo.spilo
+import spilo.ssh
+import spilo.supervisor
+
+# # Like a boto StackSummary, LastUpdatedTime is only there once the stack has been updated
+Stack = collections.namedtuple('Stack', 'stack_name, stack_status, stack_id, name, version, LastUpdatedTime')
+Stack.__new__.__defaults__ = (None,)
+Resource = collections.namedtuple('Resource', 'logical_resource_id, physical_resource_id, stack_name')
+LoadBalancer = collections.namedtuple('LoadBalancer', 'name, dns_name, vpc_id')
+Record = collections.namedtuple('Record', 'name, type, resource_records')
+Zone = collections.namedtuple('Zone', 'id')
+Instance = collections.namedtuple('Instance', 'id, private_ip_address, launch_time, tags')
+InstanceState = collections.namedtuple('InstanceState', 'instance_id, state')
+
+
+def elb_dns_name(i):
+    return 'internal-stack{}-1-{}.eu-west-1.elb.amazonaws.com'.format(i, 1000 + i)
+
+
+def max_overlap(intervals):
+    """The largest number of the (start, end) intervals which overlap at any moment
+
+    >>> max_overlap([(0, 2), (1, 3), (2, 4), (5, 6)])
+    2
+    """
+    events = sorted([(start, 1) for start, _ in intervals] + [(end, -1) for _, end in intervals])
+    active = overlap = 0
+    for _, change in events:
+        active += change
+        overlap = max(overlap, active)
+    return overlap
+
+
+class FakeAWS(object):
+    """A stubbed boto layer, every API call sleeps for `latency` seconds to simulate a round trip
+
+    When every call started and ended is recorded in intervals, so tests can tell which calls overlapped"""
+
+    def __init__(self, stacks=20, spilos=5, latency=0.0):
+        self.latency = latency
+        self.calls = collections.Counter()
+        self.lock = threading.Lock()
+        self.failures = collections.Counter()
+        self.intervals = list()
+
+        self.stacks = list()
+        self.resources = dict()
+        self.load_balancers = dict()
+        self.records = {'zone1': list(), 'zone2': list()}
+        self.instances = dict()
+        self.health = dict()
+
+        for i in range(stacks):
+            name = 'stack{}'.format(i)
+            stack = Stack(stack_name='{}-1'.format(name), stack_status='CREATE_COMPLETE',
+                          stack_id='arn:{}'.format(name), name=name, version='cluster{}'.format(i))
+            self.stacks.append(stack)
+
+            resources = [Resource('AppServer', 'app{}'.format(i), stack.stack_name)]
+            if i < spilos:
+                # # Like the spilo template of senza, the load balancer is named after the stack
+                elb_name = stack.stack_name
+                resources.append(Resource('PostgresLoadBalancer', elb_name, stack.stack_name))
+                dns_name = elb_dns_name(i)
+                self.load_balancers[elb_name] = LoadBalancer(elb_name, dns_name, 'vpc-{}'.format(i))
+                zone = 'zone{}'.format(i % 2 + 1)
+                self.records[zone].append(Record('cluster{}.db.example.com.'.format(i), 'CNAME', [dns_name]))
+
+                self.instances[stack.stack_id] = list()
+                self.health[stack.stack_name] = list()
+                for n in range(3):
+                    instance_id = 'i-{}{}'.format(i, n)
+                    self.instances[stack.stack_id].append(
+                        Instance(instance_id, '10.0.{}.{}'.format(i, n), '2015-04-14T19:09:01.000Z',
+                                 {'aws:cloudformation:stack-id': stack.stack_id}))
+                    self.health[stack.stack_name].append(
+                        InstanceState(instance_id, 'InService' if n == 0 else 'OutOfService'))
+            self.resources[stack.stack_name] = resources
+
+        self.records['zone1'].append(Record('www.example.com.', 'A', ['127.0.0.1']))
+
+    def call(self, name):
+        start = time.monotonic()
+        with self.lock:
+            self.calls[name] += 1
+            fail = self.failures[name] > 0
+            if fail:
+                self.failures[name] -= 1
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.intervals.append((start, time.monotonic()))
+        if fail:
+            error = Exception('Rate exceeded')
+            error.error_code = 'Throttling'
+            raise error
+
+    def describe_stack_resources(self, stack_name):
+        self.call('describe_stack_resources')
+        return self.resources[stack_name]
+
+    def get_all_load_balancers(self, load_balancer_names):
+        self.call('get_all_load_balancers')
+        return [self.load_balancers[n] for n in load_balancer_names]
+
+    def get_zones(self):
+        self.call('get_zones')
+        return [Zone(zone_id) for zone_id in sorted(self.records)]
+
+    def get_all_rrsets(self, hosted_zone_id):
+        self.call('get_all_rrsets')
+        return self.records[hosted_zone_id]
+
+    def get_only_instances(self, filters):
+        self.call('get_only_instances')
+        stack_ids = filters['tag:aws:cloudformation:stack-id']
+        if isinstance(stack_ids, str):
+            stack_ids = [stack_ids]
+        return [i for stack_id in stack_ids for i in self.instances.get(stack_id, list())]
+
+    def describe_instance_health(self, load_balancer_name):
+        self.call('describe_instance_health')
+        return self.health.get(load_balancer_name, list())
+
+    def get_stacks(self, stack_refs, region, all):
+        self.call('get_stacks')
+        return iter(self.stacks)
+
+    def connect_to_region(self, region):
+        return self
+
+    def boto(self):
+        connect = types.SimpleNamespace(connect_to_region=self.connect_to_region)
+        ec2 = types.SimpleNamespace(connect_to_region=self.connect_to_region, elb=connect)
+        return types.SimpleNamespace(ec2=ec2, cloudformation=connect, route53=connect)
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(monkeypatch, tmp_path):
+    """Keeps every test away from the cache, registry and port reservations in ~/.cache/spilo"""
+
+    cache_dir = tmp_path / 'cache'
+    # # For the processes we start, like ssh and the supervisor
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path))
+    monkeypatch.setattr(spilo.cache, 'CACHE_DIR', str(cache_dir))
+    monkeypatch.setattr(spilo.cache, 'DISCOVERY_CACHE', str(cache_dir / 'discovery.json'))
+    monkeypatch.setattr(spilo.cache, 'CONFIG_CACHE', str(cache_dir / 'config.json'))
+    monkeypatch.setattr(spilo.cache, 'STACKS_CACHE', str(cache_dir / 'stacks.json'))
+    monkeypatch.setattr(spilo.registry, 'REGISTRY', str(cache_dir / 'tunnels.json'))
+    monkeypatch.setattr(spilo.ports, 'RESERVATIONS', str(cache_dir / 'ports.json'))
+    monkeypatch.setattr(spilo.ssh, 'CONTROL_DIR', str(cache_dir / 'ssh'))
+    monkeypatch.setattr(spilo.supervisor, 'SOCKET', str(cache_dir / 'supervisor.sock'))
+    return str(cache_dir)
+
+
+@pytest.fixture
+def fake_aws(monkeypatch, tmp_path):
+    aws = FakeAWS()
+
+    monkeypatch.setattr(spilo.spilo, 'boto', aws.boto())
+    monkeypatch.setattr(spilo.spilo, 'get_region', lambda region: region)
+    monkeypatch.setattr(spilo.spilo, 'check_credentials', lambda region: None)
+    monkeypatch.setattr(spilo.spilo, 'get_stacks', aws.get_stacks)
+    monkeypatch.setattr(spilo.spilo, 'aws_connections', dict())
+
+    return aws
+
+
+class EchoServer(object):
+    """Stands in for the database behind the odd host"""
+
+    def __init__(self):
+        self.listener = socket.socket()
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(64)
+        self.port = self.listener.getsockname()[1]
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self):
+        while True:
+            try:
+                client, _ = self.listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.echo, args=(client,), daemon=True).start()
+
+    def echo(self, client):
+        with client:
+            while True:
+                data = client.recv(65536)
+                if not data:
+                    return
+                client.sendall(data)
+
+    def close(self):
+        self.listener.close()
+
+
+def echo(port, message=b'ping'):
+    with socket.create_connection(('127.0.0.1', int(port)), timeout=5) as sock:
+        sock.sendall(message)
+        return sock.recv(len(message))
+
+
+@pytest.fixture
+def echo_server():
+    server = EchoServer()
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def fake_ssh(monkeypatch, tmp_path, echo_server):
+    """Puts a stand-in ssh on the PATH and configures spilo to tunnel to the echo server"""
+
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    ssh = bin_dir / 'ssh'
+    ssh.write_text('#!/bin/sh\nexec {} {} "$@"\n'.format(sys.executable,
+                                                          os.path.join(os.path.dirname(__file__), 'fake_ssh.py')))
+    ssh.chmod(0o755)
+
+    monkeypatch.setenv('PATH', '{}:{}'.format(bin_dir, os.environ['PATH']))
+
+    # # Both are restored afterwards, so later tests process their own options
+    monkeypatch.setattr(spilo.spilo, 'processed', True)
+    monkeypatch.setattr(spilo.spilo, 'options', {'cluster': 'mock', 'port': 5432, 'background': True}, raising=False)
+    monkeypatch.setattr(spilo.spilo, 'odd_config', {'user_name': None, 'odd_host': 'odd'}, raising=False)
+    monkeypatch.setattr(spilo.spilo, 'pg_service_name', 'mock', raising=False)
+    monkeypatch.setattr(spilo.spilo, 'pg_service', {'host': '127.0.0.1', 'port': echo_server.port}, raising=False)
+    monkeypatch.setattr(spilo.spilo, 'tunnels', {'patroni': None, 'postgres': None})
+
+    yield spilo.spilo.options
+
+    for entry in spilo.registry.get_tunnels():
+        try:
+            os.kill(int(entry['pid']), signal.SIGKILL)
+        except OSError:
+            pass
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""A stand-in for ssh and the odd host, understanding the subset of ssh that spilo uses
+
+Local forwards (-L) are served by this process itself, connecting from the local machine to the target host.
+A master (-M -S path) listens on a unix socket for the -O check/forward/cancel/exit control commands."""
+
+import os
+import socket
+import sys
+import threading
+import time
+
+OPTIONS_WITH_ARGUMENT = 'BbcDEeFIiJLlmOopQRSWw'
+
+
+def parse(argv):
+    """Like ssh, options are accepted both before and after the destination"""
+
+    options = {'L': list(), 'o': list()}
+    flags = set()
+    args = list(argv)
+
+    def parse_options():
+        while args and args[0].startswith('-'):
+            arg = args.pop(0)
+            letters = arg[1:]
+            while letters:
+                letter, letters = letters[0], letters[1:]
+                if letter in OPTIONS_WITH_ARGUMENT:
+                    value = letters or args.pop(0)
+                    letters = ''
+                    if letter in ('L', 'o'):
+                        options[letter].append(value)
+                    else:
+                        options[letter] = value
+                else:
+                    flags.add(letter)
+
+    parse_options()
+    destination = args.pop(0) if args else ''
+    parse_options()
+    return options, flags, destination, ' '.join(args)
+
+
+def pump(source, destination):
+    try:
+        while True:
+            data = source.recv(65536)
+            if not data:
+                break
+            destination.sendall(data)
+    except OSError:
+        pass
+    finally:
+        for s in (source, destination):
+            try:
+                s.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+class Forward(object):
+
+    def __init__(self, spec):
+        local_port, self.host, self.port = spec.rsplit(':', 2)
+        self.listener = socket.socket()
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(('127.0.0.1', int(local_port)))
+        self.listener.listen(64)
+        self.running = True
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self):
+        while self.running:
+            try:
+                client, _ = self.listener.accept()
+            except OSError:
+                return
+            try:
+                remote = socket.create_connection((self.host, int(self.port)), timeout=5)
+                remote.settimeout(None)
+            except OSError:
+                # # Just like ssh, we close the local connection if the channel cannot be opened
+                client.close()
+                continue
+            threading.Thread(target=pump, args=(client, remote), daemon=True).start()
+            threading.Thread(target=pump, args=(remote, client), daemon=True).start()
+
+    def close(self):
+        self.running = False
+        try:
+            self.listener.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.listener.close()
+
+
+def open_forwards(specs):
+    forwards = dict()
+    for spec in specs:
+        try:
+            forwards[spec] = Forward(spec)
+        except OSError as e:
+            for forward in forwards.values():
+                forward.close()
+            raise Exception('bind [127.0.0.1]:{}: {}'.format(spec.split(':')[0], e.strerror))
+    return forwards
+
+
+def serve_master(path, forwards):
+    server = socket.socket(socket.AF_UNIX)
+    server.bind(path)
+    server.listen(16)
+
+    while True:
+        connection, _ = server.accept()
+        with connection:
+            command, _, spec = connection.recv(65536).decode().partition(' ')
+            reply = 'ok'
+            if command == 'check':
+                reply = 'Master running (pid={})'.format(os.getpid())
+            elif command == 'forward':
+                try:
+                    forwards.update(open_forwards(spec.split()))
+                except Exception as e:
+                    reply = 'error {}'.format(e)
+            elif command == 'cancel':
+                for s in spec.split():
+                    if s in forwards:
+                        forwards.pop(s).close()
+            elif command == 'exit':
+                connection.sendall(b'Exit request sent.')
+                os.unlink(path)
+                os._exit(0)
+            connection.sendall(reply.encode())
+
+
+def control(path, command, specs):
+    connection = socket.socket(socket.AF_UNIX)
+    try:
+        connection.connect(path)
+    except OSError:
+        sys.stderr.write('Control socket connect({}): No such file or directory\n'.format(path))
+        return 255
+
+    with connection:
+        connection.sendall(' '.join([command] + specs).encode())
+        reply = connection.recv(65536).decode()
+
+    if reply.startswith('error'):
+        sys.stderr.write(reply[6:] + '\n')
+        return 255
+    if command == 'check':
+        sys.stderr.write(reply + '\r\n')
+    return 0
+
+
+def main(argv):
+    options, flags, destination, command = parse(argv)
+
+    if os.environ.get('FAKE_SSH_FAIL'):
+        sys.stderr.write('ssh: connect to host {} port 22: Connection refused\n'.format(destination))
+        return 255
+
+    if 'O' in options:
+        return control(options['S'], options['O'], options['L'])
+
+    if command:
+        if command == 'printf t3st':
+            sys.stdout.write('t3st')
+        return 0
+
+    delay = float(os.environ.get('FAKE_SSH_DELAY', 0))
+    if delay:
+        time.sleep(delay)
+
+    if 'f' in flags:
+        if os.fork() > 0:
+            # # Like ssh, only return to the caller once the control socket is available
+            while 'M' in flags and not os.path.exists(options['S']):
+                time.sleep(0.01)
+            os._exit(0)
+        os.setsid()
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(devnull, fd)
+
+    try:
+        forwards = open_forwards(options['L'])
+    except Exception as e:
+        sys.stderr.write('{}\n'.format(e))
+        return 255
+
+    if 'M' in flags:
+        serve_master(options['S'], forwards)
+
+    while True:
+        time.sleep(60)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,62 @@
+import json
+
+import yaml
+from click.testing import CliRunner
+
+import spilo.spilo
+from spilo.api import discover, list_tunnels, open_tunnel
+from spilo.spilo import cli
+
+from conftest import echo
+
+
+def test_discover(fake_aws):
+    spilos = discover('eu-west-1', ['cluster1', 'cluster2'], details=True, ttl=0)
+    assert [s.version for s in spilos] == ['cluster1', 'cluster2']
+    assert all(len(s.instances) == 3 for s in spilos)
+
+
+def test_open_tunnels(fake_ssh, monkeypatch, tmp_path, echo_server):
+    # # The api does not look at the globals of the command line
+    monkeypatch.setattr(spilo.spilo, 'options', None)
+    monkeypatch.setattr(spilo.spilo, 'pg_service', None)
+
+    services = tmp_path / 'pg_service.conf'
+    services.write_text('[mock]\nhost=127.0.0.1\nport={}\n'.format(echo_server.port))
+
+    first = open_tunnel('mock', pg_service_file=str(services), odd_config_file=None)
+    second = open_tunnel('mock', pg_service_file=str(services), odd_config_file=None, reuse=False)
+    assert first.pg_port != second.pg_port
+    assert echo(first.pg_port) == b'ping' and echo(second.pg_port) == b'ping'
+    assert first.dsn == 'host=localhost port={} service=mock'.format(first.pg_port)
+
+    # # An existing tunnel is reused
+    assert open_tunnel('mock').pid in (first.pid, second.pid)
+
+    assert sorted(t.pg_port for t in list_tunnels('mock')) == sorted([first.pg_port, second.pg_port])
+    result = CliRunner().invoke(cli, ['tunnel', '--list', '--output', 'json', 'mock'])
+    assert sorted(int(e['pgport']) for e in json.loads(result.output)) == sorted([first.pg_port, second.pg_port])
+
+    first.close()
+    assert [t.pg_port for t in list_tunnels()] == [second.pg_port]
+    second.close()
+    assert list_tunnels() == []
+
+
+def test_list_formats(fake_aws):
+    runner = CliRunner()
+    args = ['list', '--region', 'eu-west-1', '--cache-ttl', '0', '--details', 'cluster1']
+
+    result = runner.invoke(cli, args + ['--output', 'json'])
+    assert result.exit_code == 0, result.output
+    spilos = json.loads(result.output)
+    assert [s['version'] for s in spilos] == ['cluster1']
+    assert [i['instance_id'] for i in spilos[0]['instances']] == ['i-10', 'i-11', 'i-12']
+
+    result = runner.invoke(cli, args + ['--output', 'yaml'])
+    assert yaml.safe_load(result.output) == spilos
+
+    result = runner.invoke(cli, args + ['--output', 'tsv'])
+    lines = [line.split('\t') for line in result.output.splitlines()]
+    assert lines[0] == ['cluster', 'dns', 'instance_id', 'private_ip', 'role', 'launch_time']
+    assert [line[0] for line in lines[1:]] == ['cluster1'] * 3
@@ -0,0 +1,83 @@
+import time
+
+import pytest
+
+from spilo.bench import overhead, run_benchmark
+
+
+class FakeCursor(object):
+
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, query):
+        time.sleep(self.db.latency)
+        self.db.queries += 1
+
+    def fetchone(self):
+        return (1,)
+
+    def copy_expert(self, query, file):
+        for _ in range(100):
+            file.write(b'x' * 1024)
+
+
+class FakeConnection(object):
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.queries = 0
+        self.closed = False
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def fake_connect():
+    connections = list()
+
+    def connect(latency=0.001, **parameters):
+        connections.append(FakeConnection(latency))
+        return connections[-1]
+
+    connect.connections = connections
+    return connect
+
+
+def test_run_benchmark(fake_connect):
+    result = run_benchmark('tunnel', {'latency': 0.002}, connect=fake_connect, connections=5, queries=20)
+
+    assert len(fake_connect.connections) == 6
+    assert all(c.closed for c in fake_connect.connections)
+    assert fake_connect.connections[0].queries == 20
+
+    assert result['target'] == 'tunnel'
+    assert 2 <= result['query_p50'] <= result['query_p90'] <= result['query_p99']
+    assert result['connect_p50'] is not None
+    assert result['copy_bytes'] == 100 * 1024
+    assert result['copy_mb_s'] > 0
+
+
+def test_overhead(fake_connect):
+    tunnel = run_benchmark('tunnel', {'latency': 0.005}, connect=fake_connect, connections=1, queries=10,
+                           copy_rows=0)
+    direct = run_benchmark('direct', {'latency': 0}, connect=fake_connect, connections=1, queries=10, copy_rows=0)
+
+    assert tunnel['copy_mb_s'] is None
+    assert overhead(tunnel, direct)['query_p50'] >= 5
+
+
+def test_needs_psycopg2():
+    with pytest.raises(Exception) as e:
+        run_benchmark('tunnel', {}, connect=lambda **parameters: None)
+    assert 'psycopg2' in str(e.value)
@@ -0,0 +1,130 @@
+import threading
+import time
+
+import spilo.cache
+import spilo.spilo
+from spilo.cache import invalidate_spilo, load_non_spilos, load_spilos, store_non_spilos, store_spilos
+from spilo.spilo import get_region, get_spilos, is_cached
+
+
+def test_discovery_cache(fake_aws):
+    spilos = get_spilos('eu-west-1')
+    assert not any(is_cached(s) for s in spilos)
+    calls = sum(fake_aws.calls.values())
+
+    cached = get_spilos('eu-west-1')
+    assert sum(fake_aws.calls.values()) == calls
+    assert all(is_cached(s) for s in cached)
+    assert [(s.stack_name, s.version, s.dns, s.elb, s.vpc_id) for s in cached] == \
+        [(s.stack_name, s.version, s.dns, s.elb, s.vpc_id) for s in spilos]
+    assert cached[1].stack.stack_id == spilos[1].stack.stack_id
+
+    assert [s.version for s in get_spilos('eu-west-1', clusters=['cluster2'])] == ['cluster2']
+    assert sum(fake_aws.calls.values()) == calls
+
+    get_spilos('eu-west-1', refresh=True)
+    assert sum(fake_aws.calls.values()) > calls
+
+
+def test_discovery_cache_without_region(fake_aws, monkeypatch):
+    monkeypatch.setattr(spilo.spilo, 'get_region', lambda region: region or 'eu-west-1')
+    assert len(get_spilos(None)) == 5
+    calls = sum(fake_aws.calls.values())
+
+    # # Without --region the spilos are cached under the default region, and found there again
+    assert all(is_cached(s) for s in get_spilos(None))
+    assert sum(fake_aws.calls.values()) == calls
+
+
+def test_default_region(tmp_path, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmp_path))
+    (tmp_path / '.aws').mkdir()
+    (tmp_path / '.aws' / 'config').write_text('[default]\nregion = eu-central-1\n')
+    assert get_region(None) == 'eu-central-1'
+    assert get_region('us-east-1') == 'us-east-1'
+
+
+def test_selection_cache(fake_aws):
+    assert [s.version for s in get_spilos('eu-west-1', clusters=['cluster1'])] == ['cluster1']
+    calls = sum(fake_aws.calls.values())
+
+    # # Only the selected spilo was discovered, which is cached, but not used when listing all spilos
+    assert [s.version for s in get_spilos('eu-west-1', clusters=['cluster1'])] == ['cluster1']
+    assert sum(fake_aws.calls.values()) == calls
+    assert len(get_spilos('eu-west-1')) == 5
+    assert sum(fake_aws.calls.values()) > calls
+
+
+def test_selection_cache_other_selection(fake_aws):
+    get_spilos('eu-west-1', clusters=['cluster1'])
+    calls = sum(fake_aws.calls.values())
+
+    # # cluster1 is cached and matches, but the other clusters matching the pattern were never looked for
+    assert [s.version for s in get_spilos('eu-west-1', clusters=['cluster'])] == \
+        ['cluster{}'.format(i) for i in range(5)]
+    assert sum(fake_aws.calls.values()) > calls
+
+    calls = sum(fake_aws.calls.values())
+    assert len(get_spilos('eu-west-1', clusters=['cluster'])) == 5
+    assert [s.version for s in get_spilos('eu-west-1', clusters=['cluster1'])] == ['cluster1']
+    assert sum(fake_aws.calls.values()) == calls
+
+
+def test_discovery_cache_miss(fake_aws):
+    get_spilos('eu-west-1')
+    calls = sum(fake_aws.calls.values())
+
+    # # A cluster which is not in the cache triggers discovery
+    assert get_spilos('eu-west-1', clusters=['nonexistent']) == []
+    assert sum(fake_aws.calls.values()) > calls
+
+
+def test_invalidate(tmp_path):
+    filename = str(tmp_path / 'discovery.json')
+
+    assert load_spilos('eu-west-1', filename=filename) is None
+
+    store_spilos('eu-west-1', [{'stack_name': 'a'}, {'stack_name': 'b'}], filename=filename)
+    store_spilos('eu-central-1', [{'stack_name': 'a'}], filename=filename)
+    assert len(load_spilos('eu-west-1', filename=filename)) == 2
+    assert load_spilos('eu-west-1', ttl=0, filename=filename) is None
+
+    invalidate_spilo('eu-west-1', 'a', filename=filename)
+    assert load_spilos('eu-west-1', filename=filename) == [{'stack_name': 'b'}]
+    assert load_spilos('eu-central-1', filename=filename) == [{'stack_name': 'a'}]
+
+
+def test_expired(tmp_path, monkeypatch):
+    filename = str(tmp_path / 'discovery.json')
+    store_spilos('eu-west-1', [], filename=filename)
+
+    monkeypatch.setattr(spilo.cache.time, 'time', lambda: 10 ** 10)
+    assert load_spilos('eu-west-1', ttl=60, filename=filename) is None
+
+
+def test_concurrent_regions(tmp_path, monkeypatch):
+    discovery = str(tmp_path / 'discovery.json')
+    stacks = str(tmp_path / 'stacks.json')
+    read_json = spilo.cache.read_json
+
+    def slow_read_json(*args, **kwargs):
+        result = read_json(*args, **kwargs)
+        time.sleep(0.05)
+        return result
+    monkeypatch.setattr(spilo.cache, 'read_json', slow_read_json)
+
+    def store(region):
+        store_spilos(region, [{'stack_name': region}], filename=discovery)
+        store_non_spilos(region, {region: []}, filename=stacks)
+
+    regions = ['eu-west-1', 'eu-central-1', 'us-east-1']
+    threads = [threading.Thread(target=store, args=(region,)) for region in regions]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # # Every region read the cache after the others had written it
+    for region in regions:
+        assert load_spilos(region, filename=discovery) == [{'stack_name': region}]
+        assert load_non_spilos(region, filename=stacks) == {region: []}
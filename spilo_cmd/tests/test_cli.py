@@ -2,6 +2,7 @@ import collections
 
 from click.testing import CliRunner
 
+import spilo.spilo
 from spilo.spilo import cli, process_options, print_spilos, tunnel
 
 Spilo = collections.namedtuple('Spilo', 'stack_name, version, dns, elb, instances, vpc_id, stack')
@@ -31,6 +32,18 @@ def test_tunnel():
     assert result.exit_code != 0
 
 
+def test_adopt(monkeypatch):
+    adopted = list()
+    monkeypatch.setattr(spilo.spilo, 'adopt_tunnels', lambda: adopted.append(True) or list())
+    runner = CliRunner()
+
+    # # The processes are only scanned for unregistered tunnels when asked to
+    assert runner.invoke(tunnel, ['--list', 'abc']).exit_code == 0
+    assert adopted == []
+    assert runner.invoke(tunnel, ['--adopt', '--list', 'abc']).exit_code == 0
+    assert adopted == [True]
+
+
 def test_list():
     pass
 
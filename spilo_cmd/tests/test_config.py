@@ -0,0 +1,115 @@
+import configparser
+import datetime
+import os
+import time
+
+import pytest
+
+import spilo.cache
+import spilo.spilo
+from spilo.cache import parse_files
+from spilo.spilo import get_pg_service, parse_pg_service_file
+
+HOME_SERVICES = """[DEFAULT]
+user=everyone
+
+[mock]
+host=home
+port=5433
+
+[spilo]
+host=spilo
+"""
+
+SYSCONF_SERVICES = """[DEFAULT]
+sslmode=require
+
+[mock]
+host=sysconf
+dbname=mock
+"""
+
+
+def write(path, content, age=10):
+    path.write_text(content)
+    # # Files which have just been modified are not cached
+    os.utime(str(path), (time.time() - age, time.time() - age))
+    return str(path)
+
+
+@pytest.fixture
+def config_cache(monkeypatch, tmp_path):
+    monkeypatch.setattr(spilo.cache, 'CONFIG_CACHE', str(tmp_path / 'config.json'))
+
+
+@pytest.fixture
+def services(monkeypatch, tmp_path, config_cache):
+    home = tmp_path / 'home'
+    sysconf = tmp_path / 'sysconf'
+    home.mkdir()
+    sysconf.mkdir()
+    write(home / '.pg_service.conf', HOME_SERVICES)
+    write(sysconf / 'pg_service.conf', SYSCONF_SERVICES)
+
+    monkeypatch.setenv('HOME', str(home))
+    monkeypatch.setenv('PGSYSCONFDIR', str(sysconf))
+    monkeypatch.setattr(spilo.spilo, 'options', {'cluster': 'mock', 'port': 5432}, raising=False)
+    return [str(home / '.pg_service.conf'), str(sysconf / 'pg_service.conf')]
+
+
+def test_pg_service(services):
+    # # Reading all the files into a single parser is how the services were found before they were cached
+    parser = configparser.ConfigParser(defaults={'port': 5432, 'host': 'mock'})
+    parser.read(services)
+    expected = ('mock', dict(parser.items('mock', raw=True)))
+
+    assert expected[1] == {'host': 'sysconf', 'port': '5433', 'dbname': 'mock', 'user': 'everyone',
+                           'sslmode': 'require'}
+    assert get_pg_service() == expected
+    assert get_pg_service() == expected
+
+    spilo.spilo.options['cluster'] = 'other'
+    assert get_pg_service() == ('spilo', {'host': 'spilo', 'port': '5432', 'user': 'everyone',
+                                          'sslmode': 'require'})
+
+
+def test_parse_files_cache(config_cache, tmp_path):
+    parsed = list()
+
+    def parse(filename):
+        parsed.append(filename)
+        return parse_pg_service_file(filename)
+
+    first = write(tmp_path / 'first.conf', HOME_SERVICES)
+    second = write(tmp_path / 'second.conf', SYSCONF_SERVICES, age=0)
+    missing = str(tmp_path / 'missing.conf')
+
+    result = parse_files('pg_service', [first, missing, second], parse)
+    assert [f for f, _ in result] == [first, second]
+    assert result[0][1]['DEFAULT'] == {'user': 'everyone'}
+
+    # # The file that was modified just now is parsed again, the other one comes from the cache
+    assert parse_files('pg_service', [first, missing, second], parse) == result
+    assert parsed == [first, second, second]
+
+    write(tmp_path / 'first.conf', HOME_SERVICES.replace('home', 'moved'))
+    assert parse_files('pg_service', [first], parse)[0][1]['mock']['host'] == 'moved'
+    assert parsed[-1] == first
+
+
+def test_parse_files_not_serializable(config_cache, tmp_path):
+    odd_config = write(tmp_path / 'piu.yaml', 'odd_host: odd.example.org\nexpires: 2016-01-01\n')
+
+    result = parse_files('odd_config', [odd_config], spilo.spilo.parse_yaml_file)
+    assert result[0][1]['expires'] == datetime.date(2016, 1, 1)
+    # # Nothing is cached, the next call parses the file again
+    assert parse_files('odd_config', [odd_config], spilo.spilo.parse_yaml_file) == result
+    assert 'odd_config' not in spilo.cache.read_json(spilo.cache.CONFIG_CACHE, dict())
+
+
+def test_odd_config(config_cache, tmp_path, monkeypatch):
+    odd_config = write(tmp_path / 'piu.yaml', 'odd_host: odd.example.org\nuser_name: johnny\n')
+    monkeypatch.setattr(spilo.spilo, 'options', {'odd_config_file': odd_config}, raising=False)
+
+    assert spilo.spilo.load_odd_config() == {'odd_host': 'odd.example.org', 'user_name': 'johnny'}
+    assert spilo.spilo.load_odd_config() == {'odd_host': 'odd.example.org', 'user_name': 'johnny'}
@@ -0,0 +1,53 @@
+from spilo.spilo import diff_snapshots, get_spilos, instance_snapshot, print_changes, update_spilo_info
+
+from conftest import max_overlap
+
+
+def test_instance_details(fake_aws):
+    spilos = get_spilos('eu-west-1', ttl=0)
+
+    fake_aws.calls.clear()
+    per_stack = update_spilo_info(spilos, batched=False)
+    assert fake_aws.calls['get_only_instances'] == len(spilos)
+    assert fake_aws.calls['describe_instance_health'] == len(spilos)
+
+    fake_aws.calls.clear()
+    batched = update_spilo_info(spilos, batched=True)
+    assert fake_aws.calls['get_only_instances'] == 1
+    assert fake_aws.calls['describe_instance_health'] == len(spilos)
+
+    assert batched == per_stack
+    assert [i['role'] for i in batched[0].instances] == ['MASTER', 'REPLICA', 'REPLICA']
+    assert batched[1].instances[0]['private_ip'] == '10.0.1.0'
+
+
+def test_instance_details_calls(fake_aws):
+    spilos = get_spilos('eu-west-1', ttl=0)
+    fake_aws.latency = 0.01
+
+    calls = dict()
+    for batched in (False, True):
+        fake_aws.calls.clear()
+        fake_aws.intervals.clear()
+        update_spilo_info(spilos, batched=batched, concurrency=10)
+        calls[batched] = sum(fake_aws.calls.values())
+
+    assert calls == {False: 2 * len(spilos), True: len(spilos) + 1}
+    # # Batched, the health of the load balancers is asked for at the same time
+    assert max_overlap(fake_aws.intervals) > 1
+
+
+def test_watch_diff(fake_aws):
+    spilos = update_spilo_info(get_spilos('eu-west-1', ttl=0))
+    previous = instance_snapshot(spilos)
+    assert diff_snapshots(previous, instance_snapshot(update_spilo_info(spilos))) == []
+
+    # # Failover in cluster1
+    health = fake_aws.health['stack1-1']
+    health[0], health[1] = health[0]._replace(state='OutOfService'), health[1]._replace(state='InService')
+    del fake_aws.instances['arn:stack2'][2]
+
+    changes = diff_snapshots(previous, instance_snapshot(update_spilo_info(spilos)))
+    assert [(c['cluster'], c['instance_id'], c['change']) for c in changes] == [
+        ('cluster1', 'i-10', 'DEMOTED'), ('cluster1', 'i-11', 'PROMOTED'), ('cluster2', 'i-22', 'REMOVED')]
+    print_changes(changes)
@@ -0,0 +1,132 @@
+
+import pytest
+
+import spilo.aws
+import spilo.cache
+from spilo.aws import call_with_backoff, parallel_map
+from spilo.spilo import discover_spilos, get_cname_index, get_dns_names, get_spilos
+
+from conftest import Record, elb_dns_name, max_overlap
+
+
+def test_parallel_map():
+    assert parallel_map(lambda x: x * 2, range(10), concurrency=4) == [x * 2 for x in range(10)]
+    assert parallel_map(lambda x: x * 2, [], concurrency=4) == []
+    assert parallel_map(lambda x: x * 2, [1], concurrency=None) == [2]
+
+
+def test_call_with_backoff(fake_aws, monkeypatch):
+    monkeypatch.setattr(spilo.aws, 'BASE_DELAY', 0.001)
+
+    fake_aws.failures['describe_stack_resources'] = 2
+    assert call_with_backoff(fake_aws.describe_stack_resources, 'stack0-1')
+    assert fake_aws.calls['describe_stack_resources'] == 3
+
+    monkeypatch.setattr(spilo.aws, 'MAX_RETRIES', 1)
+    fake_aws.failures['describe_stack_resources'] = 2
+    with pytest.raises(Exception):
+        call_with_backoff(fake_aws.describe_stack_resources, 'stack0-1')
+
+    def broken():
+        raise ValueError('not throttled')
+
+    with pytest.raises(ValueError):
+        call_with_backoff(broken)
+
+
+def test_get_spilos_identical(fake_aws):
+    serial = get_spilos('eu-west-1', concurrency=1, ttl=0)
+    concurrent = get_spilos('eu-west-1', concurrency=8, ttl=0)
+
+    assert len(serial) == 5
+    assert serial == concurrent
+    assert serial[0].dns == ['cluster0.db.example.com']
+
+    assert get_spilos('eu-west-1', clusters=['cluster3'], concurrency=8, ttl=0) == [serial[3]]
+
+
+def test_get_spilos_concurrent_calls(fake_aws):
+    fake_aws.latency = 0.01
+
+    serial = get_spilos('eu-west-1', concurrency=1, ttl=0)
+    assert max_overlap(fake_aws.intervals) == 1
+
+    # # The calls for the stacks are made at the same time, the same number of them
+    calls = sum(fake_aws.calls.values())
+    fake_aws.intervals.clear()
+    concurrent = get_spilos('eu-west-1', concurrency=10, ttl=0)
+    assert serial == concurrent
+    assert sum(fake_aws.calls.values()) == 2 * calls
+    assert max_overlap(fake_aws.intervals) > 1
+
+
+def test_cname_index(fake_aws):
+    fake_aws.records['zone2'].append(Record('alias0.example.org.', 'CNAME', [elb_dns_name(0)]))
+    fake_aws.records['zone2'].append(Record('cluster0.db.example.com.', 'CNAME', [elb_dns_name(0)]))
+
+    index = get_cname_index('eu-west-1', concurrency=2)
+    assert index[elb_dns_name(0)] == ['cluster0.db.example.com', 'alias0.example.org']
+    assert index[elb_dns_name(1)] == ['cluster1.db.example.com']
+    assert '127.0.0.1' not in index
+    assert fake_aws.calls['get_all_rrsets'] == 2
+
+    spilos = get_spilos('eu-west-1', clusters=['alias0'], ttl=0)
+    assert [s.version for s in spilos] == ['cluster0']
+    assert spilos[0].dns == ['cluster0.db.example.com', 'alias0.example.org']
+
+    assert get_dns_names(index, 'unknown.elb.amazonaws.com') == ['unknown.elb.amazonaws.com']
+
+
+def test_preselect_stacks(fake_aws):
+    serial = get_spilos('eu-west-1', ttl=0)
+    calls = fake_aws.calls['describe_stack_resources']
+
+    # # Only the stack of the cluster is described, not the 19 other ones
+    assert get_spilos('eu-west-1', clusters=['cluster3'], match='exact', ttl=0) == [serial[3]]
+    assert fake_aws.calls['describe_stack_resources'] == calls + 1
+
+    # # The dns names are found in the CNAME index, before we look at the stacks
+    fake_aws.records['zone2'].append(Record('alias1.example.org.', 'CNAME', [elb_dns_name(1)]))
+    assert get_spilos('eu-west-1', clusters=['alias1'], ttl=0) == [serial[1]._replace(
+        dns=['cluster1.db.example.com', 'alias1.example.org'])]
+    assert fake_aws.calls['describe_stack_resources'] == calls + 2
+
+    # # A regex matching the load balancers matches all stacks
+    assert len(get_spilos('eu-west-1', clusters=['^internal-'], ttl=0)) == 5
+    assert fake_aws.calls['describe_stack_resources'] == calls + 22
+
+
+def test_remember_non_spilos(fake_aws):
+    def described(**kwargs):
+        before = fake_aws.calls['describe_stack_resources']
+        assert len(discover_spilos('eu-west-1', **kwargs)) == 5
+        return fake_aws.calls['describe_stack_resources'] - before
+
+    assert described() == 20
+    assert described() == 5
+
+    # # A stack which was updated may have become a spilo
+    fake_aws.stacks[7] = fake_aws.stacks[7]._replace(stack_status='UPDATE_COMPLETE')
+    assert described() == 6
+    assert described() == 5
+
+    # # Updating it again leaves the status as it was, only the time of the update tells
+    fake_aws.stacks[7] = fake_aws.stacks[7]._replace(LastUpdatedTime='2015-11-02T10:00:00Z')
+    assert described() == 6
+    assert described() == 5
+
+    assert described(refresh=True) == 20
+    assert described(remember=False) == 20
+
+
+def test_remembered_non_spilos_expire(fake_aws):
+    assert len(discover_spilos('eu-west-1')) == 5
+    before = fake_aws.calls['describe_stack_resources']
+    assert len(discover_spilos('eu-west-1', ttl=1)) == 5
+    assert fake_aws.calls['describe_stack_resources'] == before + 5
+
+    cache = spilo.cache.read_json(spilo.cache.STACKS_CACHE)
+    cache['eu-west-1']['timestamp'] -= 2
+    spilo.cache.write_json(spilo.cache.STACKS_CACHE, cache)
+    assert len(discover_spilos('eu-west-1', ttl=1)) == 5
+    assert fake_aws.calls['describe_stack_resources'] == before + 25
@@ -0,0 +1,178 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import pytest
+
+from spilo.health import Prober, probe_all
+
+from test_tunnels import free_port
+
+
+class PatroniServer(ThreadingMixIn, HTTPServer):
+    """Stands in for the REST api of Patroni, counting the connections and requests it gets"""
+
+    daemon_threads = True
+
+    def __init__(self, status, delay=0, keep_alive=True):
+        self.status = status
+        self.delay = delay
+        self.connections = 0
+        self.requests = 0
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1' if keep_alive else 'HTTP/1.0'
+
+            def setup(handler):
+                self.connections += 1
+                BaseHTTPRequestHandler.setup(handler)
+
+            def do_GET(handler):
+                self.requests += 1
+                time.sleep(self.delay)
+                body = json.dumps(self.status).encode('utf-8')
+                handler.send_response(200)
+                handler.send_header('Content-Type', 'application/json')
+                handler.send_header('Content-Length', str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, *args):
+                pass
+
+        HTTPServer.__init__(self, ('127.0.0.1', 0), Handler)
+        self.port = self.server_address[1]
+        threading.Thread(target=self.serve_forever, args=(0.05,), daemon=True).start()
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+
+MASTER = {'state': 'running', 'role': 'master', 'timeline': 3, 'xlog': {'location': 1000}}
+REPLICA = {'state': 'running', 'role': 'replica', 'timeline': 3,
+           'xlog': {'received_location': 1000, 'replayed_location': 900}}
+
+
+@pytest.fixture
+def patroni():
+    servers = list()
+
+    def start(status=MASTER, **kwargs):
+        servers.append(PatroniServer(status, **kwargs))
+        return servers[-1]
+
+    yield start
+    for server in servers:
+        server.close()
+
+
+class FakeCursor(object):
+
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, query):
+        if self.db.fail:
+            raise Exception('server closed the connection unexpectedly')
+        self.db.queries.append(query)
+
+    def fetchone(self):
+        return False, 42
+
+
+class FakeConnection(object):
+    server_version = 90500
+
+    def __init__(self):
+        self.queries = list()
+        self.fail = False
+        self.closed = False
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def close(self):
+        self.closed = True
+
+
+def test_probe_patroni(patroni):
+    prober = Prober('replica', patroni(REPLICA).port)
+    result = prober.probe()
+    prober.close()
+
+    assert result['role'] == 'replica'
+    assert result['timeline'] == 3
+    assert result['lag'] == 100
+    assert result['rest_ms'] > 0
+    assert result['sql_ms'] is None
+    assert result['error'] is None
+
+
+def test_connections_are_reused(patroni):
+    servers = [patroni() for _ in range(3)]
+    probers = [Prober('cluster{}'.format(i), s.port) for i, s in enumerate(servers)]
+
+    for _ in range(3):
+        assert all(r['role'] == 'master' for r in probe_all(probers))
+
+    assert [(s.connections, s.requests) for s in servers] == [(1, 3)] * 3
+
+
+def test_closed_connections_are_reopened(patroni):
+    server = patroni(keep_alive=False)
+    prober = Prober('cluster', server.port)
+
+    for _ in range(3):
+        assert prober.probe()['error'] is None
+    assert server.connections == server.requests == 3
+
+
+def test_probe_unreachable(patroni):
+    probers = [Prober('down', free_port()), Prober('up', patroni().port)]
+
+    down, up = probe_all(probers)
+    assert down['error'].startswith('patroni:')
+    assert down['role'] is None
+    assert up['error'] is None
+
+
+def test_probes_are_concurrent(patroni):
+    probers = [Prober('cluster{}'.format(i), patroni(delay=0.2).port) for i in range(8)]
+
+    start = time.time()
+    probe_all(probers, concurrency=8)
+    assert time.time() - start < 0.2 * 4
+
+
+def test_probe_postgres(patroni):
+    connections = list()
+
+    def connect(**parameters):
+        assert parameters['port'] == 5432 and parameters['dbname'] == 'postgres'
+        connections.append(FakeConnection())
+        return connections[-1]
+
+    prober = Prober('cluster', patroni().port, 5432, {'dbname': 'postgres'}, connect=connect)
+
+    result = prober.probe()
+    assert result['lag'] == 42
+    assert result['sql_ms'] is not None
+    assert 'pg_current_xlog_location()' in connections[0].queries[0]
+
+    # # The connection is reused, until it fails
+    prober.probe()
+    connections[0].fail = True
+    assert prober.probe()['error'].startswith('postgres:')
+    assert connections[0].closed
+
+    assert prober.probe()['error'] is None
+    assert len(connections) == 2
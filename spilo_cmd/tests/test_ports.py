@@ -0,0 +1,56 @@
+import multiprocessing
+import os
+import socket
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+
+import spilo.ports
+from spilo.ports import release_ports, reserve_ports
+from spilo.registry import register_tunnel
+
+
+@pytest.fixture
+def ports(monkeypatch, tmp_path):
+    monkeypatch.setattr(spilo.ports, 'RESERVATIONS', str(tmp_path / 'ports.json'))
+    monkeypatch.setattr(spilo.ports, 'PORT_RANGE', '21000-21019')
+    monkeypatch.setattr(spilo.registry, 'REGISTRY', str(tmp_path / 'tunnels.json'))
+    return tmp_path
+
+
+def test_reserve_ports(ports):
+    first = reserve_ports(2)
+    second = reserve_ports(2)
+
+    assert len(set(first + second)) == 4
+    assert all(p in range(21000, 21020) for p in first + second)
+
+    release_ports(first)
+    assert set(reserve_ports(16)).isdisjoint(second)
+
+
+def test_reserve_skips_tunnels_and_bound_ports(ports, monkeypatch):
+    monkeypatch.setattr(spilo.ports, 'PORT_RANGE', '21000-21003')
+    register_tunnel(os.getpid(), {'SPILOCLUSTER': 'mock', 'SPILOPGPORT': '21000', 'SPILOPATRONIPORT': '21001'})
+
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 21002))
+        s.listen(1)
+        assert reserve_ports(1) == [21003]
+
+        with pytest.raises(Exception) as e:
+            reserve_ports(1)
+        assert 'No free ports' in str(e.value)
+
+
+def reserve(count):
+    return reserve_ports(count)
+
+
+def test_concurrent_reservations(ports, monkeypatch):
+    monkeypatch.setattr(spilo.ports, 'PORT_RANGE', '21000-21099')
+
+    with ProcessPoolExecutor(8, mp_context=multiprocessing.get_context('fork')) as executor:
+        reserved = [p for result in executor.map(reserve, [2] * 40) for p in result]
+
+    assert len(reserved) == len(set(reserved)) == 80
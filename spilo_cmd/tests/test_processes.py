@@ -0,0 +1,59 @@
+import os
+
+from spilo.processes import parse_ps_output, scan_proc
+
+NOISE = ' '.join('VARIABLE{}={}'.format(i, 'x' * 40) for i in range(40))
+
+
+def tunnel_environment(n):
+    return ['SPILOCLUSTER=cluster{}'.format(n), 'SPILOHOST=cluster{}.db.example.com'.format(n),
+            'SPILOSERVICE=', 'SPILOVPCID=vpc-{}'.format(n), 'SPILOPGPORT={}'.format(20000 + n),
+            'SPILOPATRONIPORT={}'.format(30000 + n)]
+
+
+def synthetic_processes(count, tunnels):
+    """Yields (pid, comm, argv, environment) for a process table of count processes"""
+
+    for pid in range(1, count + 1):
+        environment = NOISE.split()
+        if pid % (count // tunnels) == 0:
+            yield pid, 'ssh', ['ssh', 'odd', '-N'], environment + tunnel_environment(pid)
+        else:
+            yield pid, 'bash', ['-bash'], environment
+
+
+def write_proc(root, processes):
+    for pid, comm, argv, environment in processes:
+        path = os.path.join(root, str(pid))
+        os.mkdir(path)
+        with open(os.path.join(path, 'comm'), 'w') as f:
+            f.write(comm + '\n')
+        with open(os.path.join(path, 'cmdline'), 'w') as f:
+            f.write('\0'.join(argv) + '\0')
+        with open(os.path.join(path, 'environ'), 'w') as f:
+            f.write('\0'.join(environment) + '\0')
+    os.mkdir(os.path.join(root, 'self'))
+
+
+def ps_output(processes):
+    lines = [b'  PID COMMAND']
+    for pid, comm, argv, environment in processes:
+        lines.append('{:>5} {} {}'.format(pid, ' '.join(argv), ' '.join(environment)).encode())
+    return lines
+
+
+def test_scanners(tmp_path):
+    processes = list(synthetic_processes(2000, 10))
+    write_proc(str(tmp_path), processes)
+    lines = ps_output(processes)
+
+    from_ps = parse_ps_output(lines)
+    from_proc = scan_proc(str(tmp_path))
+
+    assert len(from_proc) == 10
+    assert from_proc == from_ps
+    assert from_proc[0] == {'pid': '200', 'process': 'ssh', 'cluster': 'cluster200', 'pgport': '20200',
+                            'patroniport': '30200', 'host': 'cluster200.db.example.com', 'vpc_id': 'vpc-200',
+                            'service': '', 'dsn': '"host=localhost port=20200 service="'}
+
+    assert scan_proc(str(tmp_path), uid=os.getuid() + 1) == []
@@ -0,0 +1,71 @@
+import types
+
+import pytest
+
+import spilo.spilo
+from spilo.spilo import get_spilos, get_spilos_in_regions, iter_spilos_in_regions, print_spilos, update_spilo_info
+
+from conftest import FakeAWS
+
+
+@pytest.fixture
+def regions(monkeypatch, fake_aws):
+    fakes = {'eu-west-1': fake_aws, 'eu-central-1': FakeAWS(stacks=10, spilos=3),
+             'us-east-1': FakeAWS(stacks=5, spilos=1)}
+
+    # # Every region has its own fake, Route 53 is only asked through the first region as it is a global service
+    def connect(region):
+        return fakes[region]
+
+    services = types.SimpleNamespace(connect_to_region=connect)
+    ec2 = types.SimpleNamespace(connect_to_region=connect, elb=services)
+    monkeypatch.setattr(spilo.spilo, 'boto', types.SimpleNamespace(ec2=ec2, cloudformation=services, route53=services))
+    monkeypatch.setattr(spilo.spilo, 'get_stacks', lambda stack_refs, region, all: fakes[region].get_stacks(
+                        stack_refs, region, all))
+    return fakes
+
+
+def test_get_spilos_in_regions(regions):
+    spilos = get_spilos_in_regions(['eu-west-1', 'eu-central-1', 'us-east-1'], ttl=0)
+
+    assert [(s.region, s.version) for s in spilos] == \
+        [('eu-west-1', 'cluster{}'.format(i)) for i in range(5)] + \
+        [('eu-central-1', 'cluster{}'.format(i)) for i in range(3)] + [('us-east-1', 'cluster0')]
+
+    # # The CNAME index is built only once
+    assert sum(fake.calls['get_zones'] for fake in regions.values()) == 1
+
+    spilos = update_spilo_info(spilos)
+    assert all(len(s.instances) == 3 for s in spilos)
+    assert [fake.calls['get_only_instances'] for fake in regions.values()] == [1, 1, 1]
+
+    print_spilos(spilos, show_region=True)
+
+
+def test_iter_spilos_in_regions(regions):
+    spilos = list(iter_spilos_in_regions(['eu-west-1', 'eu-central-1', 'us-east-1'], ttl=0))
+    assert sorted((s.region, s.version) for s in spilos) == sorted(
+        [('eu-west-1', 'cluster{}'.format(i)) for i in range(5)] +
+        [('eu-central-1', 'cluster{}'.format(i)) for i in range(3)] + [('us-east-1', 'cluster0')])
+
+
+def regions_overlap(regions):
+    """Whether every region was asked something before the first region got its last answer"""
+
+    spans = [(min(start for start, _ in fake.intervals), max(end for _, end in fake.intervals))
+             for fake in regions.values()]
+    return max(start for start, _ in spans) < min(end for _, end in spans)
+
+
+def test_regions_in_parallel(regions):
+    for fake in regions.values():
+        fake.latency = 0.01
+
+    for region in regions:
+        get_spilos(region, ttl=0)
+    assert not regions_overlap(regions)
+
+    for fake in regions.values():
+        fake.intervals.clear()
+    get_spilos_in_regions(regions, ttl=0)
+    assert regions_overlap(regions)
@@ -0,0 +1,44 @@
+import os
+import subprocess
+
+from spilo.processes import tunnel_process
+from spilo.registry import adopt_tunnels, get_tunnels, register_tunnel, unregister_tunnel
+
+ENVIRONMENT = {'SPILOCLUSTER': 'cluster1', 'SPILOHOST': 'cluster1.db.example.com', 'SPILOSERVICE': '',
+               'SPILOVPCID': 'vpc-1', 'SPILOPGPORT': '20001', 'SPILOPATRONIPORT': '30001'}
+
+
+def test_registry(tmp_path):
+    filename = str(tmp_path / 'tunnels.json')
+    assert get_tunnels(filename) == []
+
+    entry = register_tunnel(os.getpid(), ENVIRONMENT, filename=filename)
+    assert entry['pgport'] == '20001'
+    assert entry['host'] == 'cluster1.db.example.com'
+    assert get_tunnels(filename) == [entry]
+
+    # # A tunnel which has exited is pruned
+    dead = subprocess.Popen(['true'])
+    dead.wait()
+    register_tunnel(dead.pid, dict(ENVIRONMENT, SPILOCLUSTER='cluster2'), filename=filename)
+    assert [t['cluster'] for t in get_tunnels(filename)] == ['cluster1']
+
+    unregister_tunnel(os.getpid(), filename=filename)
+    assert get_tunnels(filename) == []
+
+
+def test_adopt_tunnels(tmp_path):
+    filename = str(tmp_path / 'tunnels.json')
+    registered = register_tunnel(os.getpid(), ENVIRONMENT, filename=filename)
+
+    dead = subprocess.Popen(['true'])
+    dead.wait()
+    scanned = [tunnel_process(str(os.getpid()), 'ssh', ENVIRONMENT),
+               tunnel_process(str(os.getpid()), 'ssh', dict(ENVIRONMENT, SPILOCLUSTER='cluster2', SPILOPGPORT='20002')),
+               tunnel_process(str(dead.pid), 'ssh', dict(ENVIRONMENT, SPILOCLUSTER='cluster3', SPILOPGPORT='20003'))]
+
+    # # Only the running tunnel which is not registered yet is adopted, once
+    assert [e['cluster'] for e in adopt_tunnels(lambda: scanned, filename)] == ['cluster2']
+    assert adopt_tunnels(lambda: scanned, filename) == []
+    assert [t['cluster'] for t in get_tunnels(filename)] == ['cluster1', 'cluster2']
+    assert get_tunnels(filename)[0] == registered
@@ -0,0 +1,45 @@
+import os
+import subprocess
+import sys
+
+# # Cumulative import time of spilo.spilo in microseconds, as reported by python -X importtime
+IMPORT_BUDGET = int(os.environ.get('SPILO_IMPORT_BUDGET', 200000))
+
+AWS_MODULES = ('boto', 'boto3', 'botocore', 'senza')
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run_python(*args, **env):
+    environment = dict(os.environ, PYTHONPATH=ROOT, **env)
+    return subprocess.run([sys.executable] + list(args), cwd=ROOT, env=environment, stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE, universal_newlines=True, check=True)
+
+
+def loaded_modules(code, modules=AWS_MODULES, **env):
+    code += '\nprint(" ".join(m for m in sys.modules if m.split(".")[0] in {}))'.format(modules)
+    return run_python('-c', 'import sys\n' + code, **env).stdout.splitlines()[-1].split()
+
+
+def import_time():
+    stderr = run_python('-X', 'importtime', '-c', 'import spilo.spilo').stderr
+    for line in stderr.splitlines():
+        _, _, cumulative, name = [f.strip() for f in line.replace(':', '|', 1).split('|')]
+        if name == 'spilo.spilo':
+            return int(cumulative)
+
+
+def test_import_does_not_load_aws():
+    assert loaded_modules('import spilo.spilo', AWS_MODULES + ('clickclick', 'yaml')) == []
+
+
+def test_tunnel_list_does_not_load_aws(tmp_path):
+    code = 'from spilo.spilo import cli\ntry:\n    cli(["tunnel", "--list", "mock"])\nexcept SystemExit:\n    pass'
+    assert loaded_modules(code, XDG_CACHE_HOME=str(tmp_path), HOME=str(tmp_path)) == []
+
+
+def test_import_time():
+    # # The best of a few runs, so a busy machine does not fail the test
+    best = min(import_time() for _ in range(3))
+    assert best < IMPORT_BUDGET, 'Importing spilo took {}ms, the budget is {}ms'.format(best // 1000,
+                                                                                        IMPORT_BUDGET // 1000)
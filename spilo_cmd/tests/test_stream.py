@@ -0,0 +1,48 @@
+import json
+
+from click.testing import CliRunner
+
+from spilo.aws import parallel_imap
+from spilo.spilo import cli, get_spilos, iter_spilos
+
+
+def test_parallel_imap():
+    assert list(parallel_imap(lambda x: x * 2, range(10), concurrency=4)) == [x * 2 for x in range(10)]
+    assert list(parallel_imap(lambda x: x * 2, [], concurrency=4)) == []
+    assert list(parallel_imap(lambda x: x * 2, [1, 2], concurrency=None)) == [2, 4]
+
+
+def test_first_spilo_before_discovery_is_done(fake_aws):
+    spilos = iter_spilos('eu-west-1', concurrency=1, ttl=0)
+    first = next(spilos)
+    first_calls = fake_aws.calls['describe_stack_resources']
+    rest = list(spilos)
+
+    # # The first spilo comes before the resources of most stacks have been asked for
+    assert first_calls < fake_aws.calls['describe_stack_resources'] / 2
+    assert [first] + rest == get_spilos('eu-west-1', concurrency=1, ttl=0)
+
+
+def test_cache_is_stored_when_done(fake_aws):
+    assert [s.version for s in iter_spilos('eu-west-1', clusters=['cluster2'])] == ['cluster2']
+
+    calls = sum(fake_aws.calls.values())
+    assert [s.version for s in get_spilos('eu-west-1', clusters=['cluster2'])] == ['cluster2']
+    assert sum(fake_aws.calls.values()) == calls
+
+
+def test_list_output(fake_aws):
+    runner = CliRunner()
+
+    result = runner.invoke(cli, ['list', '--region', 'eu-west-1', '--output', 'jsonl', '--cache-ttl', '0'])
+    assert result.exit_code == 0, result.output
+    lines = [json.loads(line) for line in result.output.splitlines()]
+    assert [line['version'] for line in lines] == ['cluster{}'.format(i) for i in range(5)]
+    assert lines[0]['region'] == 'eu-west-1' and lines[0]['instances'] is None
+
+    result = runner.invoke(cli, ['list', '--region', 'eu-west-1', '--output', 'stream', '--details',
+                                 '--cache-ttl', '0', 'cluster1'])
+    assert result.exit_code == 0, result.output
+    lines = result.output.splitlines()
+    assert lines[0].startswith('Cluster') and 'Instance ID' in lines[0]
+    assert len(lines) == 4 and 'i-10' in lines[1]
@@ -0,0 +1,133 @@
+import os
+import signal
+import threading
+import time
+
+import pytest
+
+import spilo.spilo
+import spilo.supervisor
+from spilo.registry import get_tunnels
+from spilo.spilo import find_tunnels, get_tunnel, kill_tunnel
+from spilo.supervisor import Supervisor, is_listening, query_status
+
+from conftest import echo
+
+
+@pytest.fixture
+def supervisor(fake_ssh, tmp_path, monkeypatch):
+    path = str(tmp_path / 'supervisor.sock')
+    monkeypatch.setattr(spilo.supervisor, 'SOCKET', path)
+
+    supervisor = Supervisor(interval=3600)
+    thread = threading.Thread(target=supervisor.run, daemon=True)
+    thread.start()
+    while query_status() is None:
+        time.sleep(0.01)
+
+    yield supervisor
+
+    supervisor.stop()
+    thread.join()
+    for process in supervisor.processes.values():
+        process.kill()
+        process.wait()
+
+
+def kill(pid, port):
+    """Kills the ssh of a tunnel, and waits until its port is closed"""
+
+    os.kill(pid, signal.SIGKILL)
+    deadline = time.time() + 5
+    while is_listening(port) and time.time() < deadline:
+        time.sleep(0.01)
+
+
+@pytest.mark.parametrize('multiplex', [False, True])
+def test_restart_dead_tunnel(supervisor, fake_ssh, multiplex):
+    fake_ssh['multiplex'] = multiplex
+
+    pid = get_tunnel('mock')
+    port = get_tunnels()[0]['pgport']
+    supervisor.check()
+    assert [s['state'] for s in query_status()] == ['up']
+
+    kill(pid, port)
+    with pytest.raises(OSError):
+        echo(port)
+
+    # # The supervisor keeps the tunnel registered, and starts it again on the same port
+    assert [e['pgport'] for e in get_tunnels()] == [port]
+    supervisor.check()
+    assert echo(port) == b'ping'
+
+    status = query_status()
+    assert [(s['pgport'], s['state'], s['restarts']) for s in status] == [(port, 'up', 1)]
+    assert status[0]['pid'] != str(pid)
+    assert [(e['pgport'], e['state']) for e in find_tunnels()] == [(port, 'up')]
+
+
+def test_killed_tunnel_is_not_restarted(supervisor, fake_ssh):
+    get_tunnel('mock')
+    supervisor.check()
+
+    kill_tunnel(get_tunnels()[0])
+    supervisor.check()
+    assert get_tunnels() == []
+    assert query_status() == []
+    assert supervisor.processes == dict()
+
+
+def test_no_supervisor(fake_ssh, tmp_path, monkeypatch):
+    monkeypatch.setattr(spilo.supervisor, 'SOCKET', str(tmp_path / 'supervisor.sock'))
+    assert query_status() is None
+
+    get_tunnel('mock')
+    assert [e['host'] for e in find_tunnels()] == ['127.0.0.1']
+    assert 'state' not in find_tunnels()[0]
+
+
+def test_foreground_tunnel_is_not_restarted(supervisor, fake_ssh, monkeypatch):
+    monkeypatch.setattr(spilo.spilo, 'managed_processes', dict())
+    fake_ssh['background'] = False
+    get_tunnel('mock')
+    supervisor.check()
+    process = spilo.spilo.managed_processes['tunnel']
+
+    # # cleanup unregisters the tunnel before it kills ssh, so the supervisor lets it go
+    killed_while_registered = list()
+    kill = process.kill
+
+    def checked_kill():
+        killed_while_registered.append(get_tunnels() != [])
+        kill()
+
+    monkeypatch.setattr(process, 'kill', checked_kill)
+    spilo.spilo.cleanup()
+    process.wait()
+    supervisor.check()
+    assert killed_while_registered == [False]
+    assert get_tunnels() == []
+
+
+def test_down_tunnel_is_not_reused(supervisor, fake_ssh, monkeypatch):
+    pid = get_tunnel('mock')
+    port = get_tunnels()[0]['pgport']
+    supervisor.check()
+
+    def restart(entry):
+        raise Exception('ssh: connect to host 127.0.0.1 port 22: Connection refused')
+
+    monkeypatch.setattr(supervisor, 'restart', restart)
+    kill(pid, port)
+    # # ssh was started by us, it would live on as a zombie
+    os.waitpid(pid, 0)
+    supervisor.check()
+    assert [s['state'] for s in query_status()] == ['down']
+    # # The supervisor is alive, so the tunnel still counts as running
+    assert [e['pgport'] for e in get_tunnels()] == [port]
+
+    new_pid = get_tunnel('mock')
+    assert new_pid != pid
+    assert [e['pid'] for e in get_tunnels()] == [str(new_pid)]
+    assert echo(get_tunnels()[0]['pgport']) == b'ping'
@@ -0,0 +1,110 @@
+import multiprocessing
+import os
+import socket
+import subprocess
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+
+import spilo.spilo
+from spilo.registry import get_tunnels
+from spilo.spilo import get_tunnel, kill_tunnel
+from spilo.ssh import wait_for_tunnel
+
+from conftest import echo
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_ssh(port, target_port, **env):
+    stderr = tempfile.TemporaryFile()
+    process = subprocess.Popen(['ssh', 'odd', '-L', '{}:127.0.0.1:{}'.format(port, target_port), '-N'],
+                               stderr=stderr, env=dict(os.environ, **env))
+    return process, stderr
+
+
+def test_tunnel(fake_ssh):
+    pid = get_tunnel('mock')
+    assert echo(spilo.spilo.tunnels['postgres']) == b'ping'
+
+    # # The second time around the registered tunnel is reused
+    assert get_tunnel('mock') == str(pid)
+
+    entries = get_tunnels()
+    assert [e['pid'] for e in entries] == [str(pid)]
+    assert entries[0]['host'] == '127.0.0.1'
+    assert entries[0]['latency'] > 0
+
+    kill_tunnel(entries[0])
+    assert get_tunnels() == []
+
+
+def test_wait_for_tunnel(fake_ssh, echo_server):
+    port = free_port()
+    process, stderr = start_ssh(port, echo_server.port, FAKE_SSH_DELAY='0.3')
+    try:
+        assert 0.3 <= wait_for_tunnel(port, process, stderr) < 5
+        assert echo(port) == b'ping'
+    finally:
+        process.kill()
+
+
+def test_wait_for_failing_tunnel(fake_ssh, echo_server):
+    process, stderr = start_ssh(free_port(), echo_server.port, FAKE_SSH_FAIL='1')
+    with pytest.raises(Exception) as e:
+        wait_for_tunnel(free_port(), process, stderr, timeout=30)
+    assert 'Connection refused' in str(e.value)
+
+    with pytest.raises(Exception) as e:
+        wait_for_tunnel(free_port(), timeout=0.2)
+    assert 'timeout' in str(e.value)
+
+
+def test_multiplexed_tunnels(fake_ssh):
+    fake_ssh['multiplex'] = True
+
+    first = get_tunnel('mock')
+    first_port = spilo.spilo.tunnels['postgres']
+    second = get_tunnel('mock', reuse=False)
+    second_port = spilo.spilo.tunnels['postgres']
+
+    # # Both tunnels are forwards on the same master connection
+    assert first == second
+    assert first_port != second_port
+    assert echo(first_port) == b'ping'
+    assert echo(second_port, b'pong') == b'pong'
+
+    entries = get_tunnels()
+    assert len(entries) == 2
+    assert all(e['destination'] == 'odd' for e in entries)
+
+    kill_tunnel(entries[0])
+    with pytest.raises(OSError):
+        echo(entries[0]['pgport'])
+    assert echo(entries[1]['pgport']) == b'ping'
+
+    # # The master is still running, and reused by new tunnels
+    assert get_tunnel('mock', reuse=False) == first
+
+
+def open_tunnel(_):
+    get_tunnel('mock', reuse=False)
+    return spilo.spilo.tunnels['postgres']
+
+
+@pytest.mark.parametrize('multiplex', [False, True])
+def test_concurrent_tunnels(fake_ssh, multiplex):
+    fake_ssh['multiplex'] = multiplex
+
+    # # Every worker is a separate spilo process, they only share the reservations and the registry
+    with ProcessPoolExecutor(4, mp_context=multiprocessing.get_context('fork')) as executor:
+        ports = list(executor.map(open_tunnel, range(12)))
+
+    assert len(set(ports)) == 12
+    assert all(echo(port) == b'ping' for port in ports)
+    assert sorted(int(e['pgport']) for e in get_tunnels()) == sorted(ports)